@@ -1,11 +1,15 @@
-from django.contrib import admin
-from .models import TelegramUser, Group, Participant, Draw
+from django.contrib import admin, messages
+from django.utils import timezone
+from .models import TelegramUser, Group, Participant, Draw, Exclusion, OutboxMessage, ConversationState, UserState
+from .services import add_couple_exclusion, exclude_previous_pairs
 
 
 @admin.register(TelegramUser)
 class TelegramUserAdmin(admin.ModelAdmin):
-    list_display = ('telegram_id', 'username', 'first_name', 'created_at')
+    list_display = ('telegram_id', 'username', 'first_name', 'is_reachable', 'created_at')
+    list_filter = ('is_reachable',)
     search_fields = ('telegram_id', 'username', 'first_name')
+    readonly_fields = ('unreachable_since',)
 
 
 @admin.register(Group)
@@ -14,6 +18,12 @@ class GroupAdmin(admin.ModelAdmin):
     list_filter = ('status', 'gift_via_bot', 'is_closed', 'created_at')
     search_fields = ('name', 'code')
     readonly_fields = ('code', 'created_at', 'drawn_at')
+    actions = ['exclude_previous_pairs']
+    
+    @admin.action(description='Исключить пары прошлого розыгрыша')
+    def exclude_previous_pairs(self, request, queryset):
+        added = sum(exclude_previous_pairs(group) for group in queryset)
+        self.message_user(request, f'Добавлено исключений: {added}')
 
 
 @admin.register(Participant)
@@ -21,6 +31,16 @@ class ParticipantAdmin(admin.ModelAdmin):
     list_display = ('name', 'group', 'user', 'gift_sent', 'has_gift_photo', 'joined_at')
     list_filter = ('group', 'gift_sent', 'joined_at')
     search_fields = ('name', 'group__name')
+    actions = ['exclude_couple']
+    
+    @admin.action(description='Запретить паре дарить подарки друг другу')
+    def exclude_couple(self, request, queryset):
+        participants = list(queryset)
+        if len(participants) != 2 or participants[0].group_id != participants[1].group_id:
+            self.message_user(request, 'Выберите двух участников одной группы', messages.ERROR)
+            return
+        add_couple_exclusion(participants[0].group, *participants)
+        self.message_user(request, f'{participants[0].name} и {participants[1].name} не будут дарить подарки друг другу')
     
     def has_gift_photo(self, obj):
         return bool(obj.gift_photo_file_id)
@@ -30,6 +50,45 @@ class ParticipantAdmin(admin.ModelAdmin):
 
 @admin.register(Draw)
 class DrawAdmin(admin.ModelAdmin):
-    list_display = ('group', 'giver', 'receiver', 'created_at')
+    list_display = ('group', 'giver', 'receiver', 'notified_at', 'delivered_at', 'attempts', 'created_at')
     list_filter = ('group', 'created_at')
+    readonly_fields = ('notified_at', 'delivered_at', 'attempts', 'last_error')
+    search_fields = ('group__name', 'giver__name', 'receiver__name')
+
+
+@admin.register(Exclusion)
+class ExclusionAdmin(admin.ModelAdmin):
+    list_display = ('group', 'giver', 'receiver', 'reason', 'created_at')
+    list_filter = ('reason', 'group')
     search_fields = ('group__name', 'giver__name', 'receiver__name')
+    raw_id_fields = ('group', 'giver', 'receiver')
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('idempotency_key', 'chat_id', 'status', 'attempts', 'next_attempt_at', 'sent_at', 'created_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('idempotency_key', 'chat_id')
+    readonly_fields = ('created_at', 'sent_at')
+    raw_id_fields = ('draw',)
+    actions = ['retry_messages']
+    
+    @admin.action(description='Повторить отправку')
+    def retry_messages(self, request, queryset):
+        updated = queryset.exclude(status='sent').update(status='pending', next_attempt_at=timezone.now())
+        self.message_user(request, f'Поставлено в очередь повторно: {updated}')
+
+
+@admin.register(ConversationState)
+class ConversationStateAdmin(admin.ModelAdmin):
+    list_display = ('name', 'key', 'state', 'updated_at')
+    list_filter = ('name',)
+    search_fields = ('key',)
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(UserState)
+class UserStateAdmin(admin.ModelAdmin):
+    list_display = ('telegram_id', 'updated_at')
+    search_fields = ('telegram_id',)
+    readonly_fields = ('updated_at',)
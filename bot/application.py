@@ -0,0 +1,147 @@
+"""
+Сборка и жизненный цикл приложения python-telegram-bot.
+
+Используется командой runbot (режим polling) и ASGI-приложением проекта
+(режим webhook, см. bot/webhook.py).
+"""
+import asyncio
+
+from telegram.ext import Application
+
+from . import db, metrics, outbox, profiling
+from .telegram_requests import build_request, make_bot
+from .bot_handler import setup_handlers
+from .middleware import user_cache
+from .persistence import persistence_from_settings
+from .scheduler import setup_scheduler
+
+
+def build_application(
+    token,
+    outbox_workers=outbox.DEFAULT_WORKERS,
+    outbox_batch_size=outbox.DEFAULT_BATCH_SIZE,
+    webhook=False,
+    update_queue_size=0,
+    request=None,
+    base_url=None,
+    persistence=None,
+    scheduler=True,
+    http_options=None,
+    metrics_port=None,
+    metrics_host='127.0.0.1',
+    concurrent_updates=None,
+):
+    """
+    Создает приложение бота с обработчиками и воркерами outbox.
+
+    webhook=True - приложение без Updater: обновления кладутся в
+    application.update_queue извне; update_queue_size ограничивает очередь
+    (0 - без ограничения). request - свой BaseRequest (например, фейковый
+    Bot API в тестах), base_url - адрес Bot API вместо api.telegram.org.
+    persistence - хранилище диалогов, по умолчанию DjangoPersistence
+    (см. bot/persistence.py). scheduler - запускать автоматический розыгрыш
+    и закрытие групп по датам (см. bot/scheduler.py).
+
+    Без своего request у getUpdates, ответов пользователям и рассылок outbox
+    отдельные HTTP-клиенты (см. bot/telegram_requests.py); http_options
+    переопределяет их параметры: {профиль: {параметр: значение}}.
+    metrics_port - запустить HTTP-сервер метрик GET /metrics (bot/metrics.py).
+    concurrent_updates - параллельная обработка обновлений (число или
+    BaseUpdateProcessor), по умолчанию обновления обрабатываются по одному.
+    """
+    # Рассылка идет через отдельный Bot, чтобы не занимать соединения ответов пользователям
+    broadcast_bot = None
+    if request is None and outbox_workers:
+        broadcast_bot = make_bot(token, 'broadcast', base_url, http_options)
+    metrics_server = []
+
+    async def post_init(application):
+        if metrics_port:
+            metrics_server.append(await metrics.start_server(metrics_port, metrics_host))
+        if broadcast_bot is not None:
+            await broadcast_bot.initialize()
+        # Воркеры доставки продолжают рассылку с того места, где она остановилась
+        outbox.start_workers(
+            broadcast_bot or application.bot,
+            workers=outbox_workers,
+            batch_size=outbox_batch_size
+        )
+
+    async def post_shutdown(application):
+        await outbox.stop_workers()
+        if broadcast_bot is not None:
+            await broadcast_bot.shutdown()
+        for server in metrics_server:
+            server.close()
+            await server.wait_closed()
+        stats = user_cache.stats()
+        print(
+            f"Кэш пользователей: попаданий {stats['hits']}, промахов {stats['misses']}, "
+            f"записей {stats['size']}/{stats['maxsize']}"
+        )
+        stats = db.db_executor.stats()
+        print(
+            f"Запросы к БД: вызовов {stats['calls']}, потоков {stats['threads']}, "
+            f"ожидание p50/p99 {stats['wait_p50_ms']:.1f}/{stats['wait_p99_ms']:.1f} мс, "
+            f"выполнение p50/p99 {stats['run_p50_ms']:.1f}/{stats['run_p99_ms']:.1f} мс"
+        )
+        print(
+            f"Соединения с БД: открыто {stats['connections']['opened']}, "
+            f"закрыто по возрасту {stats['connections']['expired']}, "
+            f"не прошли проверку {stats['connections']['failed_checks']}, "
+            f"переподключений {stats['connections']['reconnects']}, "
+            f"неудачных переподключений {stats['connections']['reconnect_failures']}"
+        )
+        profiler = profiling.handler_profiler
+        if profiler.updates:
+            print(
+                f"Профилирование: медленных обновлений {profiler.slow_updates} из {profiler.updates} "
+                f"(дольше {profiler.slow * 1000:.0f} мс)"
+            )
+
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(persistence or persistence_from_settings())
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        builder = (
+            builder.request(build_request('bot', http_options))
+            .get_updates_request(build_request('updates', http_options))
+        )
+    if concurrent_updates is not None:
+        builder = builder.concurrent_updates(concurrent_updates)
+    if webhook:
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=update_queue_size))
+    application = builder.build()
+
+    setup_handlers(application)
+    if scheduler:
+        setup_scheduler(application)
+    metrics.instrument_handlers(application)
+    return application
+
+
+async def start_application(application):
+    """Запускает приложение без Updater (обновления поступают через update_queue)"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application):
+    """Останавливает приложение, запущенное start_application"""
+    if application.running:
+        await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
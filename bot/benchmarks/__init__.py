@@ -0,0 +1,22 @@
+"""
+Бенчмарки проекта.
+
+Каждый модуль бенчмарка определяет:
+- HELP - краткое описание;
+- add_arguments(parser) - аргументы командной строки;
+- run(options, stdout) - запуск, возвращает словарь с результатами.
+
+Запуск: python manage.py benchmark <имя> [аргументы]
+"""
+
+# Имя бенчмарка -> модуль
+BENCHMARKS = {
+    'draw_solver': 'bot.benchmarks.draw_solver',
+    'handler_latency': 'bot.benchmarks.handler_latency',
+    'group_codes': 'bot.benchmarks.group_codes',
+    'db_concurrency': 'bot.benchmarks.db_concurrency',
+    'db_executor': 'bot.benchmarks.db_executor',
+    'bot_requests': 'bot.benchmarks.bot_requests',
+    'loadtest': 'bot.benchmarks.loadtest',
+    'micro': 'bot.benchmarks.micro',
+}
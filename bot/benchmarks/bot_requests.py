@@ -0,0 +1,139 @@
+"""
+Бенчмарк HTTP-клиентов Bot API (bot/telegram_requests.py).
+
+Против фейкового Bot API на localhost (FakeBotAPIServer) с задержкой ответа
+и задержкой первого ответа в новом соединении (как TLS-рукопожатие)
+одновременно идут:
+- рассылка пачками по --batch-size сообщений с --concurrency параллельными
+  отправками и паузой между пачками, как у воркеров outbox;
+- ответы --users пользователям, каждому по --replies сообщений подряд.
+Сравниваются:
+- shared - один HTTPXRequest с параметрами ApplicationBuilder по умолчанию
+  (пул 256 соединений, keep-alive для 20) на рассылку и ответы, как было;
+- split - отдельные клиенты профилей bot и broadcast из settings.
+Для каждого режима выводятся скорость рассылки, задержка ответов
+пользователям, ошибки и число открытых сервером соединений.
+
+Лимиты Telegram на скорость рассылки в бенчмарке отключены: измеряется
+HTTP-клиент, а не token bucket. Данные в БД не создаются.
+"""
+import asyncio
+import statistics
+import time
+
+from telegram import Bot
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+from bot.benchmarks.handler_latency import percentile
+from bot.broadcast import Broadcaster, OutgoingMessage
+from bot.fake_bot_api import BOT_TOKEN, FakeBotAPIServer
+from bot.telegram_requests import make_bot
+
+
+HELP = 'Рассылка и ответы пользователям: общий HTTP-клиент Bot API и отдельные пулы'
+UNLIMITED_RATE = 1_000_000
+
+
+def add_arguments(parser):
+    parser.add_argument('--messages', type=int, default=3000, help='Сообщений в рассылке')
+    parser.add_argument('--batch-size', type=int, default=500, help='Сообщений в пачке рассылки')
+    parser.add_argument('--concurrency', type=int, default=40, help='Параллельных отправок рассылки (по умолчанию как у воркеров outbox runbot)')
+    parser.add_argument('--pause-ms', type=float, default=200.0, help='Пауза между пачками (запросы к БД), мс')
+    parser.add_argument('--users', type=int, default=20, help='Пользователей, которым бот отвечает во время рассылки')
+    parser.add_argument('--replies', type=int, default=20, help='Ответов каждому пользователю')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Задержка ответа Bot API, мс')
+    parser.add_argument('--handshake-ms', type=float, default=100.0, help='Задержка нового соединения (TLS), мс')
+
+
+def _shared_bots(base_url):
+    # Так ApplicationBuilder создает клиент, если его не настроить
+    bot = Bot(BOT_TOKEN, base_url=base_url, request=HTTPXRequest(connection_pool_size=256))
+    return bot, bot
+
+
+def _split_bots(base_url):
+    return make_bot(BOT_TOKEN, 'bot', base_url), make_bot(BOT_TOKEN, 'broadcast', base_url)
+
+
+async def _simulate(reply_bot, broadcast_bot, options):
+    broadcaster = Broadcaster(global_rate=UNLIMITED_RATE, per_chat_rate=UNLIMITED_RATE)
+    latencies = []
+    errors = {'broadcast': 0, 'replies': 0}
+
+    async def run_broadcast():
+        started = time.perf_counter()
+        for start in range(0, options['messages'], options['batch_size']):
+            messages = [
+                OutgoingMessage(chat_id=1_000_000 + i, text='🎁 Рассылка')
+                for i in range(start, min(start + options['batch_size'], options['messages']))
+            ]
+            results = await broadcaster.broadcast(broadcast_bot, messages, concurrency=options['concurrency'])
+            errors['broadcast'] += sum(not result.ok for result in results)
+            await asyncio.sleep(options['pause_ms'] / 1000)
+        return time.perf_counter() - started
+
+    async def user_session(chat_id):
+        for _ in range(options['replies']):
+            started = time.perf_counter()
+            try:
+                await reply_bot.send_message(chat_id=chat_id, text='✅ Ответ')
+            except TelegramError:
+                errors['replies'] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            # Пользователь читает ответ и отправляет следующую команду
+            await asyncio.sleep(0.05)
+
+    broadcast_task = asyncio.ensure_future(run_broadcast())
+    await asyncio.gather(*(user_session(chat_id) for chat_id in range(1, options['users'] + 1)))
+    broadcast_seconds = await broadcast_task
+    return broadcast_seconds, latencies, errors
+
+
+async def _run_mode(make_bots, options):
+    with FakeBotAPIServer(latency=options['latency_ms'] / 1000, handshake=options['handshake_ms'] / 1000) as server:
+        reply_bot, broadcast_bot = make_bots(server.base_url)
+        bots = {reply_bot, broadcast_bot}
+        for bot in bots:
+            await bot.initialize()
+        try:
+            broadcast_seconds, latencies, errors = await _simulate(reply_bot, broadcast_bot, options)
+        finally:
+            for bot in bots:
+                await bot.shutdown()
+        return {
+            'broadcast_seconds': broadcast_seconds,
+            'broadcast_per_second': options['messages'] / broadcast_seconds,
+            'reply_p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+            'reply_p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+            'errors': errors,
+            'connections': server.connections,
+            'requests': server.requests,
+        }
+
+
+def run(options, stdout):
+    result = {
+        'messages': options['messages'],
+        'concurrency': options['concurrency'],
+        'users': options['users'],
+        'modes': {},
+    }
+    for mode, make_bots in (('shared', _shared_bots), ('split', _split_bots)):
+        stdout.write(f'Прогон {mode}...')
+        result['modes'][mode] = asyncio.run(_run_mode(make_bots, options))
+
+    for mode, data in result['modes'].items():
+        line = (
+            f"{mode}: рассылка {data['broadcast_per_second']:.0f} сообщений/с "
+            f"({data['broadcast_seconds']:.2f} с), соединений открыто {data['connections']}"
+        )
+        if data['reply_p50_ms'] is not None:
+            line += f", ответы p50 {data['reply_p50_ms']:.1f} мс, p99 {data['reply_p99_ms']:.1f} мс"
+        line += f", ошибок: рассылка {data['errors']['broadcast']}, ответы {data['errors']['replies']}"
+        stdout.write(line)
+    shared, split = result['modes']['shared'], result['modes']['split']
+    result['speedup'] = split['broadcast_per_second'] / shared['broadcast_per_second']
+    stdout.write(f"Ускорение рассылки: {result['speedup']:.2f}x")
+    return result
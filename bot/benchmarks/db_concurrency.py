@@ -0,0 +1,212 @@
+"""
+Бенчмарк одновременной работы админки и бота с одной базой.
+
+Потоки-администраторы открывают список групп в админке (настоящий запрос
+через django.test.Client) и сохраняют группы, как форма изменения: чтение
+и запись в одной транзакции. Потоки-боты выполняют /my_groups, создают
+группы и обновляют пользователя, как middleware. Для каждого вида
+операций считаются пропускная способность, p50/p99 и ошибки
+"database is locked".
+
+На SQLite сравниваются два режима:
+- default - настройки SQLite по умолчанию (журнал DELETE, synchronous=FULL,
+  отложенные транзакции);
+- tuned - текущие SQLITE_PRAGMAS и transaction_mode из settings.
+На PostgreSQL выполняется один прогон с текущими настройками (пул соединений).
+
+Данные создаются в текущей БД у отдельных пользователей и удаляются после прогона.
+"""
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, close_old_connections, connection, connections, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from bot.benchmarks.handler_latency import percentile
+from bot.db import sqlite_pragma_values
+from bot.models import Group, TelegramUser
+from bot.queries import create_group_with_owner, get_my_groups
+
+
+HELP = 'Одновременная нагрузка админки и бота на БД (SQLite: по умолчанию/WAL)'
+TELEGRAM_ID_BASE = 8_800_000_000
+ADMIN_USERNAME = 'db-concurrency-bench'
+DEFAULT_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+
+def add_arguments(parser):
+    parser.add_argument('--admins', type=int, default=4, help='Одновременных администраторов')
+    parser.add_argument('--bots', type=int, default=8, help='Одновременных потоков бота')
+    parser.add_argument('--duration', type=float, default=10.0, help='Длительность каждого прогона, секунд')
+    parser.add_argument('--groups', type=int, default=200, help='Групп в исходных данных')
+
+
+def create_dataset(bots, groups):
+    users = TelegramUser.objects.bulk_create([
+        TelegramUser(telegram_id=TELEGRAM_ID_BASE + i, username=f'dbbench{i}', first_name=f'Bench {i}')
+        for i in range(bots)
+    ])
+    for i in range(groups):
+        create_group_with_owner(users[i % bots], name=f'DB Bench {i}', description='Бенчмарк')
+    admin = get_user_model().objects.create_superuser(ADMIN_USERNAME, password=None)
+    return users, admin
+
+
+def cleanup():
+    Group.objects.filter(owner__telegram_id__gte=TELEGRAM_ID_BASE, owner__telegram_id__lt=TELEGRAM_ID_BASE + 1_000_000).delete()
+    TelegramUser.objects.filter(telegram_id__gte=TELEGRAM_ID_BASE, telegram_id__lt=TELEGRAM_ID_BASE + 1_000_000).delete()
+    get_user_model().objects.filter(username=ADMIN_USERNAME).delete()
+
+
+class _Recorder:
+    """Задержки и ошибки по видам операций (общий для всех потоков)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def measure(self, kind, operation):
+        started = time.perf_counter()
+        try:
+            operation()
+        except OperationalError:
+            # "database is locked": блокировку не дождались за busy_timeout
+            with self.lock:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            return
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(elapsed)
+
+    def summary(self, duration):
+        result = {}
+        for kind in sorted(set(self.latencies) | set(self.errors)):
+            values = self.latencies.get(kind, [])
+            result[kind] = {
+                'operations': len(values),
+                'per_second': len(values) / duration,
+                'p50_ms': percentile(values, 50) * 1000 if values else None,
+                'p99_ms': percentile(values, 99) * 1000 if values else None,
+                'errors': self.errors.get(kind, 0),
+            }
+        return result
+
+
+def _save_group(group_id, i):
+    # Как форма изменения в админке: чтение и UPDATE в одной транзакции
+    with transaction.atomic():
+        group = Group.objects.get(pk=group_id)
+        group.description = f'Изменено администратором {i}'
+        group.save()
+
+
+def _touch_user(user_id, i):
+    # Как middleware при смене username: чтение и UPDATE в одной транзакции
+    with transaction.atomic():
+        user = TelegramUser.objects.get(pk=user_id)
+        user.first_name = f'Bench {i}'
+        user.save(update_fields=['first_name'])
+
+
+def admin_worker(admin, group_ids, deadline, recorder):
+    client = Client()
+    client.force_login(admin)
+    changelist = reverse('admin:bot_group_changelist')
+    i = 0
+    try:
+        while time.monotonic() < deadline:
+            recorder.measure('admin_changelist', lambda: client.get(changelist, {'q': 'DB Bench'}))
+            group_id = group_ids[i % len(group_ids)]
+            recorder.measure('admin_save', lambda: _save_group(group_id, i))
+            i += 1
+    finally:
+        connection.close()
+
+
+def bot_worker(user, deadline, recorder):
+    i = 0
+    try:
+        while time.monotonic() < deadline:
+            recorder.measure('bot_my_groups', lambda: get_my_groups(user))
+            recorder.measure('bot_touch_user', lambda: _touch_user(user.pk, i))
+            if i % 5 == 0:
+                recorder.measure(
+                    'bot_create_group',
+                    lambda: create_group_with_owner(user, name=f'DB Bench {user.pk}-{i}', description='Бенчмарк')
+                )
+            i += 1
+    finally:
+        connection.close()
+
+
+def run_mode(options, users, admin):
+    """Один прогон: все потоки стартуют одновременно и работают duration секунд"""
+    # Новые соединения получат прагмы текущего режима
+    connections.close_all()
+    connection.ensure_connection()
+    pragmas = sqlite_pragma_values(connection) if connection.vendor == 'sqlite' else None
+    group_ids = list(Group.objects.filter(owner__in=users).values_list('id', flat=True))
+    recorder = _Recorder()
+    deadline = time.monotonic() + options['duration']
+    threads = [
+        threading.Thread(target=admin_worker, args=(admin, group_ids, deadline, recorder))
+        for _ in range(options['admins'])
+    ] + [
+        threading.Thread(target=bot_worker, args=(user, deadline, recorder))
+        for user in users
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    close_old_connections()
+    return {'pragmas': pragmas, 'seconds': elapsed, 'operations': recorder.summary(elapsed)}
+
+
+def run_default_sqlite(options, users, admin):
+    """Прогон с настройками SQLite по умолчанию"""
+    database = connections.settings[connection.alias]
+    options_backup = dict(database.get('OPTIONS', {}))
+    database['OPTIONS'] = {key: value for key, value in options_backup.items() if key != 'transaction_mode'}
+    try:
+        with override_settings(SQLITE_PRAGMAS=DEFAULT_PRAGMAS):
+            return run_mode(options, users, admin)
+    finally:
+        database['OPTIONS'] = options_backup
+
+
+def run(options, stdout):
+    cleanup()
+    result = {'vendor': connection.vendor, 'admins': options['admins'], 'bots': options['bots'], 'modes': {}}
+    # Админка проверяет Host; в бенчмарке запросы идут от тестового клиента
+    with override_settings(ALLOWED_HOSTS=['testserver']):
+        try:
+            users, admin = create_dataset(options['bots'], options['groups'])
+            if connection.vendor == 'sqlite':
+                stdout.write('Прогон default: настройки SQLite по умолчанию...')
+                result['modes']['default'] = run_default_sqlite(options, users, admin)
+                stdout.write('Прогон tuned: SQLITE_PRAGMAS из settings...')
+                result['modes']['tuned'] = run_mode(options, users, admin)
+            else:
+                stdout.write('Прогон current: текущие настройки БД...')
+                result['modes']['current'] = run_mode(options, users, admin)
+        finally:
+            # Вернуть соединения с прагмами из settings (журнал WAL хранится в файле БД)
+            connections.close_all()
+            cleanup()
+
+    stdout.write(f"Администраторов: {options['admins']}, потоков бота: {options['bots']}")
+    for mode, data in result['modes'].items():
+        stdout.write(f"{mode}: {data['pragmas'] or ''}")
+        for kind, stats in data['operations'].items():
+            line = f"  {kind}: {stats['per_second']:.1f}/с"
+            if stats['operations']:
+                line += f", p50 {stats['p50_ms']:.1f} мс, p99 {stats['p99_ms']:.1f} мс"
+            line += f", ошибок блокировки: {stats['errors']}"
+            stdout.write(line)
+    return result
@@ -0,0 +1,98 @@
+"""
+Бенчмарк пула потоков для запросов бота (bot/db.py).
+
+Несколько медленных запросов (рекурсивный подсчет на стороне БД) идут
+одновременно с потоком быстрых запросов от --users пользователей.
+Сравниваются:
+- single - один общий поток, как sync_to_async по умолчанию: быстрые
+  запросы ждут в очереди за медленными;
+- pool - DBExecutor с --threads потоками.
+Для каждого режима выводятся задержка быстрых запросов и статистика
+DBExecutor: ожидание в очереди и время выполнения.
+
+Данные в БД не создаются.
+"""
+import asyncio
+import statistics
+import time
+
+from django.db import connection
+
+from bot.benchmarks.handler_latency import percentile
+from bot.db import DEFAULT_THREADS, DBExecutor
+from bot.models import TelegramUser
+
+
+HELP = 'Задержка быстрых запросов при медленных: один поток ORM и пул потоков'
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=100, help='Одновременных пользователей с быстрыми запросами')
+    parser.add_argument('--rounds', type=int, default=10, help='Быстрых запросов на пользователя')
+    parser.add_argument('--slow', type=int, default=2, help='Одновременных медленных запросов')
+    parser.add_argument('--slow-rows', type=int, default=3_000_000, help='Строк в медленном запросе')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help='Потоков в режиме pool')
+
+
+def fast_query():
+    return TelegramUser.objects.filter(telegram_id=-1).exists()
+
+
+def slow_query(rows):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter WHERE x < %s) '
+            'SELECT count(*) FROM counter',
+            [rows]
+        )
+        return cursor.fetchone()[0]
+
+
+async def _simulate(executor, options):
+    latencies = []
+
+    async def user_session():
+        for _ in range(options['rounds']):
+            started = time.perf_counter()
+            await executor.run(fast_query)
+            latencies.append(time.perf_counter() - started)
+
+    slow = [asyncio.ensure_future(executor.run(slow_query, options['slow_rows'])) for _ in range(options['slow'])]
+    # Быстрые запросы приходят, когда медленные уже выполняются
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session() for _ in range(options['users'])))
+    fast_seconds = time.perf_counter() - started
+    await asyncio.gather(*slow)
+    return latencies, fast_seconds
+
+
+def run(options, stdout):
+    result = {'users': options['users'], 'rounds': options['rounds'], 'slow': options['slow'], 'modes': {}}
+    for mode, threads in (('single', 0), ('pool', options['threads'])):
+        executor = DBExecutor(threads=threads)
+        latencies, fast_seconds = asyncio.run(_simulate(executor, options))
+        stats = executor.stats()
+        result['modes'][mode] = {
+            'threads': threads,
+            'fast_seconds': fast_seconds,
+            'fast_p50_ms': statistics.median(latencies) * 1000,
+            'fast_p99_ms': percentile(latencies, 99) * 1000,
+            'executor': stats,
+        }
+        if executor._pool is not None:
+            executor._pool.shutdown()
+
+    for mode, data in result['modes'].items():
+        functions = data['executor']['functions']
+        stdout.write(
+            f"{mode} (потоков: {data['threads'] or 'один общий'}): быстрые запросы за {data['fast_seconds']:.2f} с, "
+            f"p50 {data['fast_p50_ms']:.1f} мс, p99 {data['fast_p99_ms']:.1f} мс"
+        )
+        for name in ('fast_query', 'slow_query'):
+            counters = functions[name]
+            stdout.write(
+                f"  {name}: {counters['calls']} вызовов, ожидание в очереди ср. {counters['wait_avg_ms']:.1f} мс "
+                f"(макс. {counters['wait_max_ms']:.1f}), выполнение ср. {counters['run_avg_ms']:.1f} мс"
+            )
+    return result
@@ -0,0 +1,95 @@
+"""
+Бенчмарк решателя розыгрыша с исключениями (bot.draw_engine.solve_assignment).
+
+Генерирует группу из N участников с исключениями двух видов: пары
+("пара не дарит друг другу", симметричные) и назначения прошлого года.
+Цель: решение меньше секунды для 10 000 участников и нескольких тысяч исключений.
+"""
+import random
+import statistics
+import time
+
+from bot.draw_engine import DrawInfeasible, derangement, solve_assignment
+
+
+HELP = 'Решатель розыгрыша с исключениями'
+TARGET_SECONDS = 1.0
+
+
+def add_arguments(parser):
+    parser.add_argument('--participants', type=int, default=10000, help='Количество участников')
+    parser.add_argument('--exclusions', type=int, default=3000, help='Количество исключений (направленных пар)')
+    parser.add_argument('--repeats', type=int, default=5, help='Количество повторов')
+    parser.add_argument('--seed', type=int, default=42, help='Seed генератора случайных чисел')
+
+
+def generate_exclusions(n, count, rng):
+    """Две трети исключений - пары (в обе стороны), треть - прошлогодние назначения"""
+    forbidden = {}
+
+    def add(giver, receiver):
+        forbidden.setdefault(giver, set()).add(receiver)
+
+    people = list(range(n))
+    rng.shuffle(people)
+    couples = min(count // 3, n // 2)
+    for i in range(couples):
+        first, second = people[2 * i], people[2 * i + 1]
+        add(first, second)
+        add(second, first)
+    previous = derangement(range(n), rng)
+    for giver in rng.sample(range(n), min(count - 2 * couples, n)):
+        add(giver, previous[giver])
+    return forbidden
+
+
+def _timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+
+def run(options, stdout):
+    n = options['participants']
+    rng = random.Random(options['seed'])
+    forbidden = generate_exclusions(n, options['exclusions'], rng)
+    exclusions = sum(len(receivers) for receivers in forbidden.values())
+
+    timings = []
+    for _ in range(options['repeats']):
+        elapsed, receivers = _timed(lambda: solve_assignment(n, forbidden, rng))
+        assert all(r != g and r not in forbidden.get(g, ()) for g, r in enumerate(receivers))
+        timings.append(elapsed)
+
+    # Неразрешимый случай: трем участникам разрешено дарить только двоим
+    impossible = {giver: set(range(n)) - {0, 1} for giver in (2, 3, 4)}
+    started = time.perf_counter()
+    try:
+        solve_assignment(n, impossible, rng)
+        infeasible_detected = False
+    except DrawInfeasible:
+        infeasible_detected = True
+    infeasible_seconds = time.perf_counter() - started
+
+    result = {
+        'participants': n,
+        'exclusions': exclusions,
+        'repeats': len(timings),
+        'min_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'max_seconds': max(timings),
+        'infeasible_detected': infeasible_detected,
+        'infeasible_seconds': infeasible_seconds,
+        'target_seconds': TARGET_SECONDS,
+        'within_target': max(timings) < TARGET_SECONDS,
+    }
+    stdout.write(
+        f"Участников: {n}, исключений: {exclusions}\n"
+        f"Решение: min {result['min_seconds'] * 1000:.1f} мс, "
+        f"медиана {result['median_seconds'] * 1000:.1f} мс, max {result['max_seconds'] * 1000:.1f} мс\n"
+        f"Неразрешимый случай обнаружен: {'да' if infeasible_detected else 'нет'} "
+        f"({infeasible_seconds * 1000:.1f} мс)\n"
+        f"Цель < {TARGET_SECONDS:.0f} с: {'выполнена' if result['within_target'] else 'НЕ выполнена'}"
+    )
+    return result
+
@@ -0,0 +1,177 @@
+"""
+Бенчмарк выдачи кодов групп при большом количестве существующих групп.
+
+В БД создается --existing групп (по умолчанию 10 млн) с кодами из того же
+алфавита, что и настоящие коды. Затем сравниваются:
+- legacy - прежний Group.generate_code(): SELECT exists() на каждую попытку + INSERT;
+- optimistic - bot.group_codes.create_group: INSERT с повтором при совпадении кода;
+- bulk - bot.group_codes.bulk_create_groups для массового импорта.
+Отдельно проверяется гонка двух /create_group с одинаковым кодом-кандидатом.
+
+Данные создаются в текущей БД у отдельного пользователя и удаляются после прогона.
+"""
+import string
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from bot import group_codes
+from bot.models import Group, TelegramUser
+
+
+HELP = 'Выдача кодов групп при 10 млн существующих групп'
+TELEGRAM_ID = 8_900_000_000
+ALPHABET = string.ascii_uppercase + string.digits + '-_'  # символы token_urlsafe().upper()
+CODE_SPACE = len(ALPHABET) ** 8
+STRIDE = 1_000_000_007  # взаимно просто с 38^8: i * STRIDE дает разные коды
+
+
+def add_arguments(parser):
+    parser.add_argument('--existing', type=int, default=10_000_000, help='Количество существующих групп')
+    parser.add_argument('--allocations', type=int, default=1000, help='Групп, создаваемых по одной')
+    parser.add_argument('--bulk', type=int, default=10000, help='Групп, создаваемых массовым импортом')
+
+
+def existing_code(i):
+    """Псевдослучайный уникальный код для i-й существующей группы"""
+    value = i * STRIDE % CODE_SPACE
+    chars = []
+    for _ in range(8):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return ''.join(chars)
+
+
+def seed(owner, count, stdout, batch_size=50000):
+    """Существующие группы вставляются сырым SQL: на порядок быстрее bulk_create"""
+    table = connection.ops.quote_name(Group._meta.db_table)
+    sql = (
+        f'INSERT INTO {table} (name, code, owner_id, description, gift_via_bot, status, is_closed, created_at) '
+        f'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+    )
+    now = timezone.now()
+    started = time.perf_counter()
+    for start in range(0, count, batch_size):
+        rows = [
+            ('Bench', existing_code(i), owner.id, 'Бенчмарк', False, 'closed', True, now)
+            for i in range(start, min(start + batch_size, count))
+        ]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        if start // batch_size % 20 == 19:
+            stdout.write(f'  создано групп: {start + len(rows)}/{count}')
+    return time.perf_counter() - started
+
+
+def cleanup():
+    owner = TelegramUser.objects.filter(telegram_id=TELEGRAM_ID).first()
+    if owner is None:
+        return
+    # Без каскада через ORM: у групп бенчмарка нет участников, а загружать 10 млн строк незачем
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(Group._meta.db_table)} WHERE owner_id = %s', [owner.id]
+        )
+    owner.delete()
+
+
+def legacy_generate_code():
+    """Прежняя реализация: запрос на каждую попытку, код не резервируется"""
+    while True:
+        code = Group.generate_code()
+        if not Group.objects.filter(code=code).exists():
+            return code
+
+
+def _timed(count, create):
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for _ in range(count):
+            create()
+        elapsed = time.perf_counter() - started
+    # Управление транзакциями (BEGIN, COMMIT, SAVEPOINT, RELEASE) не считаем
+    statements = [query for query in queries if not query['sql'].startswith(('BEGIN', 'COMMIT', 'SAVEPOINT', 'RELEASE'))]
+    return {
+        'groups': count,
+        'seconds': elapsed,
+        'ms_per_group': elapsed / count * 1000,
+        'queries_per_group': len(statements) / count,
+    }
+
+
+@contextmanager
+def _candidates(*codes):
+    """Подменяет генератор кодов: сначала codes, затем случайные"""
+    generate = Group.generate_code
+    scripted = iter(codes)
+    with mock.patch.object(Group, 'generate_code', staticmethod(lambda: next(scripted, None) or generate())):
+        yield
+
+
+def race(owner):
+    """
+    Два /create_group получают одинаковый кандидат. Прежний способ: оба
+    проверили код до вставки друг друга - второй INSERT падает. Новый способ:
+    второй повторяет вставку с другим кодом.
+    """
+    fields = {'name': 'Race', 'owner': owner, 'description': 'Бенчмарк'}
+    with _candidates('RACE0001', 'RACE0001'):
+        first_code, second_code = legacy_generate_code(), legacy_generate_code()
+        Group.objects.create(code=first_code, **fields)
+        try:
+            with transaction.atomic():
+                Group.objects.create(code=second_code, **fields)
+            legacy_failed = False
+        except IntegrityError:
+            legacy_failed = True
+    with _candidates('RACE0002', 'RACE0002'):
+        first = group_codes.create_group(**fields)
+        second = group_codes.create_group(**fields)
+    return {'legacy_integrity_error': legacy_failed, 'optimistic_codes_distinct': first.code != second.code}
+
+
+def run(options, stdout):
+    cleanup()
+    owner = TelegramUser.objects.create(telegram_id=TELEGRAM_ID, first_name='Bench')
+    fields = {'name': 'Bench', 'owner': owner, 'description': 'Бенчмарк'}
+    try:
+        stdout.write(f"Создание {options['existing']} существующих групп...")
+        seed_seconds = seed(owner, options['existing'], stdout)
+        result = {
+            'existing_groups': options['existing'],
+            'seed_seconds': seed_seconds,
+            'legacy': _timed(
+                options['allocations'],
+                lambda: Group.objects.create(code=legacy_generate_code(), **fields)
+            ),
+            'optimistic': _timed(options['allocations'], lambda: group_codes.create_group(**fields)),
+        }
+        started = time.perf_counter()
+        group_codes.bulk_create_groups([Group(**fields) for _ in range(options['bulk'])])
+        bulk_seconds = time.perf_counter() - started
+        result['bulk'] = {
+            'groups': options['bulk'],
+            'seconds': bulk_seconds,
+            'ms_per_group': bulk_seconds / options['bulk'] * 1000,
+        }
+        result['race'] = race(owner)
+    finally:
+        cleanup()
+
+    stdout.write(f"Существующих групп: {result['existing_groups']} (создано за {seed_seconds:.1f} с)")
+    for mode in ('legacy', 'optimistic', 'bulk'):
+        data = result[mode]
+        line = f"{mode}: {data['groups']} групп, {data['ms_per_group']:.3f} мс на группу"
+        if 'queries_per_group' in data:
+            line += f", запросов на группу: {data['queries_per_group']:.2f}"
+        stdout.write(line)
+    stdout.write(
+        f"Гонка с одинаковым кодом: прежний способ - "
+        f"{'IntegrityError' if result['race']['legacy_integrity_error'] else 'без ошибки'}, "
+        f"новый - {'разные коды' if result['race']['optimistic_codes_distinct'] else 'ОДИНАКОВЫЕ коды'}"
+    )
+    return result
@@ -0,0 +1,234 @@
+"""
+Бенчмарк задержки обработчиков под конкурентной нагрузкой.
+
+N пользователей одновременно выполняют сценарий: /my_groups, вступление в
+группу по коду, /set_name. Сравниваются два варианта доступа к БД:
+- before - как было раньше: отдельный sync_to_async на каждый запрос ORM
+  (в том числе N+1 запросов в /my_groups и поиск пользователя в каждом обработчике);
+- after - текущие обработчики: пользователь из кэша middleware, асинхронный
+  API ORM и укрупненные синхронные блоки из bot/queries.py.
+
+Данные создаются в текущей БД с отдельными telegram_id и кодами групп и
+удаляются после прогона.
+"""
+import asyncio
+import statistics
+import time
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+
+from bot import bot_handler
+from bot.middleware import resolve_telegram_user, user_cache
+from bot.models import Draw, Group, Participant, TelegramUser
+
+
+HELP = 'Задержка обработчиков при конкурентных пользователях (до/после async ORM)'
+TELEGRAM_ID_BASE = 8_000_000_000
+SCENARIOS = ['my_groups', 'join_group', 'set_name']
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=200, help='Количество одновременных пользователей')
+    parser.add_argument('--groups', type=int, default=5, help='Чужих групп у каждого пользователя')
+    parser.add_argument('--rounds', type=int, default=3, help='Повторов сценария на пользователя')
+
+
+class _Message:
+    def __init__(self, text=''):
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        pass
+
+
+def _update(telegram_user, text=''):
+    effective_user = SimpleNamespace(
+        id=telegram_user.telegram_id,
+        username=telegram_user.username,
+        first_name=telegram_user.first_name
+    )
+    return SimpleNamespace(effective_user=effective_user, message=_Message(text))
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) методом ближайшего ранга"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def create_dataset(mode, users, groups, rounds):
+    """
+    Пользователи, по группе на каждого (половина после розыгрыша), участие
+    каждого в groups чужих группах и rounds групп для вступления.
+    """
+    base = TELEGRAM_ID_BASE + (0 if mode == 'before' else users)
+    telegram_users = TelegramUser.objects.bulk_create([
+        TelegramUser(telegram_id=base + i, username=f'bench{base + i}', first_name=f'Bench {i}')
+        for i in range(users)
+    ])
+    owned = Group.objects.bulk_create([
+        Group(
+            name=f'Bench {i}',
+            code=f'B{mode[0].upper()}{i:07d}',
+            owner=telegram_user,
+            description='Бенчмарк',
+            status='drawn' if i % 2 else 'active',
+            gift_via_bot=True
+        )
+        for i, telegram_user in enumerate(telegram_users)
+    ])
+    participants = Participant.objects.bulk_create([
+        Participant(group=group, user=telegram_users[(i + k) % users], name=f'Bench {(i + k) % users}')
+        for i, group in enumerate(owned)
+        for k in range(min(groups, users - 1) + 1)
+    ])
+    members = {}
+    for participant in participants:
+        members.setdefault(participant.group_id, []).append(participant)
+    Draw.objects.bulk_create([
+        Draw(group=group, giver=giver, receiver=group_members[(j + 1) % len(group_members)])
+        for group in owned if group.status == 'drawn'
+        for group_members in [members[group.id]]
+        for j, giver in enumerate(group_members)
+    ])
+    join_groups = Group.objects.bulk_create([
+        Group(name=f'Join {r}', code=f'J{mode[0].upper()}{r:07d}', owner=telegram_users[0], description='Бенчмарк')
+        for r in range(rounds)
+    ])
+    return telegram_users, [group.code for group in join_groups]
+
+
+def delete_dataset(users):
+    TelegramUser.objects.filter(
+        telegram_id__gte=TELEGRAM_ID_BASE,
+        telegram_id__lt=TELEGRAM_ID_BASE + 2 * users
+    ).delete()
+
+
+# Вариант "до": каждый запрос ORM - отдельный переход в поток
+
+async def _legacy_get_user(update):
+    return await sync_to_async(TelegramUser.objects.get)(telegram_id=update.effective_user.id)
+
+
+async def legacy_my_groups(update, context):
+    telegram_user = await _legacy_get_user(update)
+    owned_groups = await sync_to_async(list)(Group.objects.filter(owner=telegram_user))
+    participations = await sync_to_async(list)(
+        Participant.objects.filter(user=telegram_user).select_related('group', 'group__owner')
+    )
+    for group in owned_groups:
+        await sync_to_async(group.participants.count)()
+    for participation in participations:
+        group = participation.group
+        if group.owner_id == telegram_user.id:
+            continue
+        participation = await sync_to_async(Participant.objects.get)(group=group, user=telegram_user)
+        if group.status == 'drawn':
+            try:
+                await sync_to_async(Draw.objects.select_related('receiver').get)(group=group, giver=participation)
+            except Draw.DoesNotExist:
+                pass
+
+
+async def legacy_join_group(update, context):
+    telegram_user = await _legacy_get_user(update)
+    group = await sync_to_async(Group.objects.get)(code=update.message.text)
+    if not await sync_to_async(group.can_add_participants)():
+        return
+    if await sync_to_async(Participant.objects.filter(group=group, user=telegram_user).exists)():
+        return
+    await sync_to_async(Participant.objects.create)(group=group, user=telegram_user, name=telegram_user.first_name)
+
+
+async def legacy_set_name(update, context):
+    telegram_user = await _legacy_get_user(update)
+    await sync_to_async(list)(
+        Participant.objects.filter(user=telegram_user, group__status='active').select_related('group')
+    )
+
+
+# Вариант "после": текущие обработчики с middleware
+
+def _with_middleware(handler):
+    async def wrapped(update, context):
+        await resolve_telegram_user(update, context)
+        await handler(update, context)
+    return wrapped
+
+
+HANDLERS = {
+    'before': {
+        'my_groups': legacy_my_groups,
+        'join_group': legacy_join_group,
+        'set_name': legacy_set_name,
+    },
+    'after': {
+        'my_groups': _with_middleware(bot_handler.my_groups),
+        'join_group': _with_middleware(bot_handler.join_group_code),
+        'set_name': _with_middleware(bot_handler.set_name_start),
+    },
+}
+
+
+async def _simulate(mode, telegram_users, join_codes):
+    handlers = HANDLERS[mode]
+    latencies = {scenario: [] for scenario in SCENARIOS}
+
+    async def user_session(telegram_user):
+        for code in join_codes:
+            for scenario in SCENARIOS:
+                update = _update(telegram_user, code if scenario == 'join_group' else '')
+                context = SimpleNamespace(user_data={}, bot=None)
+                started = time.perf_counter()
+                await handlers[scenario](update, context)
+                latencies[scenario].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(telegram_user) for telegram_user in telegram_users))
+    return latencies, time.perf_counter() - started
+
+
+def _summary(values):
+    return {
+        'p50_ms': statistics.median(values) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000,
+    }
+
+
+def run(options, stdout):
+    users = options['users']
+    delete_dataset(users)
+    user_cache.clear()
+    result = {'users': users, 'groups': options['groups'], 'rounds': options['rounds']}
+    try:
+        for mode in ('before', 'after'):
+            telegram_users, join_codes = create_dataset(mode, users, options['groups'], options['rounds'])
+            latencies, elapsed = asyncio.run(_simulate(mode, telegram_users, join_codes))
+            all_values = [value for values in latencies.values() for value in values]
+            result[mode] = {
+                'requests': len(all_values),
+                'seconds': elapsed,
+                'requests_per_second': len(all_values) / elapsed,
+                'overall': _summary(all_values),
+                'scenarios': {scenario: _summary(values) for scenario, values in latencies.items()},
+            }
+    finally:
+        delete_dataset(users)
+
+    stdout.write(f"Пользователей: {users}, чужих групп у каждого: {options['groups']}, повторов: {options['rounds']}")
+    for mode in ('before', 'after'):
+        data = result[mode]
+        stdout.write(
+            f"\n{mode}: {data['requests']} запросов за {data['seconds']:.2f} с "
+            f"({data['requests_per_second']:.0f} в секунду), "
+            f"p50 {data['overall']['p50_ms']:.1f} мс, p99 {data['overall']['p99_ms']:.1f} мс"
+        )
+        for scenario, summary in data['scenarios'].items():
+            stdout.write(f"  {scenario}: p50 {summary['p50_ms']:.1f} мс, p99 {summary['p99_ms']:.1f} мс")
+    result['p99_speedup'] = result['before']['overall']['p99_ms'] / result['after']['overall']['p99_ms']
+    stdout.write(f"\nУскорение p99: x{result['p99_speedup']:.1f}")
+    return result
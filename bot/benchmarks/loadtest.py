@@ -0,0 +1,352 @@
+"""
+Нагрузочный прогон бота целиком против фейкового Bot API.
+
+Бот собирается как в runbot (build_application: long polling, воркеры
+outbox, сохранение диалогов, HTTP-клиенты Bot API) и работает против
+FakeBotAPIServer на localhost: getUpdates отдает обновления сценария,
+отправки записываются, на долю отправок можно отвечать 429.
+
+Сценарий - сезон Тайного Санты для --users пользователей в группах по
+--group-size человек, по фазам:
+- start - все пользователи запускают бота;
+- create - владельцы создают группы (диалог /create_group);
+- join - остальные вступают по коду группы;
+- draw - владельцы проводят розыгрыш, outbox рассылает результаты;
+- send_gift - все участники отправляют подарки (доля --photo-share - фото);
+- distribute - владельцы раздают подарки, outbox доставляет их.
+В фазе все пользователи действуют одновременно, и каждый отправляет
+следующее сообщение, когда бот закончил обработку предыдущего.
+
+Задержка обновления - от его появления в getUpdates до конца обработки
+ботом (обработчики, ответы пользователю, запросы к БД). Для фаз с
+рассылкой отдельно измеряется время, пока outbox не опустеет. Запросы к
+БД считаются по DBExecutor (bot/metrics.py), поэтому в них входят и
+воркеры outbox, и сохранение диалогов.
+
+Пользователи создаются с telegram_id от TELEGRAM_ID_BASE и удаляются
+после прогона вместе с группами и сообщениями outbox.
+"""
+import asyncio
+import functools
+import json
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from asgiref.sync import sync_to_async
+from telegram.ext import BaseUpdateProcessor
+
+from bot import db, metrics, outbox
+from bot.application import build_application, start_application, stop_application
+from bot.benchmarks.handler_latency import percentile
+from bot.fake_bot_api import BOT_TOKEN, SEND_METHODS, FakeBotAPI, FakeBotAPIServer, make_photo_update, make_text_update
+from bot.middleware import user_cache
+from bot.models import ConversationState, Group, OutboxMessage, TelegramUser, UserState
+
+
+HELP = 'Нагрузочный прогон: сезон Тайного Санты через getUpdates фейкового Bot API'
+TELEGRAM_ID_BASE = 7_000_000_000
+PHASES = ['start', 'create', 'join', 'draw', 'send_gift', 'distribute']
+OUTBOX_PHASES = {'draw', 'distribute'}
+POLL_TIMEOUT = 1        # секунд long polling: остановка бота не ждет дольше
+OUTBOX_CHECK_INTERVAL = 0.05
+DELETE_BATCH_SIZE = 500
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000, help='Пользователей')
+    parser.add_argument('--group-size', type=int, default=10, help='Участников в группе, включая владельца')
+    parser.add_argument('--photo-share', type=float, default=0.2, help='Доля подарков с фото')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Задержка ответа Bot API, мс')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='Доля отправок с ответом 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, секунд')
+    parser.add_argument('--concurrent-updates', type=int, default=1,
+                        help='Обновлений, обрабатываемых одновременно (в runbot - 1)')
+    parser.add_argument('--outbox-workers', type=int, default=outbox.DEFAULT_WORKERS, help='Воркеров outbox')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Сколько ждать обработки одного обновления, секунд')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно случайных чисел (фото, 429)')
+
+
+class UpdateTracker(BaseUpdateProcessor):
+    """Обработчик очереди обновлений, который отмечает время окончания обработки каждого обновления"""
+
+    def __init__(self, max_concurrent_updates=1):
+        super().__init__(max_concurrent_updates)
+        self._waiters = {}  # update_id -> Future со временем окончания обработки
+
+    def expect(self, update_id):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[update_id] = waiter
+        return waiter
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            waiter = self._waiters.pop(getattr(update, 'update_id', None), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def summary(values):
+    """Перцентили задержки, мс"""
+    if not values:
+        return None
+    return {
+        'p50_ms': statistics.median(values) * 1000,
+        'p90_ms': percentile(values, 90) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000,
+    }
+
+
+def delete_dataset(users):
+    last = TELEGRAM_ID_BASE + users
+    OutboxMessage.objects.filter(chat_id__gte=TELEGRAM_ID_BASE, chat_id__lt=last).delete()
+    UserState.objects.filter(telegram_id__gte=TELEGRAM_ID_BASE, telegram_id__lt=last).delete()
+    # Незавершенные диалоги прерванного прогона: ключ - JSON [chat_id, user_id]
+    for start in range(TELEGRAM_ID_BASE, last, DELETE_BATCH_SIZE):
+        keys = [json.dumps([user_id, user_id]) for user_id in range(start, min(start + DELETE_BATCH_SIZE, last))]
+        ConversationState.objects.filter(key__in=keys).delete()
+    TelegramUser.objects.filter(telegram_id__gte=TELEGRAM_ID_BASE, telegram_id__lt=last).delete()
+
+
+def _text(user_id, text):
+    """Отложенное создание текстового обновления (см. LoadTest._step)"""
+    return functools.partial(make_text_update, user_id, text)
+
+
+class LoadTest:
+    """Сценарий нагрузочного прогона: пользователи по фазам отправляют обновления боту"""
+
+    def __init__(self, server, tracker, users, group_size=10, photo_share=0.2, timeout=60.0, seed=1):
+        self.server = server
+        self.tracker = tracker
+        self.timeout = timeout
+        self.photo_share = photo_share
+        self._random = random.Random(seed)
+        # Пользователи по группам; владелец - первый в группе
+        groups = max(1, users // group_size)
+        self.user_ids = [TELEGRAM_ID_BASE + i for i in range(users)]
+        self.groups = {self.user_ids[g]: self.user_ids[g + groups::groups] for g in range(groups)}
+        self.failed = set()  # пользователи, чье обновление не обработано за timeout
+        self.latencies = {phase: [] for phase in PHASES}
+
+    async def _step(self, phase, make_update):
+        # update_id выдается при отправке: Telegram нумерует обновления по порядку поступления,
+        # и getUpdates с offset пропустил бы обновление с меньшим номером, пришедшее позже
+        update = make_update()
+        waiter = self.tracker.expect(update['update_id'])
+        started = time.perf_counter()
+        self.server.push_updates([update])
+        finished = await asyncio.wait_for(waiter, self.timeout)
+        self.latencies[phase].append(finished - started)
+
+    async def _session(self, phase, user_id, updates):
+        for make_update in updates:
+            try:
+                await self._step(phase, make_update)
+            except asyncio.TimeoutError:
+                self.failed.add(user_id)
+                return
+
+    async def _phase(self, phase, sessions):
+        """Все пользователи фазы одновременно; для фаз с рассылкой - ожидание пустого outbox"""
+        sessions = {user_id: updates for user_id, updates in sessions.items() if user_id not in self.failed}
+        failed = len(self.failed)
+        queries = metrics.db_queries.value()
+        started = time.perf_counter()
+        await asyncio.gather(*(self._session(phase, user_id, updates) for user_id, updates in sessions.items()))
+        seconds = time.perf_counter() - started
+        result = {
+            'users': len(sessions),
+            'updates': len(self.latencies[phase]),
+            'seconds': seconds,
+            'updates_per_second': len(self.latencies[phase]) / seconds if seconds else None,
+            'latency': summary(self.latencies[phase]),
+            'timeouts': len(self.failed) - failed,
+        }
+        if phase in OUTBOX_PHASES:
+            result['outbox_seconds'] = await self._drain_outbox()
+        result['db_queries'] = metrics.db_queries.value() - queries
+        return result
+
+    async def _drain_outbox(self):
+        started = time.perf_counter()
+        while await sync_to_async(self._outbox_pending)():
+            if time.perf_counter() - started > self.timeout:
+                break
+            await asyncio.sleep(OUTBOX_CHECK_INTERVAL)
+        return time.perf_counter() - started
+
+    def _outbox_pending(self):
+        return OutboxMessage.objects.filter(
+            chat_id__gte=self.user_ids[0], chat_id__lte=self.user_ids[-1], status='pending'
+        ).exists()
+
+    def _group_codes(self):
+        return dict(Group.objects.filter(owner__telegram_id__in=list(self.groups)).values_list('owner__telegram_id', 'code'))
+
+    def _gift(self, user_id):
+        if self._random.random() < self.photo_share:
+            return functools.partial(make_photo_update, user_id, f'loadtest-photo-{user_id}', caption='🎁 Подарок')
+        return _text(user_id, f'🎁 Подарок от {user_id}')
+
+    async def run(self):
+        draw_date = date.today() + timedelta(days=30)
+        dates = [draw_date.strftime('%d.%m.%Y'), (draw_date + timedelta(days=1)).strftime('%d.%m.%Y')]
+        phases = {}
+
+        phases['start'] = await self._phase('start', {
+            user_id: [_text(user_id, '/start')] for user_id in self.user_ids
+        })
+        phases['create'] = await self._phase('create', {
+            owner: [
+                _text(owner, text)
+                for text in ['/create_group', f'Нагрузка {owner}', 'До 1000 рублей', 'да', *dates, 'пропустить']
+            ]
+            for owner in self.groups
+        })
+        codes = await sync_to_async(self._group_codes)()
+        phases['join'] = await self._phase('join', {
+            member: [_text(member, '/join_group'), _text(member, codes[owner])]
+            for owner, members in self.groups.items() if owner in codes
+            for member in members
+        })
+        phases['draw'] = await self._phase('draw', {
+            owner: [_text(owner, '/draw')] for owner in codes
+        })
+        phases['send_gift'] = await self._phase('send_gift', {
+            user_id: [_text(user_id, '/send_gift'), self._gift(user_id)]
+            for owner, members in self.groups.items() if owner in codes
+            for user_id in (owner, *members)
+        })
+        phases['distribute'] = await self._phase('distribute', {
+            owner: [_text(owner, '/distribute_gifts')] for owner in codes
+        })
+
+        latencies = [value for values in self.latencies.values() for value in values]
+        seconds = sum(phase['seconds'] for phase in phases.values())
+        return {
+            'groups': len(codes),
+            'updates': len(latencies),
+            'seconds': seconds,
+            'updates_per_second': len(latencies) / seconds,
+            'latency': summary(latencies),
+            'timeouts': len(self.failed),
+            'phases': phases,
+        }
+
+
+async def run_loadtest(
+    users,
+    group_size=10,
+    photo_share=0.2,
+    latency=0.0,
+    flood_rate=0.0,
+    retry_after=1,
+    concurrent_updates=1,
+    outbox_workers=outbox.DEFAULT_WORKERS,
+    timeout=60.0,
+    seed=1,
+):
+    """Запускает бота против FakeBotAPIServer, проигрывает сценарий и возвращает результаты"""
+    api = FakeBotAPI(flood_rate=flood_rate, retry_after=retry_after, seed=seed)
+    counters = {
+        'db_queries': metrics.db_queries.value(),
+        'db_calls': db.db_executor.calls,
+        'handler_errors': metrics.handler_errors.total(),
+        'broadcast_sent': metrics.broadcast_messages.value('sent'),
+        'broadcast_failed': metrics.broadcast_messages.value('failed'),
+    }
+    with FakeBotAPIServer(api, latency=latency) as server:
+        tracker = UpdateTracker(concurrent_updates)
+        application = build_application(
+            BOT_TOKEN,
+            outbox_workers=outbox_workers,
+            base_url=server.base_url,
+            scheduler=False,
+            concurrent_updates=tracker,
+        )
+        await start_application(application)
+        await application.updater.start_polling(poll_interval=0, timeout=POLL_TIMEOUT)
+        try:
+            result = await LoadTest(server, tracker, users, group_size, photo_share, timeout, seed).run()
+        finally:
+            await application.updater.stop()
+            await stop_application(application)
+
+    result['db'] = {
+        'queries': metrics.db_queries.value() - counters['db_queries'],
+        'calls': db.db_executor.calls - counters['db_calls'],
+    }
+    result['db']['queries_per_update'] = result['db']['queries'] / result['updates'] if result['updates'] else None
+    result['handler_errors'] = metrics.handler_errors.total() - counters['handler_errors']
+    result['bot_api'] = {
+        'requests': server.requests,
+        'connections': server.connections,
+        'sent': sum(api_method in SEND_METHODS for api_method, _ in api.calls),
+        'flooded': api.flooded,
+        'broadcast_sent': metrics.broadcast_messages.value('sent') - counters['broadcast_sent'],
+        'broadcast_failed': metrics.broadcast_messages.value('failed') - counters['broadcast_failed'],
+    }
+    return result
+
+
+def run(options, stdout):
+    users = options['users']
+    delete_dataset(users)
+    user_cache.clear()
+    try:
+        result = asyncio.run(run_loadtest(
+            users,
+            group_size=options['group_size'],
+            photo_share=options['photo_share'],
+            latency=options['latency_ms'] / 1000,
+            flood_rate=options['flood_rate'],
+            retry_after=options['retry_after'],
+            concurrent_updates=options['concurrent_updates'],
+            outbox_workers=options['outbox_workers'],
+            timeout=options['timeout'],
+            seed=options['seed'],
+        ))
+    finally:
+        delete_dataset(users)
+        user_cache.clear()
+    result['options'] = {
+        name: options[name] for name in
+        ('users', 'group_size', 'photo_share', 'latency_ms', 'flood_rate', 'concurrent_updates', 'outbox_workers')
+    }
+
+    stdout.write(f"Пользователей: {users}, групп: {result['groups']}, обновлений: {result['updates']}")
+    for phase, data in result['phases'].items():
+        line = f"  {phase}: {data['updates']} обновлений за {data['seconds']:.2f} с"
+        if data['latency']:
+            line += (
+                f" ({data['updates_per_second']:.0f}/с), p50 {data['latency']['p50_ms']:.1f} мс, "
+                f"p99 {data['latency']['p99_ms']:.1f} мс"
+            )
+        line += f", запросов к БД {data['db_queries']}"
+        if 'outbox_seconds' in data:
+            line += f", рассылка {data['outbox_seconds']:.2f} с"
+        if data['timeouts']:
+            line += f", не обработано за {options['timeout']:.0f} с: {data['timeouts']}"
+        stdout.write(line)
+    stdout.write(
+        f"Итого: {result['updates_per_second']:.0f} обновлений/с, "
+        f"p50 {result['latency']['p50_ms']:.1f} мс, p99 {result['latency']['p99_ms']:.1f} мс, "
+        f"запросов к БД {result['db']['queries']} ({result['db']['queries_per_update']:.1f} на обновление), "
+        f"ошибок обработчиков {result['handler_errors']}"
+    )
+    stdout.write(
+        f"Bot API: отправлено {result['bot_api']['sent']}, ответов 429 {result['bot_api']['flooded']}, "
+        f"рассылка: доставлено {result['bot_api']['broadcast_sent']}, не доставлено {result['bot_api']['broadcast_failed']}"
+    )
+    return result
@@ -0,0 +1,289 @@
+"""
+Набор микробенчмарков: розыгрыш, коды групп, тексты сообщений и запросы
+к БД обработчиков.
+
+Каждый случай (CASES) измеряется как в timeit: warmup прогонов без
+замера, подбор числа вызовов в повторе (не меньше --min-time секунд на
+повтор) и --repeats повторов с выключенным сборщиком мусора. Результат
+случая - время одного вызова по повторам: min, медиана, среднее,
+стандартное отклонение. Для случаев с БД отдельно считается число
+запросов на вызов.
+
+Случаи orm.* повторяют запросы обработчиков (queries.py, services.py,
+middleware). Данные создаются в транзакции, которая откатывается после
+прогона, поэтому в БД ничего не остается. Журнал запросов DEBUG на время
+замеров выключается. Изменяющие вызовы (создание
+группы, вступление, розыгрыш, раздача) выполняются в точке сохранения,
+которая откатывается после каждого вызова, и время отката входит в замер.
+
+Сравнение с базовой линией: --save-baseline сохраняет результат в JSON,
+--baseline сравнивает медианы с сохраненными. Случай медленнее базовой
+линии больше чем на --threshold или с большим числом запросов к БД -
+регрессия; с --fail-on-regression команда тогда завершается с ошибкой.
+"""
+import fnmatch
+import json
+import random
+import statistics
+import timeit
+from pathlib import Path
+
+from django.core.management.base import CommandError
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from bot import queries, services
+from bot.benchmarks.draw_solver import generate_exclusions
+from bot.bot_handler import build_my_groups_message, generate_invite_message
+from bot.draw_engine import derangement, solve_assignment
+from bot.middleware import upsert_telegram_user
+from bot.models import Draw, Group, Participant, TelegramUser
+
+
+HELP = 'Микробенчмарки: розыгрыш, коды групп, тексты сообщений, запросы обработчиков'
+TELEGRAM_ID_BASE = 8_800_000_000
+STATUSES = ['active', 'drawn', 'distribution', 'closed']
+MAX_LOOPS = 1_000_000
+
+
+def add_arguments(parser):
+    parser.add_argument('cases', nargs='*', help='Случаи (шаблоны имен, например orm.* или draw.*); по умолчанию все')
+    parser.add_argument('--repeats', type=int, default=20, help='Повторов замера')
+    parser.add_argument('--warmup', type=int, default=3, help='Вызовов без замера перед повторами')
+    parser.add_argument('--min-time', type=float, default=0.05, help='Наименьшая длительность повтора, секунд')
+    parser.add_argument('--participants', type=int, default=30, help='Участников в группе')
+    parser.add_argument('--groups', type=int, default=8, help='Групп пользователя: своих и чужих')
+    parser.add_argument('--seed', type=int, default=42, help='Seed генератора случайных чисел')
+    parser.add_argument('--baseline', help='JSON с базовой линией для сравнения')
+    parser.add_argument('--save-baseline', help='Сохранить результат как базовую линию')
+    parser.add_argument('--threshold', type=float, default=0.20, help='Допустимое замедление медианы (0.20 = 20%%)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Завершиться с ошибкой при регрессии')
+
+
+class Fixture:
+    """
+    Данные для случаев: пользователь владеет groups группами и участвует в
+    groups чужих группах по participants участников, статусы групп - по кругу
+    STATUSES; после розыгрыша у групп есть пары розыгрыша.
+    """
+
+    def __init__(self, participants, groups, seed):
+        self.participants = participants
+        self.rng = random.Random(seed)
+        self.forbidden = generate_exclusions(participants, participants // 3, self.rng)
+
+        users = TelegramUser.objects.bulk_create([
+            TelegramUser(telegram_id=TELEGRAM_ID_BASE + i, username=f'micro_{i}', first_name=f'Участник {i}')
+            for i in range(participants + 1)
+        ])
+        self.user, others = users[0], users[1:]
+        self.newcomer = TelegramUser.objects.create(telegram_id=TELEGRAM_ID_BASE + participants + 1, first_name='Новичок')
+
+        self.groups = []
+        for i in range(2 * groups):
+            owned = i % 2 == 0
+            status = STATUSES[i // 2 % len(STATUSES)]
+            group = Group.objects.create(
+                name=f'Микро {i}', code=f'MICRO{i:03d}', owner=self.user if owned else others[0],
+                description='Подарок до 1000 рублей', gift_via_bot=True, status=status,
+                is_closed=status == 'closed',
+            )
+            members = [self.user] + others[:participants - 1]
+            created = Participant.objects.bulk_create([
+                Participant(
+                    group=group, user=member, name=member.first_name,
+                    gift_message='Поздравляю с Новым годом!', gift_sent=status != 'active',
+                )
+                for member in members
+            ])
+            if status != 'active':
+                receivers = derangement(created, self.rng)
+                Draw.objects.bulk_create([
+                    Draw(group=group, giver=giver, receiver=receiver) for giver, receiver in zip(created, receivers)
+                ])
+            self.groups.append(group)
+        self.active = self.groups[0]
+        self.drawn = self.groups[2]
+        self.my_groups = queries.get_my_groups(self.user)
+
+
+def _rolled_back(func):
+    """Вызов в точке сохранения, которая откатывается: изменения не накапливаются"""
+    def call():
+        with transaction.atomic():
+            func()
+            transaction.set_rollback(True)
+    return call
+
+
+def _upsert(user):
+    return lambda: upsert_telegram_user(user.telegram_id, user.username, user.first_name)
+
+
+def _draw_handler(fixture):
+    group = queries.find_owned_group(fixture.user, ['active'])
+    queries.count_participants(group)
+    services.run_draw(group, fixture.rng)
+
+
+def _distribute_handler(fixture):
+    group = queries.find_owned_group(fixture.user, ['drawn'])
+    services.start_distribution(group)
+
+
+def _join_handler(fixture):
+    group = queries.get_group_by_code(fixture.active.code)
+    queries.join_group(group, fixture.newcomer)
+
+
+def _invite_handler(fixture):
+    queries.list_owned_groups(fixture.user, status='active')
+    queries.list_participations(fixture.user, group__status='active')
+
+
+# Имя -> (функция fixture -> вызываемый объект, запросы к БД)
+CASES = {
+    'draw.derangement': (lambda f: lambda: derangement(range(f.participants), f.rng), False),
+    'draw.solve_assignment': (lambda f: lambda: solve_assignment(f.participants, f.forbidden, f.rng), False),
+    'codes.generate_code': (lambda f: Group.generate_code, False),
+    'messages.invite': (lambda f: lambda: generate_invite_message(f.active), False),
+    'messages.my_groups': (lambda f: lambda: build_my_groups_message(*f.my_groups), False),
+    'orm.start': (lambda f: _upsert(f.user), True),
+    'orm.create_group': (lambda f: _rolled_back(lambda: queries.create_group_with_owner(
+        f.user, name='Новая группа', description='Подарок')), True),
+    'orm.join_group': (lambda f: _rolled_back(lambda: _join_handler(f)), True),
+    'orm.my_groups': (lambda f: lambda: queries.get_my_groups(f.user), True),
+    'orm.leave_group': (lambda f: lambda: queries.list_participations(f.user), True),
+    'orm.invite': (lambda f: lambda: _invite_handler(f), True),
+    'orm.draw': (lambda f: _rolled_back(lambda: _draw_handler(f)), True),
+    'orm.send_gift': (lambda f: lambda: queries.list_participations(f.user, group__status='drawn'), True),
+    'orm.distribute_gifts': (lambda f: _rolled_back(lambda: _distribute_handler(f)), True),
+    'orm.view_gifts': (lambda f: lambda: queries.list_received_gifts(f.user), True),
+    'orm.retry_delivery': (lambda f: lambda: queries.retry_owned_deliveries(f.user), True),
+}
+
+
+def select_cases(patterns):
+    if not patterns:
+        return list(CASES)
+    names = [name for name in CASES if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+    if not names:
+        raise CommandError(f"Нет случаев по шаблонам: {' '.join(patterns)}; доступны: {', '.join(CASES)}")
+    return names
+
+
+def measure(func, repeats=20, warmup=3, min_time=0.05):
+    """Время одного вызова func по repeats повторам, секунд; сборщик мусора выключен на время повтора"""
+    for _ in range(warmup):
+        func()
+    timer = timeit.Timer(func)
+    loops = 1
+    while loops < MAX_LOOPS:
+        if timer.timeit(loops) >= min_time:
+            break
+        loops *= 2
+    timings = [timer.timeit(loops) / loops for _ in range(repeats)]
+    return {
+        'loops': loops,
+        'repeats': repeats,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if repeats > 1 else 0.0,
+        'max': max(timings),
+    }
+
+
+def count_queries(func):
+    # Журнал запросов ограничен 9000 записями: заполненный журнал не растет, и захват был бы пуст
+    reset_queries()
+    with CaptureQueriesContext(connection) as captured:
+        func()
+    # Управление транзакциями (SAVEPOINT, RELEASE, ROLLBACK TO) не считаем
+    return sum(1 for query in captured if not query['sql'].startswith(('SAVEPOINT', 'RELEASE', 'ROLLBACK')))
+
+
+def compare(cases, baseline, threshold):
+    """Сравнение медиан и числа запросов с базовой линией: {случай: {...}}"""
+    comparison = {}
+    for name, data in cases.items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None:
+            comparison[name] = {'status': 'new'}
+            continue
+        ratio = data['median'] / base['median'] if base['median'] else float('inf')
+        more_queries = data.get('queries', 0) > base.get('queries', 0)
+        if ratio > 1 + threshold or more_queries:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'same'
+        comparison[name] = {
+            'status': status,
+            'ratio': ratio,
+            'baseline_median': base['median'],
+            'baseline_queries': base.get('queries'),
+        }
+    return comparison
+
+
+def _format(name, data, comparison):
+    line = (
+        f"{name:<24} {data['median'] * 1e6:>10.1f} мкс  ±{data['stdev'] / data['median'] * 100 if data['median'] else 0:4.1f}%"
+        f"  min {data['min'] * 1e6:.1f}  ({data['loops']} x {data['repeats']})"
+    )
+    if 'queries' in data:
+        line += f"  запросов {data['queries']}"
+    if comparison:
+        if comparison['status'] == 'new':
+            line += '  [новый]'
+        else:
+            marks = {'regression': 'РЕГРЕССИЯ', 'faster': 'быстрее', 'same': 'без изменений'}
+            line += f"  x{comparison['ratio']:.2f} {marks[comparison['status']]}"
+            if comparison['baseline_queries'] is not None and data.get('queries', 0) != comparison['baseline_queries']:
+                line += f" (запросов было {comparison['baseline_queries']})"
+    return line
+
+
+def run(options, stdout):
+    if options['groups'] < 2 or options['participants'] < 3:
+        raise CommandError('Нужно не меньше 2 групп и 3 участников')
+    names = select_cases(options['cases'])
+    baseline = json.loads(Path(options['baseline']).read_text()) if options['baseline'] else None
+
+    cases = {}
+    # С DEBUG = True (по умолчанию в settings) каждый запрос пишется в журнал, и время ORM завышено
+    with override_settings(DEBUG=False), transaction.atomic():
+        fixture = Fixture(options['participants'], options['groups'], options['seed'])
+        for name in names:
+            factory, uses_db = CASES[name]
+            func = factory(fixture)
+            data = measure(func, options['repeats'], options['warmup'], options['min_time'])
+            if uses_db:
+                data['queries'] = count_queries(func)
+            cases[name] = data
+        # Данные бенчмарка не сохраняются
+        transaction.set_rollback(True)
+
+    result = {
+        'participants': options['participants'],
+        'groups': options['groups'],
+        'vendor': connection.vendor,
+        'cases': cases,
+    }
+    comparison = compare(cases, baseline, options['threshold']) if baseline else {}
+    for name, data in cases.items():
+        stdout.write(_format(name, data, comparison.get(name)))
+
+    if options['save_baseline']:
+        Path(options['save_baseline']).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+        stdout.write(f"Базовая линия сохранена: {options['save_baseline']}")
+    if baseline:
+        regressions = [name for name, data in comparison.items() if data['status'] == 'regression']
+        result['comparison'] = comparison
+        result['regressions'] = regressions
+        stdout.write(f"Регрессий: {len(regressions)}" + (f" ({', '.join(regressions)})" if regressions else ''))
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"Регрессии относительно {options['baseline']}: {', '.join(regressions)}")
+    return result
@@ -1,9 +1,13 @@
-import random
-from asgiref.sync import sync_to_async
-from django.utils import timezone
 from telegram import Update
+from django.conf import settings
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters, ConversationHandler
-from .models import TelegramUser, Group, Participant, Draw
+from .db import db_async
+from .models import Group, Participant
+from .middleware import setup_middleware
+from . import outbox
+from . import queries
+from .profiling import profile_handlers
+from .services import DrawError, close_group, run_draw, start_distribution
 
 
 # Состояния для ConversationHandler
@@ -41,28 +45,16 @@ def get_all_commands_list():
         "🔹 Для владельцев:\n"
         "/draw - Провести розыгрыш\n"
         "/distribute_gifts - Распределить подарки\n"
+        "/retry_delivery - Повторить недоставленные сообщения\n"
         "/close_group - Принудительно закрыть группу"
     )
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
-    user = update.effective_user
-    
-    telegram_user, created = await sync_to_async(TelegramUser.objects.get_or_create)(
-        telegram_id=user.id,
-        defaults={
-            'username': user.username,
-            'first_name': user.first_name
-        }
-    )
-    
-    if not created:
-        # Обновляем данные пользователя
-        telegram_user.username = user.username
-        telegram_user.first_name = user.first_name
-        await sync_to_async(telegram_user.save)()
-    
+    # Пользователь уже создан или обновлен в resolve_telegram_user (bot/middleware.py).
+    # /start приходит и после разблокировки бота: рассылки снова включают пользователя
+    await queries.amark_reachable(context.telegram_user)
     welcome_text = (
         "🎄 Добро пожаловать в бота Тайный Санта! 🎄\n\n"
         "Этот бот поможет вам организовать игру Тайный Санта с друзьями!\n\n"
@@ -86,6 +78,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/draw - Провести розыгрыш (только для владельца группы)\n"
         "/send_gift - Отправить подарок боту (если включены подарки через бота)\n"
         "/distribute_gifts - Распределить подарки (только для владельца группы)\n"
+        "/retry_delivery - Повторно отправить недоставленные сообщения розыгрыша и подарки (только для владельца группы)\n"
         "/view_gifts - Просмотреть полученные подарки из групп, где уже прошла расдача\n"
         "/close_group - Принудительно закрыть группу (только для владельца группы)\n"
         "/delete_group - Удалить закрытую группу из списка\n"
@@ -110,21 +103,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def create_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало создания группы"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        telegram_user, _ = await sync_to_async(TelegramUser.objects.get_or_create)(
-            telegram_id=user.id,
-            defaults={
-                'username': user.username,
-                'first_name': user.first_name
-            }
-        )
+    telegram_user = context.telegram_user
     
     # Проверяем, есть ли у пользователя активная группа (не закрытая)
-    active_group = await sync_to_async(Group.objects.filter(owner=telegram_user, status__in=['active', 'drawn', 'distribution']).first)()
+    active_group = await queries.afind_owned_group(telegram_user, Group.OPEN_STATUSES)
     if active_group:
         status_display = dict(Group.STATUS_CHOICES).get(active_group.status, active_group.status)
         hints = get_command_hints("/my_groups", "/close_group", "/help")
@@ -235,18 +217,7 @@ async def create_group_close_date(update: Update, context: ContextTypes.DEFAULT_
     from datetime import datetime, timedelta
     
     date_str = update.message.text.strip().lower()
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        telegram_user, _ = await sync_to_async(TelegramUser.objects.get_or_create)(
-            telegram_id=user.id,
-            defaults={
-                'username': user.username,
-                'first_name': user.first_name
-            }
-        )
+    telegram_user = context.telegram_user
     
     close_date = None
     if date_str not in ['пропустить', 'skip', 'пропустить', '']:
@@ -260,11 +231,10 @@ async def create_group_close_date(update: Update, context: ContextTypes.DEFAULT_
             await update.message.reply_text("❌ Неверный формат даты. Используйте формат ДД.ММ.ГГГГ или отправьте 'пропустить':")
             return WAITING_FOR_CLOSE_DATE
     
-    # Создаем группу
-    group = await sync_to_async(Group.objects.create)(
+    # Создаем группу, владелец автоматически становится участником
+    group = await queries.acreate_group_with_owner(
+        telegram_user,
         name=context.user_data['group_name'],
-        code=await sync_to_async(Group.generate_code)(),
-        owner=telegram_user,
         description=context.user_data['description'],
         gift_via_bot=context.user_data['gift_via_bot'],
         draw_date=context.user_data['draw_date'],
@@ -273,14 +243,6 @@ async def create_group_close_date(update: Update, context: ContextTypes.DEFAULT_
         status='active'
     )
     
-    # Владелец автоматически становится участником
-    default_name = telegram_user.first_name or telegram_user.username or f"Участник {telegram_user.telegram_id}"
-    await sync_to_async(Participant.objects.create)(
-        group=group,
-        user=telegram_user,
-        name=default_name
-    )
-    
     gift_text = "✅ Да, подарки будут отправляться через бота" if context.user_data['gift_via_bot'] else "❌ Нет, подарки не через бота"
     
     hints = get_command_hints("/invite", "/set_name", "/my_groups", "/help")
@@ -328,47 +290,28 @@ async def join_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def join_group_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кода группы"""
     code = update.message.text.strip().upper()
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        # Создаем пользователя, если его нет
-        telegram_user, _ = await sync_to_async(TelegramUser.objects.get_or_create)(
-            telegram_id=user.id,
-            defaults={
-                'username': user.username,
-                'first_name': user.first_name
-            }
-        )
+    telegram_user = context.telegram_user
     
     try:
-        group = await sync_to_async(Group.objects.get)(code=code)
+        group = await queries.aget_group_by_code(code)
     except Group.DoesNotExist:
         hints = get_command_hints("/my_groups", "/create_group", "/help")
         await update.message.reply_text("❌ Группа с таким кодом не найдена. Проверьте код и попробуйте снова." + hints)
         return ConversationHandler.END
     
-    if not await sync_to_async(group.can_add_participants)():
-        status_display = await sync_to_async(lambda: group.get_status_display())()
+    if not group.can_add_participants():
+        status_display = group.get_status_display()
         hints = get_command_hints("/my_groups", "/create_group", "/help")
         await update.message.reply_text(f"❌ Эта группа уже не принимает участников. Статус: {status_display}" + hints)
         return ConversationHandler.END
     
-    # Проверяем, не является ли пользователь уже участником
-    is_participant = await sync_to_async(Participant.objects.filter(group=group, user=telegram_user).exists)()
-    if is_participant:
+    # Добавляем участника, если он еще не в группе
+    participation, created = await queries.ajoin_group(group, telegram_user)
+    if not created:
         hints = get_command_hints("/my_groups", "/set_name", "/help")
         await update.message.reply_text("❌ Вы уже являетесь участником этой группы." + hints)
         return ConversationHandler.END
-    
-    # Добавляем участника
-    default_name = telegram_user.first_name or telegram_user.username or f"Участник {telegram_user.telegram_id}"
-    await sync_to_async(Participant.objects.create)(
-        group=group,
-        user=telegram_user,
-        name=default_name
-    )
+    default_name = participation.name
     
     hints = get_command_hints("/set_name", "/my_groups", "/help")
     await update.message.reply_text(
@@ -389,16 +332,10 @@ async def join_group_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def leave_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выход из группы"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
+    telegram_user = context.telegram_user
     
     # Получаем все группы пользователя с предзагрузкой связанных объектов
-    participations = await sync_to_async(list)(Participant.objects.filter(user=telegram_user, group__is_closed=False).select_related('group', 'group__owner'))
+    participations = await queries.alist_participations(telegram_user, group__is_closed=False)
     
     if not participations:
         await update.message.reply_text("❌ Вы не состоите ни в одной активной группе.")
@@ -415,7 +352,7 @@ async def leave_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Вы не можете выйти из группы, которой владеете. Сначала проведите розыгрыш." + hints)
             return
         
-        await sync_to_async(participation.delete)()
+        await db_async(participation.delete)()
         hints = get_command_hints("/my_groups", "/join_group", "/help")
         await update.message.reply_text(f"✅ Вы вышли из группы '{group.name}'." + hints)
         return
@@ -430,30 +367,9 @@ async def leave_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⚠️ Для выхода из конкретной группы используйте код группы в формате: /leave_group КОД")
 
 
-async def my_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать группы пользователя"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
-    
-    # Группы, где пользователь владелец
-    owned_groups = await sync_to_async(list)(Group.objects.filter(owner=telegram_user))
-    
-    # Группы, где пользователь участник
-    participations = await sync_to_async(list)(Participant.objects.filter(user=telegram_user).select_related('group', 'group__owner'))
-    participant_groups = []
-    for p in participations:
-        if p.group.owner_id != telegram_user.id:
-            participant_groups.append(p.group)
-    
-    if not owned_groups and not participant_groups:
-        hints = get_command_hints("/create_group", "/join_group", "/invite", "/help")
-        await update.message.reply_text("❌ Вы не состоите ни в одной группе." + hints)
-        return
+def build_my_groups_message(owned_groups, participations):
+    """Формирует текст /my_groups по данным из queries.get_my_groups"""
+    participant_groups = [p.group for p in participations]
     
     message = "📋 Ваши группы:\n\n"
     
@@ -468,33 +384,25 @@ async def my_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += "👑 Группы, которыми вы владеете:\n"
         for group in owned_groups:
             status = status_map.get(group.status, group.status)
-            participants_count = await sync_to_async(group.participants.count)()
             message += f"• {group.name} ({group.code}) - {status}\n"
-            message += f"  Участников: {participants_count}\n"
+            message += f"  Участников: {group.participants_count}\n"
             if group.status == 'active':
                 message += f"  Используйте /draw для розыгрыша\n"
             elif group.status == 'drawn':
                 message += f"  Используйте /distribute_gifts для расдачи подарков\n"
         message += "\n"
     
-    if participant_groups:
+    if participations:
         message += "👥 Группы, в которых вы участвуете:\n"
-        for group in participant_groups:
+        for participation in participations:
+            group = participation.group
             status = status_map.get(group.status, group.status)
-            participation = await sync_to_async(Participant.objects.get)(group=group, user=telegram_user)
             message += f"• {group.name} ({group.code}) - {status}\n"
             message += f"  Ваше имя: {participation.name}\n"
             
             # Для групп со статусом "жеребьевка проведена" показываем получателя
-            if group.status == 'drawn':
-                try:
-                    draw = await sync_to_async(Draw.objects.select_related('receiver').get)(
-                        group=group,
-                        giver=participation
-                    )
-                    message += f"  🎁 Вы дарите подарок: {draw.receiver.name}\n"
-                except Draw.DoesNotExist:
-                    pass
+            if group.status == 'drawn' and participation.own_draws:
+                message += f"  🎁 Вы дарите подарок: {participation.own_draws[0].receiver.name}\n"
             
             # Информация о подарке через бота
             if group.status == 'drawn' and group.gift_via_bot:
@@ -517,26 +425,30 @@ async def my_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
         hints = get_command_hints("/invite", "/help")
         message += hints
     
-    await update.message.reply_text(message)
+    return message
+
+
+async def my_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать группы пользователя"""
+    telegram_user = context.telegram_user
+    
+    # Все данные для ответа одним переходом в поток и фиксированным числом запросов
+    owned_groups, participations = await queries.aget_my_groups(telegram_user)
+    
+    if not owned_groups and not participations:
+        hints = get_command_hints("/create_group", "/join_group", "/invite", "/help")
+        await update.message.reply_text("❌ Вы не состоите ни в одной группе." + hints)
+        return
+    
+    await update.message.reply_text(build_my_groups_message(owned_groups, participations))
 
 
 async def set_name_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало установки имени"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return ConversationHandler.END
+    telegram_user = context.telegram_user
     
     # Получаем только активные группы (до жеребьевки) пользователя
-    participations = await sync_to_async(list)(
-        Participant.objects.filter(
-            user=telegram_user,
-            group__status='active'
-        ).select_related('group')
-    )
+    participations = await queries.alist_participations(telegram_user, group__status='active')
     
     if not participations:
         hints = get_command_hints("/join_group", "/my_groups", "/help")
@@ -610,9 +522,9 @@ async def set_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     participation_id = context.user_data.get('participation_id')
     if participation_id:
-        participation = await sync_to_async(Participant.objects.select_related('group').get)(id=participation_id)
+        participation = await queries.aget_participation(participation_id)
         participation.name = name
-        await sync_to_async(participation.save)()
+        await db_async(participation.save)(update_fields=['name'])
         
         hints = get_command_hints("/my_groups", "/draw", "/help")
         await update.message.reply_text(
@@ -634,16 +546,10 @@ async def set_name_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проведение розыгрыша"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
+    telegram_user = context.telegram_user
     
     # Находим активную группу пользователя
-    group = await sync_to_async(Group.objects.filter(owner=telegram_user, status='active').first)()
+    group = await queries.afind_owned_group(telegram_user, ['active'])
     
     if not group:
         hints = get_command_hints("/create_group", "/my_groups", "/help")
@@ -652,9 +558,8 @@ async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    can_draw = await sync_to_async(group.can_draw)()
-    if not can_draw:
-        participants_count = await sync_to_async(group.participants.count)()
+    participants_count = await queries.acount_participants(group)
+    if participants_count < 2:
         hints = get_command_hints("/invite", "/my_groups", "/help")
         await update.message.reply_text(
             "❌ Для розыгрыша необходимо минимум 2 участника. "
@@ -662,75 +567,14 @@ async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Получаем всех участников
-    participants = await sync_to_async(list)(group.participants.select_related('user').all())
-    
-    # Проводим розыгрыш
-    # Перемешиваем список получателей
-    receivers = participants.copy()
-    random.shuffle(receivers)
-    
-    # Проверяем, чтобы никто не дарил сам себе
-    max_attempts = 100
-    attempt = 0
-    while attempt < max_attempts:
-        valid = True
-        for i, giver in enumerate(participants):
-            if giver == receivers[i]:
-                valid = False
-                break
-        
-        if valid:
-            break
-        
-        random.shuffle(receivers)
-        attempt += 1
-    
-    # Создаем записи о розыгрыше
-    draws_created = []
-    for giver, receiver in zip(participants, receivers):
-        draw_obj = await sync_to_async(Draw.objects.create)(
-            group=group,
-            giver=giver,
-            receiver=receiver
-        )
-        draws_created.append(draw_obj)
-    
-    # Загружаем связанные объекты для рассылки
-    draws_created = await sync_to_async(list)(Draw.objects.filter(group=group).select_related('giver__user', 'receiver'))
-    
-    # Устанавливаем статус "жеребьевка проведена"
-    group.status = 'drawn'
-    group.drawn_at = timezone.now()
-    await sync_to_async(group.save)()
-    
-    # Рассылаем результаты участникам
-    gift_via_bot_text = ""
-    if group.gift_via_bot:
-        gift_via_bot_text = "\n\n🎁 Вы можете отправить подарок боту командой /send_gift, и он сохранит его на виртуальной ёлочке до дня расдачи!"
-    
-    for draw_obj in draws_created:
-        try:
-            receiver_name = draw_obj.receiver.name
-            giver_telegram_id = draw_obj.giver.user.telegram_id
-            
-            message_text = (
-                f"🎄 Розыгрыш в группе '{group.name}' проведен!\n\n"
-                f"🎁 Вы дарите подарок: <b>{receiver_name}</b>\n\n"
-                f"📝 Описание подарка:\n{group.description}\n"
-            )
-            if group.gift_distribution_date:
-                message_text += f"📅 Дата расдачи: {group.gift_distribution_date.strftime('%d.%m.%Y')}\n"
-            message_text += f"{gift_via_bot_text}\n\nУдачи в выборе подарка! 🎅"
-            await context.bot.send_message(
-                chat_id=giver_telegram_id,
-                text=message_text,
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            # Логируем ошибку, но продолжаем рассылку
-            giver_telegram_id = draw_obj.giver.user.telegram_id if hasattr(draw_obj, 'giver') else 'unknown'
-            print(f"Ошибка отправки сообщения пользователю {giver_telegram_id}: {e}")
+    # Проводим розыгрыш: пары, статус группы и уведомления сохраняются одной транзакцией
+    try:
+        await db_async(run_draw)(group)
+    except DrawError as e:
+        hints = get_command_hints("/my_groups", "/help")
+        await update.message.reply_text(f"❌ {e}" + hints)
+        return
+    outbox.wake()
     
     distribution_date_text = ""
     if group.gift_distribution_date:
@@ -739,29 +583,21 @@ async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     hints = get_command_hints("/distribute_gifts", "/my_groups", "/send_gift", "/help")
     await update.message.reply_text(
         f"✅ Розыгрыш в группе '{group.name}' успешно проведен!\n\n"
-        f"📨 Все участники получили уведомления о своих получателях.{distribution_date_text}\n\n"
+        f"📨 Участникам отправляются уведомления о своих получателях.{distribution_date_text}\n\n"
         f"Статус группы изменен на 'Жеребьевка проведена'." + hints
     )
 
 
 async def send_gift_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало отправки подарка боту"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return ConversationHandler.END
+    telegram_user = context.telegram_user
     
     # Получаем группы, где пользователь участник и статус "жеребьевка проведена" или "расдача подарков" и gift_via_bot=True
     # Позволяем изменять подарок до момента расдачи
-    participations = await sync_to_async(list)(
-        Participant.objects.filter(
-            user=telegram_user,
-            group__status__in=['drawn', 'distribution'],
-            group__gift_via_bot=True
-        ).select_related('group')
+    participations = await queries.alist_participations(
+        telegram_user,
+        group__status__in=['drawn', 'distribution'],
+        group__gift_via_bot=True
     )
     
     if not participations:
@@ -847,7 +683,7 @@ async def send_gift_select_group(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data.pop('participations', None)  # Удаляем список, больше не нужен
     
     # Получаем participation для проверки подарка
-    participation = await sync_to_async(Participant.objects.select_related('group').get)(id=participation_id)
+    participation = await queries.aget_participation(participation_id)
     
     # Проверяем, есть ли уже подарок
     if participation.gift_sent:
@@ -884,7 +720,7 @@ async def send_gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.clear()
         return ConversationHandler.END
     
-    participation = await sync_to_async(Participant.objects.select_related('group').get)(id=participation_id)
+    participation = await queries.aget_participation(participation_id)
     
     # Проверяем, что пришло: фото, текст или фото с подписью
     photo = update.message.photo
@@ -927,7 +763,7 @@ async def send_gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_FOR_GIFT
     
     participation.gift_sent = True
-    await sync_to_async(participation.save)()
+    await db_async(participation.save)(update_fields=['gift_message', 'gift_photo_file_id', 'gift_sent'])
     
     distribution_date_text = participation.group.gift_distribution_date.strftime('%d.%m.%Y') if participation.group.gift_distribution_date else "в день расдачи"
     
@@ -976,29 +812,12 @@ async def get_invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
     
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
-    except Exception as e:
-        print(f"Ошибка при получении пользователя в get_invite: {e}")
-        await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
-        return
+    telegram_user = context.telegram_user
     
     try:
         # Получаем активные группы пользователя (где он владелец или участник)
-        owned_groups = await sync_to_async(list)(
-            Group.objects.filter(owner=telegram_user, status='active')
-        )
-        participations = await sync_to_async(list)(
-            Participant.objects.filter(
-                user=telegram_user,
-                group__status='active'
-            ).select_related('group', 'group__owner')
-        )
+        owned_groups = await queries.alist_owned_groups(telegram_user, status='active')
+        participations = await queries.alist_participations(telegram_user, group__status='active')
         # Используем owner_id вместо owner для избежания дополнительных запросов к БД
         participant_groups = [p.group for p in participations if p.group.owner_id != telegram_user.id]
         
@@ -1066,7 +885,6 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
     if not update.message:
         return
     
-    user = update.effective_user
     message_text = update.message.text or update.message.caption or ""
     
     # Ищем маркер приглашения в тексте сообщения
@@ -1085,47 +903,29 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
         return
     
     # Получаем или создаем пользователя
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        telegram_user, _ = await sync_to_async(TelegramUser.objects.get_or_create)(
-            telegram_id=user.id,
-            defaults={
-                'username': user.username,
-                'first_name': user.first_name
-            }
-        )
+    telegram_user = context.telegram_user
     
     # Находим группу по коду
     try:
-        group = await sync_to_async(Group.objects.get)(code=code)
+        group = await queries.aget_group_by_code(code)
     except Group.DoesNotExist:
         await update.message.reply_text("❌ Группа с таким кодом не найдена.")
         return
     
     # Проверяем, можно ли добавить участников
-    if not await sync_to_async(group.can_add_participants)():
-        status_display = await sync_to_async(lambda: group.get_status_display())()
+    if not group.can_add_participants():
+        status_display = group.get_status_display()
         await update.message.reply_text(
             f"❌ Группа '{group.name}' уже не принимает участников. Статус: {status_display}"
         )
         return
     
-    # Проверяем, не является ли пользователь уже участником
-    is_participant = await sync_to_async(
-        Participant.objects.filter(group=group, user=telegram_user).exists
-    )()
-    if is_participant:
+    # Добавляем участника, если он еще не в группе
+    participation, created = await queries.ajoin_group(group, telegram_user)
+    if not created:
         await update.message.reply_text(f"✅ Вы уже являетесь участником группы '{group.name}'.")
         return
-    
-    # Добавляем участника
-    default_name = telegram_user.first_name or telegram_user.username or f"Участник {telegram_user.telegram_id}"
-    await sync_to_async(Participant.objects.create)(
-        group=group,
-        user=telegram_user,
-        name=default_name
-    )
+    default_name = participation.name
     
     await update.message.reply_text(
         f"✅ Вы успешно присоединились к группе '{group.name}'!\n\n"
@@ -1139,23 +939,10 @@ async def view_gifts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Просмотр полученных подарков из групп, где уже расдали подарки"""
     user = update.effective_user
     
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
+    telegram_user = context.telegram_user
     
     # Находим все розыгрыши, где пользователь является получателем, и группа имеет статус 'distribution' или 'closed'
-    draws = await sync_to_async(list)(
-        Draw.objects.filter(
-            receiver__user=telegram_user,
-            group__status__in=['distribution', 'closed']
-        ).select_related(
-            'group',
-            'giver',
-            'giver__user'
-        ).order_by('-group__gift_distribution_date', '-group__created_at')
-    )
+    draws = await queries.alist_received_gifts(telegram_user)
     
     if not draws:
         hints = get_command_hints("/my_groups", "/distribute_gifts", "/help")
@@ -1246,21 +1033,10 @@ async def view_gifts(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def close_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало принудительного закрытия группы"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return ConversationHandler.END
+    telegram_user = context.telegram_user
     
     # Находим группу, которой владеет пользователь (не закрытую)
-    group = await sync_to_async(
-        Group.objects.filter(
-            owner=telegram_user,
-            status__in=['active', 'drawn', 'distribution']
-        ).first
-    )()
+    group = await queries.afind_owned_group(telegram_user, Group.OPEN_STATUSES)
     
     if not group:
         hints = get_command_hints("/my_groups", "/create_group", "/help")
@@ -1306,14 +1082,14 @@ async def close_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Получаем группу
     try:
-        group = await sync_to_async(Group.objects.select_related('owner').get)(id=group_id)
+        group = await queries.aget_group(group_id)
     except Group.DoesNotExist:
         await update.message.reply_text("❌ Группа не найдена.")
         context.user_data.clear()
         return ConversationHandler.END
     
     # Проверяем, что пользователь все еще владелец
-    if group.owner_id != update.effective_user.id:
+    if group.owner_id != context.telegram_user.id:
         await update.message.reply_text("❌ Вы не являетесь владельцем этой группы.")
         context.user_data.clear()
         return ConversationHandler.END
@@ -1335,32 +1111,14 @@ async def close_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"{message_text}"
         )
     
-    # Получаем всех участников группы
-    participants = await sync_to_async(list)(
-        Participant.objects.filter(group=group).select_related('user')
-    )
-    
-    # Отправляем сообщение всем участникам
-    notified_count = 0
-    for participant in participants:
-        try:
-            await context.bot.send_message(
-                chat_id=participant.user.telegram_id,
-                text=message_text
-            )
-            notified_count += 1
-        except Exception as e:
-            print(f"Ошибка отправки сообщения участнику {participant.user.telegram_id}: {e}")
-    
-    # Закрываем группу
-    group.status = 'closed'
-    group.is_closed = True
-    await sync_to_async(group.save)()
+    # Закрываем группу и ставим уведомления участникам в очередь
+    notified_count = await db_async(close_group)(group, message_text)
+    outbox.wake()
     
     hints = get_command_hints("/delete_group", "/create_group", "/my_groups", "/help")
     await update.message.reply_text(
         f"✅ Группа '{group.name}' успешно закрыта!\n\n"
-        f"📨 Уведомлено участников: {notified_count} из {len(participants)}" + hints
+        f"📨 Уведомления отправляются участникам: {notified_count}" + hints
     )
     
     context.user_data.clear()
@@ -1376,26 +1134,13 @@ async def close_group_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def delete_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало удаления закрытой группы"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return ConversationHandler.END
+    telegram_user = context.telegram_user
     
     # Находим все закрытые группы пользователя (где он владелец)
-    owned_closed_groups = await sync_to_async(list)(
-        Group.objects.filter(owner=telegram_user, status='closed').select_related('owner').order_by('-created_at')
-    )
+    owned_closed_groups = await queries.alist_owned_groups(telegram_user, status='closed')
     
     # Находим закрытые группы, где пользователь участник
-    participations = await sync_to_async(list)(
-        Participant.objects.filter(
-            user=telegram_user,
-            group__status='closed'
-        ).select_related('group', 'group__owner')
-    )
+    participations = await queries.alist_participations(telegram_user, group__status='closed')
     participant_closed_groups = [p.group for p in participations if p.group.owner_id != telegram_user.id]
     
     all_closed_groups = owned_closed_groups + participant_closed_groups
@@ -1413,7 +1158,7 @@ async def delete_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
             'id': g.id,
             'name': g.name,
             'code': g.code,
-            'is_owner': g.owner.telegram_id == telegram_user.telegram_id
+            'is_owner': g.owner_id == telegram_user.id
         }
         for g in all_closed_groups
     ]
@@ -1453,20 +1198,9 @@ async def delete_group_selection(update: Update, context: ContextTypes.DEFAULT_T
         deleted_count = 0
         for group_data in closed_groups:
             try:
-                group = await sync_to_async(Group.objects.select_related('owner').get)(id=group_data['id'])
-                # Проверяем, что пользователь является владельцем или участником
-                if group.owner_id == update.effective_user.id:
-                    # Если владелец - удаляем группу полностью
-                    await sync_to_async(group.delete)()
-                    deleted_count += 1
-                else:
-                    # Если участник - удаляем только его участие
-                    telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=update.effective_user.id)
-                    participation = await sync_to_async(
-                        Participant.objects.get
-                    )(group=group, user=telegram_user)
-                    await sync_to_async(participation.delete)()
-                    deleted_count += 1
+                # Владелец удаляет группу полностью, участник - только свое участие
+                await queries.adelete_closed_group(group_data['id'], context.telegram_user)
+                deleted_count += 1
             except Exception as e:
                 print(f"Ошибка удаления группы {group_data['id']}: {e}")
         
@@ -1501,25 +1235,16 @@ async def delete_group_selection(update: Update, context: ContextTypes.DEFAULT_T
     selected_group_data = closed_groups[group_number - 1]
     
     try:
-        group = await sync_to_async(Group.objects.select_related('owner').get)(id=selected_group_data['id'])
+        # Владелец удаляет группу полностью, участник - только свое участие
+        group, owner_deleted = await queries.adelete_closed_group(selected_group_data['id'], context.telegram_user)
         
-        # Проверяем, что пользователь является владельцем или участником
-        if group.owner_id == update.effective_user.id:
-            # Если владелец - удаляем группу полностью
-            group_name = group.name
-            await sync_to_async(group.delete)()
+        if owner_deleted:
             hints = get_command_hints("/my_groups", "/create_group", "/help")
             await update.message.reply_text(
-                f"✅ Группа '{group_name}' успешно удалена!\n\n"
+                f"✅ Группа '{group.name}' успешно удалена!\n\n"
                 f"Удалены все связанные данные (участники, розыгрыши и т.д.)." + hints
             )
         else:
-            # Если участник - удаляем только его участие
-            telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=update.effective_user.id)
-            participation = await sync_to_async(
-                Participant.objects.get
-            )(group=group, user=telegram_user)
-            await sync_to_async(participation.delete)()
             hints = get_command_hints("/my_groups", "/join_group", "/help")
             await update.message.reply_text(
                 f"✅ Вы удалены из группы '{group.name}'." + hints
@@ -1545,16 +1270,10 @@ async def delete_group_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def distribute_gifts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Расдача подарков (команда для владельца группы)"""
-    user = update.effective_user
-    
-    try:
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=user.id)
-    except TelegramUser.DoesNotExist:
-        await update.message.reply_text("❌ Вы не зарегистрированы в системе. Используйте /start")
-        return
+    telegram_user = context.telegram_user
     
     # Находим группу со статусом "жеребьевка проведена"
-    group = await sync_to_async(Group.objects.filter(owner=telegram_user, status='drawn').first)()
+    group = await queries.afind_owned_group(telegram_user, ['drawn'])
     
     if not group:
         hints = get_command_hints("/my_groups", "/draw", "/help")
@@ -1563,89 +1282,59 @@ async def distribute_gifts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Получаем все розыгрыши с предзагрузкой связанных объектов
-    draws = await sync_to_async(list)(
-        Draw.objects.filter(group=group).select_related(
-            'giver__user', 
-            'receiver__user',
-            'giver'
-        )
-    )
+    # Меняем статус на "расдача подарков" и ставим подарки в очередь одной транзакцией
+    queued_count = await db_async(start_distribution)(group)
     
-    if not draws:
+    if not queued_count:
         await update.message.reply_text("❌ В группе нет результатов розыгрыша.")
         return
     
-    # Рассылаем подарки
-    sent_count = 0
-    for draw_obj in draws:
-        try:
-            receiver_telegram_id = draw_obj.receiver.user.telegram_id
-            giver_name = draw_obj.giver.name
-            
-            if group.gift_via_bot and (draw_obj.giver.gift_message or draw_obj.giver.gift_photo_file_id):
-                # Отправляем подарок от бота (без указания дарителя - это Тайный Санта!)
-                if draw_obj.giver.gift_photo_file_id:
-                    # Если есть фото, отправляем фото с подписью
-                    message_text = "🎁 Подарок от Тайного Санты! 🎄"
-                    if draw_obj.giver.gift_message:
-                        message_text += f"\n\n🎁 Ваш подарок:\n{draw_obj.giver.gift_message}"
-                    message_text += "\n\nСчастливого праздника! 🎅"
-                    
-                    await context.bot.send_photo(
-                        chat_id=receiver_telegram_id,
-                        photo=draw_obj.giver.gift_photo_file_id,
-                        caption=message_text,
-                        parse_mode='HTML'
-                    )
-                else:
-                    # Если только текст без фото
-                    message_text = (
-                        f"🎁 Подарок от Тайного Санты! 🎄\n\n"
-                        f"🎁 Ваш подарок:\n{draw_obj.giver.gift_message}\n\n"
-                        f"Счастливого праздника! 🎅"
-                    )
-                    await context.bot.send_message(
-                        chat_id=receiver_telegram_id,
-                        text=message_text,
-                        parse_mode='HTML'
-                    )
-            else:
-                # Если подарок не через бота или не отправлен
-                message_text = (
-                    f"🎁 Подарок от Тайного Санты! 🎄\n\n"
-                    f"Подарок будет в условленном месте! 🎅"
-                )
-                await context.bot.send_message(
-                    chat_id=receiver_telegram_id,
-                    text=message_text,
-                    parse_mode='HTML'
-                )
-            sent_count += 1
-        except Exception as e:
-            print(f"Ошибка отправки подарка получателю {draw_obj.receiver.user.telegram_id}: {e}")
-    
-    # Меняем статус на "расдача подарков"
-    group.status = 'distribution'
-    await sync_to_async(group.save)()
-    
-    # Проверяем, нужно ли автоматически закрыть группу
-    from datetime import date
-    if group.close_date and group.close_date <= date.today():
-        group.status = 'closed'
-        await sync_to_async(group.save)()
+    outbox.wake()
+    
+    if group.status == 'closed':
         close_text = "\n\nГруппа автоматически закрыта (дата закрытия наступила)."
     else:
         close_text = f"\n\nГруппа будет автоматически закрыта {group.close_date.strftime('%d.%m.%Y') if group.close_date else 'на следующий день после расдачи'}."
     
-    hints = get_command_hints("/view_gifts", "/my_groups", "/close_group", "/help")
+    hints = get_command_hints("/retry_delivery", "/view_gifts", "/my_groups", "/close_group", "/help")
     await update.message.reply_text(
         f"✅ Подарки в группе '{group.name}' разосланы!\n\n"
-        f"📨 Отправлено подарков: {sent_count} из {len(draws)}\n\n"
+        f"📨 Подарков отправляется получателям: {queued_count}\n\n"
         f"Статус группы изменен на 'Расдача подарков'.{close_text}" + hints
     )
 
 
+async def retry_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторная отправка недоставленных сообщений розыгрыша (команда для владельца группы)"""
+    # Повторно уходят только сообщения с ошибкой доставки, остальные участники ничего не получат
+    results = await queries.aretry_owned_deliveries(context.telegram_user)
+    
+    if not results:
+        hints = get_command_hints("/my_groups", "/help")
+        await update.message.reply_text("✅ В ваших группах нет недоставленных сообщений." + hints)
+        return
+    
+    outbox.wake()
+    
+    lines = []
+    for group, queued_count, stats in results:
+        line = (
+            f"🔁 {group.name} ({group.code}): повторно отправляется сообщений: {queued_count}\n"
+            f"   Результат розыгрыша получили {stats['notified']} из {stats['pairs']}"
+        )
+        if group.status in ('distribution', 'closed'):
+            line += f", подарки получили {stats['delivered']} из {stats['pairs']}"
+        if stats['unreachable']:
+            line += f"\n   Заблокировали бота: {stats['unreachable']}"
+        lines.append(line)
+    hints = get_command_hints("/my_groups", "/help")
+    await update.message.reply_text(
+        "📨 Повторная доставка\n\n" + "\n\n".join(lines) + "\n\n"
+        "Участникам, заблокировавшим бота, сообщения не отправляются. Когда они снова "
+        "запустят бота (/start), повторите /retry_delivery." + hints
+    )
+
+
 def setup_handlers(application):
     """Настройка обработчиков команд"""
     
@@ -1661,6 +1350,8 @@ def setup_handlers(application):
             WAITING_FOR_CLOSE_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_group_close_date)],
         },
         fallbacks=[CommandHandler('cancel', create_group_cancel)],
+        name='create_group',
+        persistent=True,
     )
     
     # ConversationHandler для вступления в группу
@@ -1670,6 +1361,8 @@ def setup_handlers(application):
             WAITING_FOR_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, join_group_code)],
         },
         fallbacks=[CommandHandler('cancel', join_group_cancel)],
+        name='join_group',
+        persistent=True,
     )
     
     # ConversationHandler для установки имени
@@ -1680,6 +1373,8 @@ def setup_handlers(application):
             WAITING_FOR_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_name)],
         },
         fallbacks=[CommandHandler('cancel', set_name_cancel)],
+        name='set_name',
+        persistent=True,
     )
     
     # ConversationHandler для отправки подарка
@@ -1693,6 +1388,8 @@ def setup_handlers(application):
             ],
         },
         fallbacks=[CommandHandler('cancel', send_gift_cancel)],
+        name='send_gift',
+        persistent=True,
     )
     
     # ConversationHandler для закрытия группы
@@ -1702,6 +1399,8 @@ def setup_handlers(application):
             WAITING_FOR_CLOSE_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, close_group_message)],
         },
         fallbacks=[CommandHandler('cancel', close_group_cancel)],
+        name='close_group',
+        persistent=True,
     )
     
     # ConversationHandler для удаления группы
@@ -1711,8 +1410,13 @@ def setup_handlers(application):
             WAITING_FOR_DELETE_GROUP_SELECTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_group_selection)],
         },
         fallbacks=[CommandHandler('cancel', delete_group_cancel)],
+        name='delete_group',
+        persistent=True,
     )
     
+    # Пользователь из БД для всех обработчиков (группа -1, выполняется первой)
+    setup_middleware(application)
+    
     # Регистрируем обработчики
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('help', help_command))
@@ -1724,6 +1428,7 @@ def setup_handlers(application):
     application.add_handler(CommandHandler('draw', draw))
     application.add_handler(send_gift_handler)
     application.add_handler(CommandHandler('distribute_gifts', distribute_gifts))
+    application.add_handler(CommandHandler('retry_delivery', retry_delivery))
     application.add_handler(CommandHandler('view_gifts', view_gifts))
     application.add_handler(close_group_handler)
     application.add_handler(delete_group_handler)
@@ -1732,3 +1437,7 @@ def setup_handlers(application):
     application.add_handler(MessageHandler(filters.TEXT & filters.FORWARDED, handle_forwarded_message))
     # Обработчик непонятных сообщений (должен быть последним, чтобы не перехватывать сообщения из ConversationHandler)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_unknown_message))
+    
+    # Профилирование обработчиков и журнал медленных обновлений (bot/profiling.py)
+    if getattr(settings, 'TELEGRAM_PROFILE_HANDLERS', False):
+        profile_handlers(application)
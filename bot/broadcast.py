@@ -0,0 +1,194 @@
+"""
+Движок массовой рассылки сообщений участникам.
+
+Отправляет сообщения с ограниченной конкурентностью и соблюдением лимитов
+Telegram Bot API: не более ~30 сообщений в секунду на бота и не более
+одного сообщения в секунду в один чат. Сам обрабатывает RetryAfter
+(приостанавливает все отправки на указанное время) и временные сетевые
+ошибки (повтор с экспоненциальной задержкой).
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from . import metrics
+
+
+# Лимиты Telegram Bot API
+GLOBAL_RATE = 30        # сообщений в секунду на бота
+PER_CHAT_RATE = 1       # сообщений в секунду в один чат
+DEFAULT_CONCURRENCY = 20
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5      # секунд, удваивается с каждой попыткой
+
+
+@dataclass
+class OutgoingMessage:
+    """Сообщение для рассылки"""
+    chat_id: int
+    text: str
+    photo: Optional[str] = None       # file_id фото, текст уходит подписью
+    parse_mode: Optional[str] = None
+    key: object = None                # произвольный идентификатор для сопоставления результата
+    draw_id: Optional[int] = None     # Draw, состояние доставки которого обновляет outbox
+
+
+@dataclass
+class DeliveryResult:
+    """Результат доставки одного сообщения"""
+    message: OutgoingMessage
+    ok: bool
+    attempts: int
+    error: Optional[TelegramError] = None
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не более capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # Лок держится во время ожидания, чтобы ожидающие обслуживались по очереди
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """
+    Общий для бота движок рассылки.
+
+    Один экземпляр на бота (см. get_broadcaster), чтобы одновременные рассылки
+    из разных обработчиков делили глобальный лимит.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_interval = 1 / per_chat_rate
+        self.max_attempts = max_attempts
+        self._chat_next_slot = {}
+        self._paused_until = 0.0
+
+    async def _wait_for_chat(self, chat_id):
+        """Резервирует ближайший слот отправки в чат с учетом per-chat лимита"""
+        now = time.monotonic()
+        slot = max(now, self._chat_next_slot.get(chat_id, 0.0))
+        self._chat_next_slot[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next_slot) > 10000:
+            # Удаляем устаревшие слоты, чтобы словарь не рос бесконечно
+            self._chat_next_slot = {k: v for k, v in self._chat_next_slot.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _acquire(self, chat_id):
+        await self._wait_for_chat(chat_id)
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        await self.global_bucket.acquire()
+
+    def _pause(self, retry_after):
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    async def send(self, bot, message: OutgoingMessage) -> DeliveryResult:
+        """Отправляет одно сообщение с учетом лимитов и повторами"""
+        metrics.broadcast_in_flight.inc()
+        try:
+            result = await self._send(bot, message)
+        finally:
+            metrics.broadcast_in_flight.dec()
+        metrics.broadcast_messages.inc('sent' if result.ok else 'failed')
+        return result
+
+    async def _send(self, bot, message: OutgoingMessage) -> DeliveryResult:
+        attempts = 0
+        while True:
+            attempts += 1
+            await self._acquire(message.chat_id)
+            try:
+                if message.photo:
+                    await bot.send_photo(
+                        chat_id=message.chat_id,
+                        photo=message.photo,
+                        caption=message.text,
+                        parse_mode=message.parse_mode
+                    )
+                else:
+                    await bot.send_message(
+                        chat_id=message.chat_id,
+                        text=message.text,
+                        parse_mode=message.parse_mode
+                    )
+                return DeliveryResult(message, True, attempts)
+            except RetryAfter as e:
+                # Flood control действует на весь бот - приостанавливаем все отправки
+                self._pause(e.retry_after)
+                if attempts >= self.max_attempts:
+                    return DeliveryResult(message, False, attempts, e)
+            except BadRequest as e:
+                # BadRequest наследуется от NetworkError, но повтор не поможет
+                return DeliveryResult(message, False, attempts, e)
+            except NetworkError as e:
+                if attempts >= self.max_attempts:
+                    return DeliveryResult(message, False, attempts, e)
+                await asyncio.sleep(BACKOFF_BASE * 2 ** (attempts - 1))
+            except TelegramError as e:
+                # Forbidden (бот заблокирован) и прочие постоянные ошибки
+                return DeliveryResult(message, False, attempts, e)
+
+    async def broadcast(self, bot, messages: Iterable[OutgoingMessage],
+                        concurrency: int = DEFAULT_CONCURRENCY) -> list:
+        """
+        Рассылает сообщения не более чем в concurrency параллельных отправок.
+
+        Возвращает список DeliveryResult в порядке входных сообщений.
+        """
+        queue = enumerate(messages)
+        results = {}
+
+        async def worker():
+            # Все воркеры читают общий итератор, поэтому сообщения не материализуются заранее
+            for index, message in queue:
+                results[index] = await self.send(bot, message)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        return [results[i] for i in range(len(results))]
+
+
+_broadcasters = {}
+
+
+def get_broadcaster(bot) -> Broadcaster:
+    """Возвращает общий экземпляр Broadcaster для бота"""
+    broadcaster = _broadcasters.get(bot.token)
+    if broadcaster is None:
+        broadcaster = _broadcasters[bot.token] = Broadcaster()
+    return broadcaster
+
+
+async def broadcast(bot, messages: Iterable[OutgoingMessage], concurrency: int = DEFAULT_CONCURRENCY) -> list:
+    """Рассылает сообщения через общий для бота Broadcaster"""
+    return await get_broadcaster(bot).broadcast(bot, messages, concurrency=concurrency)
@@ -0,0 +1,286 @@
+"""
+Настройка соединений с базой данных.
+
+SQLite по умолчанию ведет журнал в режиме DELETE: пока бот пишет, админка
+не может даже читать, и наоборот. Поэтому при открытии каждого соединения
+(сигнал connection_created) применяются прагмы из settings.SQLITE_PRAGMAS:
+- journal_mode=WAL - читатели не блокируются записью, писатель - читателями;
+- synchronous=NORMAL - в режиме WAL fsync только при checkpoint, без потери
+  целостности (при сбое питания теряются лишь последние транзакции);
+- busy_timeout - сколько миллисекунд ждать освобождения блокировки вместо
+  немедленной ошибки "database is locked";
+- mmap_size и cache_size - чтение через отображение файла в память и
+  кэш страниц соединения.
+
+Для PostgreSQL прагмы не нужны: пул соединений и проверки их исправности
+настраиваются в DATABASES (см. santagame/settings.py).
+
+Синхронный код ORM из обработчиков бота выполняется через db_executor -
+пул из TELEGRAM_DB_THREADS потоков (см. DBExecutor), а не в единственном
+потоке sync_to_async(thread_sensitive=True).
+"""
+import functools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, connection
+
+from . import metrics, profiling
+
+
+# Порядок важен: busy_timeout раньше journal_mode, чтобы переключение режима
+# журнала дождалось других соединений
+PRAGMA_ORDER = ['busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size']
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """Обработчик connection_created: применяет SQLITE_PRAGMAS к новому соединению SQLite"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    names = [name for name in PRAGMA_ORDER if name in pragmas]
+    names += [name for name in pragmas if name not in PRAGMA_ORDER]
+    # Сырое соединение sqlite3: курсор Django здесь еще не нужен и не логируется
+    cursor = connection.connection.cursor()
+    try:
+        for name in names:
+            if pragmas[name] is not None:
+                cursor.execute(f'PRAGMA {name} = {pragmas[name]}')
+    finally:
+        cursor.close()
+
+
+def sqlite_pragma_values(connection, names=PRAGMA_ORDER):
+    """Текущие значения прагм соединения SQLite (для проверки и бенчмарка)"""
+    with connection.cursor() as cursor:
+        values = {}
+        for name in names:
+            cursor.execute(f'PRAGMA {name}')
+            values[name] = cursor.fetchone()[0]
+    return values
+
+
+DEFAULT_THREADS = 4
+DEFAULT_SAMPLES = 10000     # последних вызовов для перцентилей
+DEFAULT_RETRIES = 2         # повторов вызова после обрыва соединения
+DEFAULT_RETRY_DELAY = 0.1   # секунд перед первым повтором, далее вдвое больше
+CONNECTION_COUNTERS = ['opened', 'expired', 'failed_checks', 'reconnects', 'reconnect_failures']
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))]
+
+
+def _count_statements(executed):
+    """execute_wrapper: записывает успешно выполненные запросы вызова и их время"""
+    def wrapper(execute, sql, params, many, context):
+        started = time.perf_counter()
+        result = execute(sql, params, many, context)
+        executed.append((sql, time.perf_counter() - started))
+        return result
+    return wrapper
+
+
+class DBExecutor:
+    """
+    Пул потоков для синхронного кода ORM, вызываемого из event loop бота.
+
+    sync_to_async по умолчанию выполняет весь ORM всех пользователей в одном
+    потоке, и медленный запрос одного обработчика задерживает остальных.
+    DBExecutor выполняет вызовы в threads потоках. У каждого потока свое
+    соединение с БД (соединения Django привязаны к потоку).
+    threads=0 - прежнее поведение: один поток sync_to_async(thread_sensitive=True).
+
+    Бот - долгоживущий процесс без границ HTTP-запросов, на которых Django
+    закрывает старые соединения, поэтому жизненным циклом соединения
+    управляет каждый вызов:
+    - до и после вызова close_old_connections закрывает соединения старше
+      CONN_MAX_AGE и сломанные;
+    - перед использованием соединение проверяется (CONN_HEALTH_CHECKS),
+      неисправное закрывается и открывается заново;
+    - если соединение оборвалось (рестарт PostgreSQL, разрыв по простою) до
+      первого успешного запроса вызова, вызов повторяется с новым
+      соединением до retries раз. После успешного запроса вызов не
+      повторяется: изменения могли быть уже записаны.
+    Внутри внешней транзакции (transaction.atomic вокруг вызова, TestCase)
+    соединение не трогается.
+
+    Для каждого вызова измеряются ожидание в очереди (от отправки до начала
+    выполнения в потоке) и время выполнения, а также считаются события
+    соединений (CONNECTION_COUNTERS); stats() возвращает сводку.
+    Статистика обновляется только из event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(
+        self,
+        threads=DEFAULT_THREADS,
+        samples=DEFAULT_SAMPLES,
+        retries=DEFAULT_RETRIES,
+        retry_delay=DEFAULT_RETRY_DELAY,
+    ):
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix='db') if threads else None
+        self._samples = deque(maxlen=samples)  # (ожидание, выполнение), секунд
+        self._functions = {}                   # имя функции -> счетчики
+        self.connections = dict.fromkeys(CONNECTION_COUNTERS, 0)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) в потоке пула и возвращает результат"""
+        events = dict.fromkeys(CONNECTION_COUNTERS, 0)
+        executed = []
+        timings = {}
+
+        def call():
+            timings['started'] = time.perf_counter()
+            try:
+                return self._call(func, args, kwargs, events, executed)
+            finally:
+                timings['finished'] = time.perf_counter()
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        submitted = time.perf_counter()
+        try:
+            if self._pool is None:
+                return await sync_to_async(call)()
+            return await sync_to_async(call, thread_sensitive=False, executor=self._pool)()
+        finally:
+            self.in_flight -= 1
+            for name, count in events.items():
+                self.connections[name] += count
+            # Запросы считаются здесь, в event loop, а не в потоке пула: метрикам не нужны блокировки
+            metrics.count_db_queries(len(executed))
+            if 'finished' in timings:
+                wait = timings['started'] - submitted
+                run = timings['finished'] - timings['started']
+                self._record(getattr(func, '__qualname__', None) or type(func).__qualname__, wait, run)
+                profiling.record_db(wait, run, executed)
+
+    def _call(self, func, args, kwargs, events, executed):
+        """
+        Выполняется в потоке пула: вызов с подготовкой соединения и повторами.
+        В executed записываются успешно выполненные запросы: (sql, секунд).
+        """
+        attempt = 0
+        try:
+            while True:
+                self._prepare_connection(events)
+                opened = connection.connection is None
+                try:
+                    with connection.execute_wrapper(_count_statements(executed)):
+                        return func(*args, **kwargs)
+                except (OperationalError, InterfaceError):
+                    if executed or connection.in_atomic_block or self._connection_usable():
+                        raise
+                    # Соединение оборвалось до первого запроса: ничего не записано, можно повторить.
+                    # Повтор возможен, только пока executed пуст, поэтому список общий для попыток
+                    connection.close()
+                    if attempt >= self.retries:
+                        events['reconnect_failures'] += 1
+                        raise
+                    events['reconnects'] += 1
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    attempt += 1
+                finally:
+                    if opened and connection.connection is not None:
+                        events['opened'] += 1
+        finally:
+            if not connection.in_atomic_block:
+                close_old_connections()
+
+    @staticmethod
+    def _connection_usable():
+        return connection.connection is not None and connection.is_usable()
+
+    def _prepare_connection(self, events):
+        """Закрывает устаревшее соединение и проверяет оставшееся перед использованием"""
+        if connection.in_atomic_block or connection.connection is None:
+            return
+        close_old_connections()
+        if connection.connection is None:
+            events['expired'] += 1
+        elif connection.settings_dict['CONN_HEALTH_CHECKS']:
+            if connection.is_usable():
+                # Django не будет проверять соединение повторно при первом запросе
+                connection.health_check_done = True
+            else:
+                events['failed_checks'] += 1
+                connection.close()
+
+    def _record(self, name, wait, run):
+        self.calls += 1
+        self._samples.append((wait, run))
+        counters = self._functions.setdefault(
+            name, {'calls': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'run_total': 0.0, 'run_max': 0.0}
+        )
+        counters['calls'] += 1
+        counters['wait_total'] += wait
+        counters['wait_max'] = max(counters['wait_max'], wait)
+        counters['run_total'] += run
+        counters['run_max'] = max(counters['run_max'], run)
+
+    def stats(self):
+        """
+        Сводка для мониторинга: перцентили ожидания и выполнения (мс) по
+        последним вызовам, средние/максимумы по каждой функции и счетчики
+        соединений: opened - открыто, expired - закрыто по CONN_MAX_AGE,
+        failed_checks - не прошли проверку, reconnects - повторы вызова после
+        обрыва, reconnect_failures - повторы не помогли.
+        """
+        waits = [wait for wait, _ in self._samples]
+        runs = [run for _, run in self._samples]
+        result = {
+            'threads': self.threads,
+            'calls': self.calls,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'wait_p50_ms': _percentile(waits, 50) * 1000 if waits else 0.0,
+            'wait_p99_ms': _percentile(waits, 99) * 1000 if waits else 0.0,
+            'run_p50_ms': _percentile(runs, 50) * 1000 if runs else 0.0,
+            'run_p99_ms': _percentile(runs, 99) * 1000 if runs else 0.0,
+            'connections': dict(self.connections),
+            'functions': {},
+        }
+        for name, counters in self._functions.items():
+            result['functions'][name] = {
+                'calls': counters['calls'],
+                'wait_avg_ms': counters['wait_total'] / counters['calls'] * 1000,
+                'wait_max_ms': counters['wait_max'] * 1000,
+                'run_avg_ms': counters['run_total'] / counters['calls'] * 1000,
+                'run_max_ms': counters['run_max'] * 1000,
+            }
+        return result
+
+    def reset_stats(self):
+        self._samples.clear()
+        self._functions.clear()
+        self.connections = dict.fromkeys(CONNECTION_COUNTERS, 0)
+        self.calls = 0
+        self.max_in_flight = self.in_flight
+
+
+db_executor = DBExecutor(
+    threads=getattr(settings, 'TELEGRAM_DB_THREADS', DEFAULT_THREADS),
+    retries=getattr(settings, 'TELEGRAM_DB_RETRIES', DEFAULT_RETRIES),
+)
+
+
+def db_async(func):
+    """
+    Асинхронная обертка над синхронной функцией ORM, как sync_to_async,
+    но вызов выполняется через db_executor
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # db_executor читается при каждом вызове: его можно заменить (например, в тестах)
+        return await db_executor.run(func, *args, **kwargs)
+    return wrapper
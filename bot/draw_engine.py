@@ -0,0 +1,138 @@
+"""
+Алгоритмы распределения участников розыгрыша.
+"""
+import random
+from collections import namedtuple
+
+
+# Участник розыгрыша в компактном виде (строка values_list)
+DrawParticipant = namedtuple('DrawParticipant', ['id', 'name', 'telegram_id'])
+
+
+def derangement(items, rng=None):
+    """
+    Возвращает перестановку items без неподвижных точек (никто не дарит сам себе).
+
+    Алгоритм Саттоло: за один проход O(n) строит случайный цикл длины n,
+    равновероятно выбирая одну из (n-1)! цикловых перестановок. Результат
+    всегда корректен, повторные перемешивания не нужны. Бонус для Тайного
+    Санты: подарки образуют одну цепочку, без замкнутых пар "А дарит Б, Б дарит А"
+    (для n > 2).
+    """
+    n = len(items)
+    if n < 2:
+        raise ValueError("Для розыгрыша нужно минимум 2 участника")
+    rng = rng or random
+    receivers = list(items)
+    for i in range(n - 1, 0, -1):
+        j = rng.randrange(i)  # 0 <= j < i, в отличие от Фишера-Йетса j != i
+        receivers[i], receivers[j] = receivers[j], receivers[i]
+    return receivers
+
+
+class DrawInfeasible(Exception):
+    """Не существует распределения, удовлетворяющего ограничениям"""
+
+
+# Сколько случайных обменов пробовать для каждого конфликта до перехода к поиску паросочетания
+REPAIR_SWAP_ATTEMPTS = 32
+
+
+def solve_assignment(n, forbidden=None, rng=None):
+    """
+    Находит распределение для n участников с учетом запрещенных пар.
+
+    forbidden - словарь {даритель: множество запрещенных получателей} по индексам
+    0..n-1; дарить самому себе запрещено всегда. Возвращает список receivers,
+    где receivers[i] - индекс получателя для дарителя i.
+
+    1. Случайный цикл Саттоло - без ограничений это и есть ответ.
+    2. Конфликты (запрещенные пары) чинятся случайными обменами получателей:
+       при разреженных ограничениях их единицы, и почти все исправляются здесь.
+    3. Оставшиеся конфликты решаются поиском увеличивающих путей в двудольном
+       графе разрешенных пар (паросочетание Куна на дополнении графа запретов).
+       Граф разрешенных пар плотный, поэтому он не строится явно: непосещенные
+       получатели хранятся множеством, и каждый путь ищется за O(n + запретов).
+       Если путь не найден, идеального паросочетания нет - розыгрыш невозможен.
+
+    Вызывает DrawInfeasible, если распределения не существует.
+    """
+    if n < 2:
+        raise DrawInfeasible("Для розыгрыша нужно минимум 2 участника")
+    rng = rng or random
+    forbidden = {giver: receivers for giver, receivers in (forbidden or {}).items() if receivers}
+
+    def allowed(giver, receiver):
+        return giver != receiver and receiver not in forbidden.get(giver, ())
+
+    # Быстрые проверки условия Холла для одиночных вершин
+    blocked_count = [1] * n  # сам себе
+    for giver, receivers in forbidden.items():
+        if len(receivers - {giver}) >= n - 1:
+            raise DrawInfeasible("Участнику некому дарить подарок")
+        for receiver in receivers:
+            if receiver != giver:
+                blocked_count[receiver] += 1
+    if any(count >= n for count in blocked_count):
+        raise DrawInfeasible("Участнику некому подарить подарок")
+
+    receivers = derangement(range(n), rng)
+    if not forbidden:
+        return receivers
+
+    conflicts = [giver for giver in forbidden if not allowed(giver, receivers[giver])]
+
+    # Шаг 2: случайные обмены
+    unresolved = []
+    for giver in conflicts:
+        if allowed(giver, receivers[giver]):
+            continue  # исправлен предыдущим обменом
+        for _ in range(REPAIR_SWAP_ATTEMPTS):
+            other = rng.randrange(n)
+            if allowed(giver, receivers[other]) and allowed(other, receivers[giver]):
+                receivers[giver], receivers[other] = receivers[other], receivers[giver]
+                break
+        else:
+            unresolved.append(giver)
+
+    if not unresolved:
+        return receivers
+
+    # Шаг 3: увеличивающие пути
+    owner = [None] * n  # owner[получатель] = даритель
+    for giver in range(n):
+        owner[receivers[giver]] = giver
+    for giver in unresolved:
+        if not allowed(giver, receivers[giver]):
+            owner[receivers[giver]] = None
+            receivers[giver] = None
+    free_givers = [giver for giver in range(n) if receivers[giver] is None]
+
+    for start in free_givers:
+        unvisited = set(range(n))
+        came_from = {}  # получатель -> даритель, из которого в него пришли
+        queue = [start]
+        found = None
+        while queue and found is None:
+            giver = queue.pop()
+            for receiver in list(unvisited):
+                if not allowed(giver, receiver):
+                    continue
+                unvisited.discard(receiver)
+                came_from[receiver] = giver
+                if owner[receiver] is None:
+                    found = receiver
+                    break
+                queue.append(owner[receiver])
+        if found is None:
+            raise DrawInfeasible("Не удалось распределить участников с учетом исключений")
+        # Переворачиваем путь: каждый даритель на пути получает новый получатель
+        receiver = found
+        while receiver is not None:
+            giver = came_from[receiver]
+            previous = receivers[giver]
+            receivers[giver] = receiver
+            owner[receiver] = giver
+            receiver = previous if giver != start else None
+
+    return receivers
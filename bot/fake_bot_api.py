@@ -0,0 +1,287 @@
+"""
+Фейковый Bot API для тестов без обращения к серверам Telegram.
+
+FakeBotAPI подключается к приложению как request (BaseRequest), отвечает
+на методы Bot API из памяти процесса и записывает все вызовы. getUpdates
+отдает обновления, добавленные push_updates (сценарий нагрузочного прогона),
+а на долю отправок можно отвечать 429 (flood control).
+FakeBotAPIServer отдает те же ответы по настоящему HTTP на localhost - для
+бенчмарков HTTP-клиента (пулы соединений, keep-alive, таймауты) и
+нагрузочного прогона бота целиком (bot/loadtest.py).
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest
+
+
+BOT_ID = 123456
+BOT_TOKEN = f'{BOT_ID}:TEST-TOKEN'
+SEND_METHODS = ('sendMessage', 'sendPhoto')
+
+
+class FakeBotAPI(BaseRequest):
+    """
+    Bot API в памяти процесса: записывает вызовы и возвращает правдоподобные ответы.
+
+    flood_rate - доля отправок (SEND_METHODS), на которые возвращается 429
+    с retry_after секунд; такие вызовы не записываются, а считаются в flooded.
+    seed - для воспроизводимого выбора отправок с 429.
+    """
+
+    def __init__(self, bot_id=BOT_ID, username='santa_test_bot', flood_rate=0.0, retry_after=1, seed=None):
+        self.bot_id = bot_id
+        self.username = username
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = []  # (метод Bot API, параметры)
+        self.updates = []  # обновления для getUpdates, по возрастанию update_id
+        self.flooded = 0
+        self._message_ids = itertools.count(1)
+        self._random = random.Random(seed)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        parameters = request_data.parameters if request_data else {}
+        return self.respond(url.rsplit('/', 1)[-1], parameters)
+
+    def respond(self, api_method, parameters):
+        """Записывает вызов и возвращает (HTTP-статус, тело ответа)"""
+        if api_method in SEND_METHODS and self.flood_rate and self._random.random() < self.flood_rate:
+            self.flooded += 1
+            return 429, json.dumps({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+        self.calls.append((api_method, parameters))
+        handler = getattr(self, f'api_{api_method}', None)
+        result = handler(parameters) if handler else True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def api_getMe(self, parameters):
+        return {
+            'id': self.bot_id,
+            'is_bot': True,
+            'first_name': 'Santa Test',
+            'username': self.username,
+            'can_join_groups': False,
+            'can_read_all_group_messages': False,
+            'supports_inline_queries': False,
+        }
+
+    def push_updates(self, updates):
+        """Добавляет обновления (dict), которые бот получит через getUpdates"""
+        self.updates.extend(updates)
+
+    def has_updates(self, offset=0):
+        return bool(self.updates) and self.updates[-1]['update_id'] >= offset
+
+    def api_getUpdates(self, parameters):
+        # Как в Telegram: offset подтверждает все обновления с меньшим update_id
+        offset = int(parameters.get('offset') or 0)
+        if offset:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        return self.updates[:int(parameters.get('limit') or 100)]
+
+    def _message(self, parameters, **content):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(parameters['chat_id']), 'type': 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Santa Test'},
+            **content,
+        }
+
+    def api_sendMessage(self, parameters):
+        return self._message(parameters, text=parameters.get('text', ''))
+
+    def api_sendPhoto(self, parameters):
+        photo = {'file_id': str(parameters.get('photo')), 'file_unique_id': 'photo', 'width': 1, 'height': 1}
+        return self._message(parameters, photo=[photo], caption=parameters.get('caption'))
+
+    def sent_messages(self, chat_id=None):
+        """Параметры отправленных сообщений (sendMessage/sendPhoto), при необходимости в один чат"""
+        return [
+            parameters for api_method, parameters in self.calls
+            if api_method in ('sendMessage', 'sendPhoto')
+            and (chat_id is None or int(parameters['chat_id']) == chat_id)
+        ]
+
+
+class FakeBotAPIServer:
+    """
+    HTTP-сервер Bot API на localhost поверх FakeBotAPI.
+
+    Работает в отдельном потоке со своим event loop, чтобы не делить его с
+    клиентом. latency - задержка каждого ответа, handshake - дополнительная
+    задержка первого ответа в новом соединении (как TLS-рукопожатие с
+    api.telegram.org), в секундах. Считает открытые соединения и запросы.
+    getUpdates, как в Telegram, ждет новых обновлений до timeout секунд (long polling).
+    Используется как контекстный менеджер; base_url передается в Bot/Application.
+    """
+
+    def __init__(self, api=None, latency=0.0, handshake=0.0, host='127.0.0.1'):
+        self.api = api or FakeBotAPI()
+        self.latency = latency
+        self.handshake = handshake
+        self.host = host
+        self.port = None
+        self.connections = 0
+        self.requests = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._new_updates = None
+        self._stopping = False
+        self._writers = set()
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}/bot'
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._new_updates = asyncio.Event()
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, 0))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            # Соединения keep-alive и ожидающие getUpdates закрываются вместе с сервером
+            self._stopping = True
+            self._new_updates.set()
+            for writer in list(self._writers):
+                writer.close()
+            tasks = asyncio.all_tasks(self._loop)
+            if tasks:
+                # gather() без задач ищет текущий event loop, а в этом потоке его нет
+                self._loop.run_until_complete(asyncio.gather(*tasks))
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def push_updates(self, updates):
+        """Добавляет обновления для getUpdates; можно вызывать из любого потока"""
+        self._loop.call_soon_threadsafe(self._push_updates, list(updates))
+
+    def _push_updates(self, updates):
+        self.api.push_updates(updates)
+        self._new_updates.set()
+
+    async def _wait_for_updates(self, parameters):
+        """Long polling: ждет обновлений с update_id >= offset не дольше timeout"""
+        offset = int(parameters.get('offset') or 0)
+        timeout = float(parameters.get('timeout') or 0)
+        deadline = self._loop.time() + timeout
+        while not (self.api.has_updates(offset) or self._stopping) and self._loop.time() < deadline:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), deadline - self._loop.time())
+            except asyncio.TimeoutError:
+                return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handle(self, reader, writer):
+        """Одно соединение HTTP/1.1 с keep-alive: запросы обрабатываются по очереди"""
+        self.connections += 1
+        self._writers.add(writer)
+        delay = self.latency + self.handshake
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                if delay:
+                    await asyncio.sleep(delay)
+                delay = self.latency
+                if headers.get('content-type', '').startswith('application/json'):
+                    parameters = json.loads(body or b'{}')
+                else:
+                    parameters = dict(parse_qsl(body.decode()))
+                api_method = path.rsplit('/', 1)[-1]
+                if api_method == 'getUpdates':
+                    await self._wait_for_updates(parameters)
+                status, response = self.api.respond(api_method, parameters)
+                writer.write(
+                    f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(response)}\r\n\r\n'.encode() + response
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+_update_ids = itertools.count(1)
+
+
+def _private_message(user_id, first_name, username, **content):
+    return {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': first_name},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': first_name, 'username': username},
+        **content,
+    }
+
+
+def make_text_update(user_id, text, first_name='Тест', username=None):
+    """Обновление Telegram (dict) с текстовым сообщением пользователя в личном чате"""
+    message = _private_message(user_id, first_name, username, text=text)
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def make_photo_update(user_id, file_id, caption=None, first_name='Тест', username=None):
+    """Обновление Telegram (dict) с фото от пользователя в личном чате"""
+    photo = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}]
+    content = {'photo': photo, 'caption': caption} if caption else {'photo': photo}
+    return {'update_id': next(_update_ids), 'message': _private_message(user_id, first_name, username, **content)}
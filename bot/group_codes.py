@@ -0,0 +1,85 @@
+"""
+Выдача уникальных кодов групп.
+
+Код не проверяется запросом перед вставкой: группа вставляется сразу со
+случайным кодом, а уникальность гарантирует индекс по Group.code. При
+совпадении (IntegrityError) вставка откатывается до точки сохранения и
+повторяется с новым кодом. Так два одновременных /create_group не могут
+получить один код, а на каждую группу в обычном случае уходит один INSERT
+вместо SELECT + INSERT.
+
+Вероятность совпадения мала: алфавит кода - 38 символов, 38^8 ~ 4*10^12
+вариантов, даже при 10 млн групп повтор нужен примерно раз на 400 000 вставок.
+"""
+from django.db import IntegrityError, transaction
+
+from .models import Group
+
+
+MAX_ATTEMPTS = 10
+
+
+class CodeAllocationError(Exception):
+    """Не удалось подобрать свободный код за MAX_ATTEMPTS попыток"""
+
+
+def new_code():
+    """Случайный код-кандидат (без обращения к базе)"""
+    return Group.generate_code()
+
+
+def create_group(**fields):
+    """Создает группу с уникальным кодом; повторяет вставку при совпадении кода"""
+    for _ in range(MAX_ATTEMPTS):
+        code = new_code()
+        try:
+            # Точка сохранения: ошибка не прерывает внешнюю транзакцию
+            with transaction.atomic():
+                return Group.objects.create(code=code, **fields)
+        except IntegrityError:
+            # Повторяем только при совпадении кода, остальные ошибки не скрываем
+            if not Group.objects.filter(code=code).exists():
+                raise
+    raise CodeAllocationError(f'Не удалось подобрать код группы за {MAX_ATTEMPTS} попыток')
+
+
+def bulk_create_groups(groups, batch_size=1000):
+    """
+    Создает группы пачками, выдавая каждой уникальный код (для массового импорта).
+
+    Коды внутри пачки различны; если пачка упирается в уже занятый код, занятые
+    коды находятся одним запросом, заменяются, и пачка вставляется снова.
+    Возвращает созданные группы.
+    """
+    created = []
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        codes = set()
+        for group in batch:
+            group.code = _unique_candidate(codes)
+            codes.add(group.code)
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    created.extend(Group.objects.bulk_create(batch))
+                break
+            except IntegrityError:
+                taken = set(Group.objects.filter(code__in=codes).values_list('code', flat=True))
+                if not taken:
+                    raise
+                codes -= taken
+                for group in batch:
+                    if group.code in taken:
+                        group.code = _unique_candidate(codes | taken)
+                        codes.add(group.code)
+        else:
+            raise CodeAllocationError(f'Не удалось подобрать коды групп за {MAX_ATTEMPTS} попыток')
+    return created
+
+
+def _unique_candidate(used):
+    """Код-кандидат, которого нет в used"""
+    code = new_code()
+    while code in used:
+        code = new_code()
+    return code
@@ -0,0 +1,27 @@
+import json
+from importlib import import_module
+from django.core.management.base import BaseCommand
+from bot.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Запускает бенчмарк производительности'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Вывести результат в формате JSON',
+        )
+        subparsers = parser.add_subparsers(dest='benchmark', required=True, title='бенчмарки')
+        for name, module_path in BENCHMARKS.items():
+            module = import_module(module_path)
+            subparser = subparsers.add_parser(name, help=module.HELP)
+            module.add_arguments(subparser)
+
+    def handle(self, *args, **options):
+        module = import_module(BENCHMARKS[options['benchmark']])
+        self.stdout.write(self.style.SUCCESS(f"⏱ Бенчмарк: {module.HELP}"))
+        result = module.run(options, self.stdout)
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
@@ -1,70 +1,131 @@
 import asyncio
+import time
 from django.core.management.base import BaseCommand
 from asgiref.sync import sync_to_async
-from bot.models import Group, Participant, Draw
+from bot.models import Group, Participant
 from django.conf import settings
-from telegram import Bot
+from bot.telegram_requests import make_bot
+from bot import outbox
+from bot.broadcast import DEFAULT_CONCURRENCY, GLOBAL_RATE
+from bot.services import close_open_groups
+
+
+PROGRESS_INTERVAL = 5.0  # секунд между сообщениями о ходе доставки
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+
+def format_progress(done, total, started):
+    """'done/total (pct%), скорость/с, осталось ~ETA'"""
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = done / elapsed
+    text = f'{done}/{total}'
+    if total:
+        text += f' ({done * 100 // total}%)'
+    text += f', {rate:.1f}/с'
+    if rate and total and done < total:
+        text += f', осталось ~{format_duration((total - done) / rate)}'
+    return text
 
 
 class Command(BaseCommand):
     help = 'Закрывает все группы и уведомляет участников'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, сколько групп будет закрыто и сколько уведомлений отправлено',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Количество групп, закрываемых одной транзакцией',
+            default=500,
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Количество параллельных отправок уведомлений (с учетом лимитов Telegram)',
+            default=DEFAULT_CONCURRENCY,
+        )
+
     def handle(self, *args, **options):
-        self.stdout.write('🔒 Начинаю закрытие всех групп...')
-        
-        # Получаем все незакрытые группы
-        groups = Group.objects.filter(status__in=['active', 'drawn', 'distribution'])
+        groups = Group.objects.filter(is_closed=False, status__in=Group.OPEN_STATUSES)
+        total = groups.count()
         
-        if not groups.exists():
+        if not total:
             self.stdout.write(self.style.SUCCESS('✅ Все группы уже закрыты.'))
             return
         
-        self.stdout.write(f'Найдено групп для закрытия: {groups.count()}')
-        
-        # Запускаем асинхронную функцию
-        asyncio.run(self.close_groups_async(groups))
+        if options['dry_run']:
+            # Как и при закрытии: недоступным пользователям уведомления не отправляются
+            notifications = Participant.objects.filter(group__in=groups, user__is_reachable=True).count()
+            self.stdout.write(
+                f'Будет закрыто групп: {total}\n'
+                f'Будет отправлено уведомлений: {notifications} '
+                f'(~{format_duration(notifications / GLOBAL_RATE)} при лимите {GLOBAL_RATE} сообщений/с)'
+            )
+            self.stdout.write(self.style.WARNING('Пробный запуск: ничего не изменено.'))
+            return
         
-        self.stdout.write(self.style.SUCCESS('✅ Все группы закрыты и участники уведомлены.'))
-
-    async def close_groups_async(self, groups):
-        """Асинхронное закрытие групп и уведомление участников"""
-        token = settings.TELEGRAM_BOT_TOKEN
-        if not token:
+        if not settings.TELEGRAM_BOT_TOKEN:
             self.stdout.write(self.style.ERROR('❌ Токен бота не настроен!'))
             return
         
-        bot = Bot(token=token)
+        self.stdout.write(f'🔒 Начинаю закрытие всех групп... Найдено групп для закрытия: {total}')
         
-        groups_list = await sync_to_async(list)(groups)
+        # Запускаем асинхронную функцию
+        asyncio.run(self.close_groups_async(total, options['batch_size'], options['concurrency']))
         
-        for group in groups_list:
-            # Получаем всех участников группы
-            participants = await sync_to_async(list)(
-                Participant.objects.filter(group=group).select_related('user')
-            )
-            
-            # Закрываем группу
-            group.status = 'closed'
-            group.is_closed = True
-            await sync_to_async(group.save)()
-            
-            self.stdout.write(f'Закрыта группа: {group.name} ({group.code})')
-            
-            # Уведомляем всех участников
-            for participant in participants:
-                try:
-                    message_text = (
-                        f"🔒 Группа '{group.name}' закрыта.\n\n"
-                        f"Спасибо за участие в Тайном Санте! 🎄\n"
-                        f"До встречи в следующем году! 🎅"
-                    )
-                    await bot.send_message(
-                        chat_id=participant.user.telegram_id,
-                        text=message_text
-                    )
-                    self.stdout.write(f'  ✓ Уведомлен: {participant.user.telegram_id}')
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.WARNING(f'  ✗ Ошибка уведомления {participant.user.telegram_id}: {e}')
-                    )
+        self.stdout.write(self.style.SUCCESS('✅ Все группы закрыты и участники уведомлены.'))
+
+    async def close_groups_async(self, total, batch_size, concurrency):
+        """Закрывает группы пачками и параллельно доставляет уведомления из outbox"""
+        # Соединений столько же, сколько параллельных отправок
+        bot = make_bot(settings.TELEGRAM_BOT_TOKEN, pool_size=concurrency)
+        closing = asyncio.Event()
+        stats = {'queued': 0}
+        
+        async with bot:
+            delivery = asyncio.create_task(self.deliver(bot, concurrency, closing, stats))
+            closed = 0
+            try:
+                last_id = 0
+                started = time.monotonic()
+                while True:
+                    # Одна транзакция на пачку: UPDATE групп и уведомления в outbox
+                    last_id, batch_closed, queued = await sync_to_async(close_open_groups)(last_id, batch_size)
+                    if last_id is None:
+                        break
+                    closed += batch_closed
+                    stats['queued'] += queued
+                    self.stdout.write(f'Закрыто групп: {format_progress(closed, total, started)}')
+            except BaseException:
+                # Недоставленное дошлют воркеры runbot; ждем, пока доставка остановится
+                delivery.cancel()
+                await asyncio.gather(delivery, return_exceptions=True)
+                raise
+            self.stdout.write(f'Закрыто групп: {closed}, уведомлений в очереди: {stats["queued"]}')
+            closing.set()
+            delivered = await delivery
+            self.stdout.write(f'Обработано уведомлений из очереди: {delivered}')
 
+    async def deliver(self, bot, concurrency, closing, stats):
+        """Доставляет уведомления из outbox, пока идет закрытие и пока очередь не пуста"""
+        delivered = 0
+        started = last_report = time.monotonic()
+        while True:
+            processed = await outbox.deliver_batch(bot, concurrency=concurrency)
+            delivered += processed
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                self.stdout.write(f'Доставка уведомлений: {format_progress(delivered, stats["queued"], started)}')
+                last_report = time.monotonic()
+            if not processed:
+                if closing.is_set():
+                    return delivered
+                await asyncio.sleep(0.1)
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from bot.telegram_requests import make_bot
+from bot import outbox
+from bot.broadcast import DEFAULT_CONCURRENCY
+from bot.management.commands.close_all_groups import PROGRESS_INTERVAL, format_progress
+from bot.services import delivery_stats, groups_with_undelivered, retry_undelivered
+
+
+class Command(BaseCommand):
+    help = 'Повторно отправляет только недоставленные сообщения розыгрыша и подарки'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--group',
+            help='Код группы (по умолчанию - все группы с недоставленными сообщениями)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, сколько сообщений будет отправлено повторно',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Количество параллельных отправок (с учетом лимитов Telegram)',
+            default=DEFAULT_CONCURRENCY,
+        )
+
+    def handle(self, *args, **options):
+        filters = {'code': options['group'].upper()} if options['group'] else {}
+        groups = list(groups_with_undelivered(**filters))
+        
+        if not groups:
+            self.stdout.write(self.style.SUCCESS('✅ Недоставленных сообщений нет.'))
+            return
+        
+        if options['dry_run']:
+            for group in groups:
+                stats = delivery_stats(group)
+                self.stdout.write(
+                    f"{group.name} ({group.code}): недоставлено {stats['failed']} "
+                    f"(заблокировали бота: {stats['unreachable']}), "
+                    f"результат розыгрыша получили {stats['notified']}/{stats['pairs']}, "
+                    f"подарки {stats['delivered']}/{stats['pairs']}"
+                )
+            self.stdout.write(self.style.WARNING('Пробный запуск: ничего не изменено.'))
+            return
+        
+        if not settings.TELEGRAM_BOT_TOKEN:
+            self.stdout.write(self.style.ERROR('❌ Токен бота не настроен!'))
+            return
+        
+        queued = sum(retry_undelivered(group) for group in groups)
+        self.stdout.write(f'🔁 Поставлено в очередь повторно: {queued} (групп: {len(groups)})')
+        
+        delivered = asyncio.run(self.deliver(queued, options['concurrency']))
+        self.stdout.write(f'Обработано сообщений из очереди: {delivered}')
+        
+        for group in groups:
+            stats = delivery_stats(group)
+            style = self.style.SUCCESS if not stats['failed'] else self.style.WARNING
+            self.stdout.write(style(
+                f"{group.name} ({group.code}): результат розыгрыша получили {stats['notified']}/{stats['pairs']}, "
+                f"подарки {stats['delivered']}/{stats['pairs']}, снова не доставлено {stats['failed']} "
+                f"(заблокировали бота: {stats['unreachable']})"
+            ))
+
+    async def deliver(self, total, concurrency):
+        """Доставляет очередь outbox (в том числе повторные сообщения) с параллельными отправками"""
+        # Соединений столько же, сколько параллельных отправок
+        bot = make_bot(settings.TELEGRAM_BOT_TOKEN, pool_size=concurrency)
+        delivered = 0
+        started = last_report = time.monotonic()
+        async with bot:
+            while True:
+                processed = await outbox.deliver_batch(bot, concurrency=concurrency)
+                if not processed:
+                    return delivered
+                delivered += processed
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    self.stdout.write(f'Доставка: {format_progress(delivered, total, started)}')
+                    last_report = time.monotonic()
@@ -1,10 +1,28 @@
 import os
 import asyncio
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from telegram import Update
-from telegram.ext import Application
-from bot.bot_handler import setup_handlers
+from bot.application import build_application
+from bot import outbox, sharding, webhook
+from bot.telegram_requests import PROFILES
+
+
+# Параметры HTTP-клиентов Bot API в командной строке: --<профиль>-<параметр>
+HTTP_OPTIONS = [
+    ('pool_size', int, 'размер пула соединений'),
+    ('keepalive', int, 'соединений keep-alive'),
+    ('http_version', str, 'версия HTTP: 1.1 или 2'),
+    ('connect_timeout', float, 'таймаут соединения, секунд'),
+    ('read_timeout', float, 'таймаут ответа, секунд'),
+    ('write_timeout', float, 'таймаут отправки запроса, секунд'),
+    ('pool_timeout', float, 'ожидание свободного соединения в пуле, секунд'),
+]
+PROFILE_TITLES = {
+    'updates': 'getUpdates',
+    'bot': 'ответы пользователям',
+    'broadcast': 'рассылки outbox',
+}
 
 
 class Command(BaseCommand):
@@ -17,6 +35,93 @@ class Command(BaseCommand):
             help='Telegram Bot Token',
             default=None,
         )
+        parser.add_argument(
+            '--outbox-workers',
+            type=int,
+            help='Количество воркеров доставки уведомлений из очереди',
+            default=outbox.DEFAULT_WORKERS,
+        )
+        parser.add_argument(
+            '--outbox-batch-size',
+            type=int,
+            help='Размер пачки сообщений, забираемой воркером из очереди',
+            default=outbox.DEFAULT_BATCH_SIZE,
+        )
+        parser.add_argument(
+            '--api-url',
+            type=str,
+            help='Базовый URL Bot API, например локального сервера telegram-bot-api (http://localhost:8081/bot)',
+            default=None,
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Количество процессов обработки обновлений (шардирование по пользователю); 1 - один процесс',
+            default=1,
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            help='Интервал вывода статистики воркеров в секундах (при --workers > 1)',
+            default=sharding.STATS_INTERVAL,
+        )
+        parser.add_argument(
+            '--webhook',
+            action='store_true',
+            help='Принимать обновления через webhook (ASGI-сервер вместе с админкой) вместо long polling',
+        )
+        parser.add_argument(
+            '--webhook-url',
+            type=str,
+            help='Публичный HTTPS URL webhook (по умолчанию TELEGRAM_WEBHOOK_URL)',
+            default=None,
+        )
+        parser.add_argument(
+            '--webhook-secret',
+            type=str,
+            help='Секретный токен webhook (по умолчанию TELEGRAM_WEBHOOK_SECRET или производный от токена бота)',
+            default=None,
+        )
+        parser.add_argument(
+            '--webhook-queue-size',
+            type=int,
+            help='Максимум обновлений в очереди; при переполнении Telegram получает 503 и повторит доставку',
+            default=None,
+        )
+        parser.add_argument(
+            '--host',
+            type=str,
+            help='Адрес, на котором ASGI-сервер принимает запросы в режиме webhook',
+            default='0.0.0.0',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            help='Порт ASGI-сервера в режиме webhook',
+            default=8000,
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            help='Порт HTTP-сервера метрик Prometheus (GET /metrics); 0 - не запускать. '
+                 'При --workers > 1 воркеры слушают следующие порты',
+            default=None,
+        )
+        parser.add_argument(
+            '--metrics-host',
+            type=str,
+            help='Адрес HTTP-сервера метрик (по умолчанию TELEGRAM_METRICS_HOST)',
+            default=None,
+        )
+        # Отдельные HTTP-клиенты Bot API (bot/telegram_requests.py); по умолчанию - TELEGRAM_REQUESTS
+        for profile in PROFILES:
+            for name, value_type, title in HTTP_OPTIONS:
+                parser.add_argument(
+                    f"--{profile}-{name.replace('_', '-')}",
+                    type=value_type,
+                    help=f'HTTP-клиент Bot API ({PROFILE_TITLES[profile]}): {title}',
+                    default=None,
+                )
 
     def handle(self, *args, **options):
         # Получаем токен из аргументов, переменной окружения или settings
@@ -34,15 +139,88 @@ class Command(BaseCommand):
             )
             return
         
-        self.stdout.write(self.style.SUCCESS('🤖 Запуск Telegram бота...'))
+        if options['metrics_port'] is None:
+            options['metrics_port'] = getattr(settings, 'TELEGRAM_METRICS_PORT', 0)
+        options['metrics_host'] = options['metrics_host'] or getattr(settings, 'TELEGRAM_METRICS_HOST', '127.0.0.1')
+        options['http_options'] = {
+            profile: {name: options[f'{profile}_{name}'] for name, _, _ in HTTP_OPTIONS}
+            for profile in PROFILES
+        }
         
-        # Создаем приложение бота
-        application = Application.builder().token(token).build()
+        if options['webhook']:
+            self.run_webhook(token, options)
+            return
+        
+        if options['workers'] > 1:
+            self.run_sharded(token, options)
+            return
         
-        # Настраиваем обработчики
-        setup_handlers(application)
+        self.stdout.write(self.style.SUCCESS('🤖 Запуск Telegram бота...'))
+        
+        # Создаем приложение бота с обработчиками
+        application = build_application(
+            token,
+            outbox_workers=options['outbox_workers'],
+            outbox_batch_size=options['outbox_batch_size'],
+            base_url=options['api_url'],
+            http_options=options['http_options'],
+            metrics_port=options['metrics_port'],
+            metrics_host=options['metrics_host']
+        )
         
         # Запускаем бота
         self.stdout.write(self.style.SUCCESS('✅ Бот запущен и готов к работе!'))
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    def run_sharded(self, token, options):
+        """Запускает диспетчер и процессы-воркеры с шардированием по пользователю"""
+        self.stdout.write(self.style.SUCCESS(f"🤖 Запуск Telegram бота с {options['workers']} процессами-воркерами..."))
+        runner = sharding.ShardedRunner(
+            token,
+            workers=options['workers'],
+            outbox_workers=options['outbox_workers'],
+            outbox_batch_size=options['outbox_batch_size'],
+            stats_interval=options['stats_interval'],
+            base_url=options['api_url'],
+            http_options=options['http_options'],
+            metrics_port=options['metrics_port'],
+            metrics_host=options['metrics_host'],
+            stdout=self.stdout,
+        )
+        try:
+            asyncio.run(runner.run())
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS('Бот остановлен'))
+
+    def run_webhook(self, token, options):
+        """Запускает ASGI-приложение проекта (админка + webhook бота) на uvicorn"""
+        try:
+            import uvicorn
+        except ImportError:
+            raise CommandError('Для режима webhook установите uvicorn: pip install uvicorn')
+        
+        url = options['webhook_url'] or getattr(settings, 'TELEGRAM_WEBHOOK_URL', '')
+        if not url:
+            raise CommandError('Укажите URL webhook: --webhook-url или TELEGRAM_WEBHOOK_URL')
+        
+        webhook.configure(
+            token=token,
+            url=url,
+            secret=options['webhook_secret'] or getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '') or webhook.default_secret(token),
+            queue_size=options['webhook_queue_size'] or getattr(settings, 'TELEGRAM_WEBHOOK_QUEUE_SIZE', webhook.DEFAULT_QUEUE_SIZE),
+            outbox_workers=options['outbox_workers'],
+            outbox_batch_size=options['outbox_batch_size'],
+            base_url=options['api_url'],
+            http_options=options['http_options'],
+            metrics_port=options['metrics_port'],
+            metrics_host=options['metrics_host'],
+        )
+        
+        from santagame.asgi import application
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'🤖 Запуск Telegram бота в режиме webhook: {url} '
+            f'(сервер {options["host"]}:{options["port"]})'
+        ))
+        uvicorn.run(application, host=options['host'], port=options['port'], lifespan='on')
@@ -0,0 +1,76 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from bot import synthetic
+from bot.management.commands.close_all_groups import PROGRESS_INTERVAL, format_progress
+
+
+class Command(BaseCommand):
+    help = 'Создает синтетический набор пользователей, групп, участников и розыгрышей для проверки на больших объемах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000, help='Количество пользователей')
+        parser.add_argument(
+            '--groups',
+            type=int,
+            help='Количество групп (по умолчанию - четверть пользователей; в группе в среднем ~8 участников)',
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Начальное значение генератора: тот же seed - те же данные')
+        parser.add_argument(
+            '--method',
+            choices=synthetic.METHODS,
+            default='insert',
+            help='Способ записи: INSERT пачками, bulk_create или COPY (только PostgreSQL)',
+        )
+        parser.add_argument('--batch-size', type=int, default=10000, help='Строк таблицы в одной пачке')
+        parser.add_argument('--max-group-size', type=int, default=200, help='Наибольший размер группы')
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='Удалить ранее созданный синтетический набор и выйти',
+        )
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            deleted = synthetic.delete()
+            self.stdout.write(self.style.SUCCESS(
+                '🗑 Удалено: ' + ', '.join(f'{table} {rows}' for table, rows in deleted.items())
+            ))
+            return
+
+        if synthetic.exists():
+            raise CommandError('Синтетический набор уже создан; удалите его: seed_synthetic --delete')
+        if options['method'] == 'copy' and connection.vendor != 'postgresql':
+            raise CommandError('COPY доступен только на PostgreSQL')
+
+        users = options['users']
+        groups = options['groups'] if options['groups'] is not None else users // 4
+        self.stdout.write(f'🎲 Создание набора: пользователей {users}, групп {groups}, seed {options["seed"]}')
+
+        started = time.monotonic()
+        last_report = {}
+
+        def progress(model, done, total):
+            now = time.monotonic()
+            if now - last_report.get(model, started) >= PROGRESS_INTERVAL:
+                last_report[model] = now
+                self.stdout.write(f'  {model._meta.verbose_name_plural}: {format_progress(done, total, started)}')
+
+        result = synthetic.seed(
+            users,
+            groups,
+            seed=options['seed'],
+            method=options['method'],
+            batch_size=options['batch_size'],
+            max_group_size=options['max_group_size'],
+            progress=progress,
+        )
+
+        rows = 0
+        for table, data in result['tables'].items():
+            rows += data['rows']
+            rate = data['rows'] / data['seconds'] if data['seconds'] else 0
+            self.stdout.write(f"  {table}: {data['rows']} строк, запись {data['seconds']:.1f} с ({rate:,.0f} строк/с)")
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Создано строк: {rows} за {result['seconds']:.1f} с ({rows / result['seconds']:,.0f} строк/с)"
+        ))
@@ -0,0 +1,357 @@
+"""
+Метрики бота в формате Prometheus.
+
+Счетчики и гистограммы хранятся в памяти процесса и обновляются только из
+event loop бота (обработчики, рассылка, HTTP-клиенты Bot API, итоги вызовов
+DBExecutor), поэтому блокировки не нужны: запись метрики - несколько
+операций со словарем и списком. render() читает снимки значений и может
+вызываться из другого потока (представление Django /metrics).
+
+Собираются:
+- обновления и их обработка по обработчикам: количество, ошибки,
+  гистограмма длительности и числа запросов к БД на обновление;
+- запросы к Bot API по методам: гистограмма длительности, ошибки и ответы
+  429 (flood control);
+- рассылка: отправки в процессе и результаты;
+- при каждом чтении метрик: глубина очереди outbox, число сохраненных
+  диалогов по ConversationHandler, статистика DBExecutor и кэша пользователей.
+
+Метрики отдаются представлением /metrics (santagame/urls.py) - в режиме
+webhook бот и Django работают в одном процессе - и отдельным
+HTTP-сервером внутри runbot (--metrics-port, см. start_server).
+"""
+import asyncio
+import bisect
+import functools
+import ipaddress
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.models import Count
+from telegram.ext import ConversationHandler
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        """Сумма по всем меткам"""
+        return sum(self._values.values())
+
+    def samples(self):
+        for labels, value in dict(self._values).items():
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    """Значение, которое может уменьшаться"""
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    """Гистограмма: число наблюдений по корзинам, их сумма и количество"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # метки -> [число в каждой корзине..., +Inf, сумма]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in dict(self._series).items():
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket', _format_labels(self.labels, labels, le), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labels, labels), series[-1]
+            yield f'{self.name}_count', _format_labels(self.labels, labels), cumulative
+
+
+class Registry:
+    """Метрики процесса и функции, которые добавляют значения при чтении (collectors)"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, func):
+        """Декоратор: func() возвращает [(метрика, [(значение, метки...)])] на момент чтения"""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        """Текстовый формат Prometheus"""
+        lines = []
+        families = [(metric, metric.samples()) for metric in self.metrics]
+        for collector in self.collectors:
+            for metric, values in collector():
+                families.append((metric, (
+                    (metric.name, _format_labels(metric.labels, labels), value) for value, *labels in values
+                )))
+        for metric, samples in families:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+updates_received = registry.counter('santa_updates_received_total', 'Обновлений получено')
+handler_updates = registry.counter('santa_handler_updates_total', 'Обновлений обработано', ['handler'])
+handler_errors = registry.counter('santa_handler_errors_total', 'Ошибок в обработчиках', ['handler'])
+handler_duration = registry.histogram(
+    'santa_handler_duration_seconds', 'Длительность обработчика', ['handler']
+)
+update_db_queries = registry.histogram(
+    'santa_update_db_queries', 'Запросов к БД на обновление (с middleware)', ['handler'], QUERY_BUCKETS
+)
+db_queries = registry.counter('santa_db_queries_total', 'Запросов к БД из кода бота (DBExecutor)')
+bot_api_duration = registry.histogram(
+    'santa_bot_api_request_duration_seconds', 'Длительность запроса к Bot API', ['client', 'method']
+)
+bot_api_errors = registry.counter(
+    'santa_bot_api_errors_total', 'Ошибок запросов к Bot API (ответ не 200 или сетевая ошибка)', ['client', 'method']
+)
+bot_api_retry_after = registry.counter(
+    'santa_bot_api_retry_after_total', 'Ответов 429 (flood control) от Bot API', ['client', 'method']
+)
+broadcast_in_flight = registry.gauge('santa_broadcast_in_flight', 'Сообщений рассылки в процессе отправки')
+broadcast_messages = registry.counter('santa_broadcast_messages_total', 'Результаты отправки рассылки', ['result'])
+
+_update_queries = ContextVar('update_queries', default=None)
+
+
+def start_update():
+    """Начало обработки обновления (middleware): запросы к БД считаются до конца обработки"""
+    updates_received.inc()
+    _update_queries.set([0])
+
+
+def count_db_queries(count):
+    """Итог вызова DBExecutor: запросы добавляются к общему счетчику и к текущему обновлению"""
+    if not count:
+        return
+    db_queries.inc(amount=count)
+    queries = _update_queries.get()
+    if queries is not None:
+        queries[0] += count
+
+
+def record_bot_api(client, method, duration, status=None):
+    """Запрос к Bot API: status=None - сетевая ошибка без ответа"""
+    bot_api_duration.observe(duration, client, method)
+    if status != 200:
+        bot_api_errors.inc(client, method)
+    if status == 429:
+        bot_api_retry_after.inc(client, method)
+
+
+def instrument_callback(name, callback):
+    """Обертка обработчика PTB: количество, ошибки, длительность и запросы к БД"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        handler_updates.inc(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name)
+            queries = _update_queries.get()
+            if queries is not None:
+                update_db_queries.observe(queries[0], name)
+    return wrapper
+
+
+def _instrument_handler(handler, instrument):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner, instrument)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument_handler(inner, instrument)
+        return
+    # Один обработчик может встречаться в нескольких состояниях: оборачиваем его один раз
+    applied = getattr(handler.callback, 'instrumented_by', ())
+    if instrument not in applied:
+        handler.callback = instrument(handler.callback.__name__, handler.callback)
+        handler.callback.instrumented_by = applied + (instrument,)
+
+
+def instrument_handlers(application, instrument=instrument_callback):
+    """
+    Оборачивает обработчики приложения (кроме middleware в группе -1):
+    instrument(имя, callback) возвращает новый callback
+    """
+    for group, handlers in application.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            _instrument_handler(handler, instrument)
+
+
+# Значения, которые вычисляются при чтении метрик (не регистрируются в registry.metrics)
+OUTBOX_MESSAGES = Gauge('santa_outbox_messages', 'Сообщений в outbox по статусу (очередь рассылки)', ['status'])
+CONVERSATIONS = Gauge('santa_conversations', 'Сохраненных диалогов по ConversationHandler', ['conversation'])
+DB_EXECUTOR = {
+    'calls': Counter('santa_db_executor_calls_total', 'Вызовов DBExecutor'),
+    'in_flight': Gauge('santa_db_executor_in_flight', 'Вызовов DBExecutor в процессе'),
+    'wait_p99_ms': Gauge('santa_db_executor_wait_p99_ms', 'p99 ожидания в очереди пула потоков БД, мс'),
+    'run_p99_ms': Gauge('santa_db_executor_run_p99_ms', 'p99 выполнения вызова в пуле потоков БД, мс'),
+}
+DB_CONNECTIONS = Counter('santa_db_connections_total', 'События соединений с БД (см. DBExecutor.stats)', ['event'])
+USER_CACHE = {
+    'hits': Counter('santa_user_cache_hits_total', 'Попаданий в кэш пользователей'),
+    'misses': Counter('santa_user_cache_misses_total', 'Промахов кэша пользователей'),
+    'size': Gauge('santa_user_cache_size', 'Записей в кэше пользователей'),
+}
+
+
+@registry.collector
+def _database_state():
+    from .models import ConversationState, OutboxMessage
+
+    # Отправленные не считаются: их много, а для очереди важны ожидающие и недоставленные
+    statuses = dict.fromkeys(['pending', 'failed'], 0)
+    statuses.update(
+        OutboxMessage.objects.filter(status__in=list(statuses)).order_by()
+        .values_list('status').annotate(count=Count('id'))
+    )
+    conversations = ConversationState.objects.order_by().values_list('name').annotate(count=Count('id'))
+    return [
+        (OUTBOX_MESSAGES, [(count, status) for status, count in statuses.items()]),
+        (CONVERSATIONS, [(count, name) for name, count in conversations]),
+    ]
+
+
+@registry.collector
+def _process_state():
+    from . import db
+    from .middleware import user_cache
+
+    executor = db.db_executor.stats()
+    cache = user_cache.stats()
+    return [(metric, [(executor[key],)]) for key, metric in DB_EXECUTOR.items()] + [
+        (DB_CONNECTIONS, [(count, event) for event, count in executor['connections'].items()]),
+    ] + [(metric, [(cache[key],)]) for key, metric in USER_CACHE.items()]
+
+
+def is_authorized(headers, remote_addr):
+    """
+    Доступ к метрикам: с токеном TELEGRAM_METRICS_TOKEN (Authorization: Bearer),
+    а без токена - только напрямую из локальной сети, не через прокси
+    """
+    token = getattr(settings, 'TELEGRAM_METRICS_TOKEN', '')
+    if token:
+        return headers.get('authorization') == f'Bearer {token}'
+    if 'x-forwarded-for' in headers or 'x-real-ip' in headers:
+        return False
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+
+async def _serve(reader, writer):
+    from .db import db_async
+
+    try:
+        request_line = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.decode('latin-1').split()
+        if len(parts) < 2 or parts[0] != 'GET' or parts[1].split('?')[0] != '/metrics':
+            status, body = '404 Not Found', b''
+        elif not is_authorized(headers, writer.get_extra_info('peername')[0]):
+            status, body = '403 Forbidden', b''
+        else:
+            # Метрики из БД читаются через пул потоков, как запросы обработчиков
+            status, body = '200 OK', (await db_async(registry.render)()).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(port, host='127.0.0.1'):
+    """Отдельный HTTP-сервер GET /metrics в event loop бота (runbot --metrics-port)"""
+    return await asyncio.start_server(_serve, host, port)
@@ -0,0 +1,128 @@
+"""
+Предобработка входящих обновлений.
+
+resolve_telegram_user выполняется один раз на каждое обновление до основных
+обработчиков (группа -1) и кладет пользователя в context.telegram_user.
+Пользователи кэшируются в памяти процесса (LRU с ограничением размера и
+временем жизни записи), поэтому повторные команды одного пользователя не
+обращаются к базе данных.
+"""
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+from . import metrics
+from .db import db_async
+from .models import TelegramUser
+
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 300  # секунд
+
+
+class TelegramUserCache:
+    """
+    LRU-кэш пользователей по telegram_id с временем жизни записей.
+
+    Используется только из event loop бота, поэтому блокировки не нужны.
+    Счетчики hits/misses увеличивает resolve_telegram_user.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # telegram_id -> (telegram_user, expires_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, telegram_id):
+        """Возвращает пользователя из кэша или None, если записи нет или она устарела"""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        telegram_user, expires_at = entry
+        if expires_at <= self.clock():
+            del self._entries[telegram_id]
+            return None
+        self._entries.move_to_end(telegram_id)
+        return telegram_user
+
+    def set(self, telegram_user):
+        self._entries[telegram_user.telegram_id] = (telegram_user, self.clock() + self.ttl)
+        self._entries.move_to_end(telegram_user.telegram_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """Счетчики кэша для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+user_cache = TelegramUserCache(
+    maxsize=getattr(settings, 'TELEGRAM_USER_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+    ttl=getattr(settings, 'TELEGRAM_USER_CACHE_TTL', DEFAULT_CACHE_TTL),
+)
+
+
+def upsert_telegram_user(telegram_id, username, first_name):
+    """Находит или создает пользователя и обновляет его username и имя, если они изменились"""
+    telegram_user, created = TelegramUser.objects.get_or_create(
+        telegram_id=telegram_id,
+        defaults={
+            'username': username,
+            'first_name': first_name
+        }
+    )
+    if not created and (telegram_user.username != username or telegram_user.first_name != first_name):
+        telegram_user.username = username
+        telegram_user.first_name = first_name
+        telegram_user.save(update_fields=['username', 'first_name'])
+    return telegram_user
+
+
+async def resolve_telegram_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кладет пользователя Telegram из БД (или кэша) в context.telegram_user"""
+    metrics.start_update()
+    user = update.effective_user
+    if user is None:
+        return
+
+    telegram_user = user_cache.get(user.id)
+    # Изменившийся профиль тоже считаем промахом: данные в БД нужно обновить
+    if (
+        telegram_user is not None
+        and telegram_user.username == user.username
+        and telegram_user.first_name == user.first_name
+    ):
+        user_cache.hits += 1
+    else:
+        user_cache.misses += 1
+        telegram_user = await db_async(upsert_telegram_user)(user.id, user.username, user.first_name)
+        user_cache.set(telegram_user)
+
+    context.telegram_user = telegram_user
+
+
+def setup_middleware(application):
+    """Регистрирует предобработчики в группе -1, до основных обработчиков"""
+    application.add_handler(TypeHandler(Update, resolve_telegram_user), group=-1)
@@ -0,0 +1,79 @@
+# Generated by Django 6.0 on 2026-10-17 19:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0004_outboxmessage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Exclusion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "reason",
+                    models.CharField(
+                        choices=[
+                            ("couple", "Пара"),
+                            ("previous", "Прошлый розыгрыш"),
+                            ("manual", "Вручную"),
+                        ],
+                        default="manual",
+                        max_length=20,
+                        verbose_name="Причина",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Дата создания"
+                    ),
+                ),
+                (
+                    "giver",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="exclusions_as_giver",
+                        to="bot.participant",
+                        verbose_name="Даритель",
+                    ),
+                ),
+                (
+                    "group",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="exclusions",
+                        to="bot.group",
+                        verbose_name="Группа",
+                    ),
+                ),
+                (
+                    "receiver",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="exclusions_as_receiver",
+                        to="bot.participant",
+                        verbose_name="Получатель",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Исключение розыгрыша",
+                "verbose_name_plural": "Исключения розыгрыша",
+                "unique_together": {("group", "giver", "receiver")},
+            },
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 6.0 on 2026-10-17 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0005_exclusion"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "telegram_id",
+                    models.BigIntegerField(unique=True, verbose_name="Telegram ID"),
+                ),
+                ("data", models.JSONField(default=dict, verbose_name="Данные")),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Дата изменения"),
+                ),
+            ],
+            options={
+                "verbose_name": "Данные пользователя бота",
+                "verbose_name_plural": "Данные пользователей бота",
+            },
+        ),
+        migrations.CreateModel(
+            name="ConversationState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, verbose_name="Диалог")),
+                (
+                    "key",
+                    models.CharField(
+                        help_text="JSON-список, обычно [chat_id, user_id]",
+                        max_length=100,
+                        verbose_name="Ключ диалога",
+                    ),
+                ),
+                ("state", models.JSONField(verbose_name="Состояние")),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Дата изменения"),
+                ),
+            ],
+            options={
+                "verbose_name": "Состояние диалога",
+                "verbose_name_plural": "Состояния диалогов",
+                "unique_together": {("name", "key")},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0 on 2026-10-17 19:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0006_conversation_persistence"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="draw",
+            index=models.Index(
+                fields=["receiver", "group"], name="bot_draw_receiver_group_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                fields=["owner", "status"], name="bot_group_owner_status_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                condition=models.Q(("is_closed", False)),
+                fields=["status"],
+                name="bot_group_open_status_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="participant",
+            index=models.Index(
+                fields=["user", "group"], name="bot_participant_user_group_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-17 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0007_hot_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="group",
+            name="auto_draw_error",
+            field=models.TextField(
+                blank=True,
+                help_text="Пока заполнено, планировщик не повторяет розыгрыш по дате",
+                null=True,
+                verbose_name="Ошибка автоматического розыгрыша",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                fields=["status", "draw_date"], name="bot_group_status_draw_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                condition=models.Q(("is_closed", False)),
+                fields=["close_date"],
+                name="bot_group_open_close_date_idx",
+            ),
+        ),
+    ]
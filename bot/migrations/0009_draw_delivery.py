@@ -0,0 +1,57 @@
+# Generated by Django 6.0 on 2026-10-17 20:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0008_scheduler"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="draw",
+            name="attempts",
+            field=models.PositiveIntegerField(
+                default=0, verbose_name="Попыток доставки"
+            ),
+        ),
+        migrations.AddField(
+            model_name="draw",
+            name="delivered_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Получателю доставлен подарок"
+            ),
+        ),
+        migrations.AddField(
+            model_name="draw",
+            name="last_error",
+            field=models.TextField(
+                blank=True, null=True, verbose_name="Последняя ошибка доставки"
+            ),
+        ),
+        migrations.AddField(
+            model_name="draw",
+            name="notified_at",
+            field=models.DateTimeField(
+                blank=True,
+                null=True,
+                verbose_name="Дарителю доставлен результат розыгрыша",
+            ),
+        ),
+        migrations.AddField(
+            model_name="outboxmessage",
+            name="draw",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Пара, состояние доставки которой обновляется после отправки",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="outbox_messages",
+                to="bot.draw",
+                verbose_name="Результат розыгрыша",
+            ),
+        ),
+    ]
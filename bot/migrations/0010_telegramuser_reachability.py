@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-17 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0009_draw_delivery"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="telegramuser",
+            name="is_reachable",
+            field=models.BooleanField(
+                default=True, verbose_name="Доступен для сообщений"
+            ),
+        ),
+        migrations.AddField(
+            model_name="telegramuser",
+            name="unreachable_since",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Недоступен с"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="telegramuser",
+            index=models.Index(
+                condition=models.Q(("is_reachable", False)),
+                fields=["telegram_id"],
+                name="bot_tguser_unreachable_idx",
+            ),
+        ),
+    ]
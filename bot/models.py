@@ -10,10 +10,22 @@ class TelegramUser(models.Model):
     username = models.CharField(max_length=100, blank=True, null=True, verbose_name="Username")
     first_name = models.CharField(max_length=100, blank=True, null=True, verbose_name="Имя")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    # Сбрасывается в False, когда Telegram отвечает Forbidden (бот заблокирован,
+    # аккаунт удален) или "chat not found"; снова True после /start
+    is_reachable = models.BooleanField(default=True, verbose_name="Доступен для сообщений")
+    unreachable_since = models.DateTimeField(null=True, blank=True, verbose_name="Недоступен с")
     
     class Meta:
         verbose_name = "Пользователь Telegram"
         verbose_name_plural = "Пользователи Telegram"
+        indexes = [
+            # Недоступные пользователи (рассылки их пропускают); частичный индекс - их немного
+            models.Index(
+                fields=['telegram_id'],
+                condition=models.Q(is_reachable=False),
+                name='bot_tguser_unreachable_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"{self.first_name or self.username or self.telegram_id} ({self.telegram_id})"
@@ -28,6 +40,7 @@ class Group(models.Model):
         ('distribution', 'Расдача подарков'),
         ('closed', 'Закрыта'),
     ]
+    OPEN_STATUSES = ['active', 'drawn', 'distribution']
     
     name = models.CharField(max_length=200, verbose_name="Название группы")
     code = models.CharField(max_length=20, unique=True, verbose_name="Код группы")
@@ -46,21 +59,43 @@ class Group(models.Model):
     is_closed = models.BooleanField(default=False, verbose_name="Группа закрыта")  # Оставляем для обратной совместимости
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     drawn_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата розыгрыша")
+    auto_draw_error = models.TextField(
+        blank=True,
+        null=True,
+        verbose_name="Ошибка автоматического розыгрыша",
+        help_text="Пока заполнено, планировщик не повторяет розыгрыш по дате"
+    )
     
     class Meta:
         verbose_name = "Группа"
         verbose_name_plural = "Группы"
+        indexes = [
+            # Группы владельца по статусу: /create_group, /draw, /distribute_gifts, /close_group
+            models.Index(fields=['owner', 'status'], name='bot_group_owner_status_idx'),
+            # Незакрытые группы (close_all_groups); частичный индекс там, где БД их поддерживает.
+            # Условие по is_closed, а не по status__in: SQLite применяет частичный индекс,
+            # только если условие запроса совпадает с условием индекса без параметров
+            models.Index(
+                fields=['status'],
+                condition=models.Q(is_closed=False),
+                name='bot_group_open_status_idx'
+            ),
+            # Планировщик (bot/scheduler.py): группы, у которых наступила дата розыгрыша или закрытия
+            models.Index(fields=['status', 'draw_date'], name='bot_group_status_draw_idx'),
+            models.Index(
+                fields=['close_date'],
+                condition=models.Q(is_closed=False),
+                name='bot_group_open_close_date_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.code})"
     
     @staticmethod
     def generate_code():
-        """Генерирует уникальный код группы"""
-        while True:
-            code = secrets.token_urlsafe(8).upper()[:8]
-            if not Group.objects.filter(code=code).exists():
-                return code
+        """Случайный код группы; уникальность обеспечивает вставка через bot/group_codes.py"""
+        return secrets.token_urlsafe(8).upper()[:8]
     
     def can_add_participants(self):
         """Проверяет, можно ли добавлять участников"""
@@ -103,6 +138,10 @@ class Participant(models.Model):
         verbose_name = "Участник"
         verbose_name_plural = "Участники"
         unique_together = [['group', 'user']]
+        indexes = [
+            # Участия пользователя вместе с группой (unique_together начинается с group)
+            models.Index(fields=['user', 'group'], name='bot_participant_user_group_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} в группе {self.group.name}"
@@ -129,11 +168,129 @@ class Draw(models.Model):
         verbose_name="Получатель"
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    # Состояние доставки сообщений этой пары через outbox (обновляется пачками в outbox.record_results)
+    notified_at = models.DateTimeField(null=True, blank=True, verbose_name="Дарителю доставлен результат розыгрыша")
+    delivered_at = models.DateTimeField(null=True, blank=True, verbose_name="Получателю доставлен подарок")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попыток доставки")
+    last_error = models.TextField(blank=True, null=True, verbose_name="Последняя ошибка доставки")
     
     class Meta:
         verbose_name = "Результат розыгрыша"
         verbose_name_plural = "Результаты розыгрышей"
         unique_together = [['group', 'giver']]
+        indexes = [
+            # Полученные подарки (/view_gifts): получатель вместе с группой
+            models.Index(fields=['receiver', 'group'], name='bot_draw_receiver_group_idx'),
+        ]
     
     def __str__(self):
         return f"{self.giver.name} -> {self.receiver.name} ({self.group.name})"
+
+
+class Exclusion(models.Model):
+    """Запрещенная пара розыгрыша: даритель не может дарить подарок получателю"""
+    
+    REASON_CHOICES = [
+        ('couple', 'Пара'),
+        ('previous', 'Прошлый розыгрыш'),
+        ('manual', 'Вручную'),
+    ]
+    
+    group = models.ForeignKey(
+        Group,
+        on_delete=models.CASCADE,
+        related_name="exclusions",
+        verbose_name="Группа"
+    )
+    giver = models.ForeignKey(
+        Participant,
+        on_delete=models.CASCADE,
+        related_name="exclusions_as_giver",
+        verbose_name="Даритель"
+    )
+    receiver = models.ForeignKey(
+        Participant,
+        on_delete=models.CASCADE,
+        related_name="exclusions_as_receiver",
+        verbose_name="Получатель"
+    )
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default='manual', verbose_name="Причина")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    
+    class Meta:
+        verbose_name = "Исключение розыгрыша"
+        verbose_name_plural = "Исключения розыгрыша"
+        unique_together = [['group', 'giver', 'receiver']]
+    
+    def __str__(self):
+        return f"{self.giver.name} -x-> {self.receiver.name} ({self.group.name})"
+
+class OutboxMessage(models.Model):
+    """Исходящее сообщение в очереди доставки (outbox)"""
+    
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает отправки'),
+        ('sent', 'Отправлено'),
+        ('failed', 'Ошибка отправки'),
+    ]
+    
+    idempotency_key = models.CharField(max_length=200, unique=True, verbose_name="Ключ идемпотентности")
+    chat_id = models.BigIntegerField(verbose_name="Chat ID получателя")
+    text = models.TextField(verbose_name="Текст сообщения")
+    photo_file_id = models.CharField(max_length=255, blank=True, null=True, verbose_name="Фото (file_id)")
+    parse_mode = models.CharField(max_length=20, blank=True, null=True, verbose_name="Режим разметки")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попыток отправки")
+    last_error = models.TextField(blank=True, null=True, verbose_name="Последняя ошибка")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="Следующая попытка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата отправки")
+    draw = models.ForeignKey(
+        Draw,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="outbox_messages",
+        verbose_name="Результат розыгрыша",
+        help_text="Пара, состояние доставки которой обновляется после отправки"
+    )
+    
+    class Meta:
+        verbose_name = "Исходящее сообщение"
+        verbose_name_plural = "Очередь исходящих сообщений"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='bot_outbox_status_next_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.idempotency_key} -> {self.chat_id} ({self.get_status_display()})"
+
+
+class ConversationState(models.Model):
+    """Состояние диалога ConversationHandler (персистентность бота)"""
+    name = models.CharField(max_length=100, verbose_name="Диалог")
+    key = models.CharField(max_length=100, verbose_name="Ключ диалога", help_text="JSON-список, обычно [chat_id, user_id]")
+    state = models.JSONField(verbose_name="Состояние")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата изменения")
+    
+    class Meta:
+        verbose_name = "Состояние диалога"
+        verbose_name_plural = "Состояния диалогов"
+        unique_together = [['name', 'key']]
+    
+    def __str__(self):
+        return f"{self.name} {self.key}: {self.state}"
+
+
+class UserState(models.Model):
+    """Данные пользователя между шагами диалогов (context.user_data)"""
+    telegram_id = models.BigIntegerField(unique=True, verbose_name="Telegram ID")
+    data = models.JSONField(default=dict, verbose_name="Данные")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата изменения")
+    
+    class Meta:
+        verbose_name = "Данные пользователя бота"
+        verbose_name_plural = "Данные пользователей бота"
+    
+    def __str__(self):
+        return f"{self.telegram_id}"
@@ -0,0 +1,115 @@
+"""
+Тексты массовых уведомлений участникам.
+
+Каждая функция возвращает список OutgoingMessage с ключами идемпотентности
+для очереди outbox.
+"""
+from .broadcast import OutgoingMessage
+
+
+def draw_messages(group, pairs):
+    """
+    Уведомления дарителям о результатах розыгрыша.
+
+    pairs - пары (даритель, получатель) DrawParticipant.
+    """
+    gift_via_bot_text = ""
+    if group.gift_via_bot:
+        gift_via_bot_text = "\n\n🎁 Вы можете отправить подарок боту командой /send_gift, и он сохранит его на виртуальной ёлочке до дня расдачи!"
+
+    # Общая часть текста одинакова для всех участников группы
+    description_text = f"📝 Описание подарка:\n{group.description}\n"
+    if group.gift_distribution_date:
+        description_text += f"📅 Дата расдачи: {group.gift_distribution_date.strftime('%d.%m.%Y')}\n"
+    description_text += f"{gift_via_bot_text}\n\nУдачи в выборе подарка! 🎅"
+
+    return [
+        OutgoingMessage(
+            chat_id=giver.telegram_id,
+            text=(
+                f"🎄 Розыгрыш в группе '{group.name}' проведен!\n\n"
+                f"🎁 Вы дарите подарок: <b>{receiver.name}</b>\n\n"
+                f"{description_text}"
+            ),
+            parse_mode='HTML',
+            key=f"draw:{group.id}:{giver.id}"
+        )
+        for giver, receiver in pairs
+    ]
+
+
+def gift_messages(group, draws):
+    """Подарки получателям (без указания дарителя - это Тайный Санта!)"""
+    messages = []
+    for draw_obj in draws:
+        receiver_telegram_id = draw_obj.receiver.user.telegram_id
+        key = f"gift:{group.id}:{draw_obj.receiver.id}"
+
+        if group.gift_via_bot and (draw_obj.giver.gift_message or draw_obj.giver.gift_photo_file_id):
+            if draw_obj.giver.gift_photo_file_id:
+                # Если есть фото, отправляем фото с подписью
+                message_text = "🎁 Подарок от Тайного Санты! 🎄"
+                if draw_obj.giver.gift_message:
+                    message_text += f"\n\n🎁 Ваш подарок:\n{draw_obj.giver.gift_message}"
+                message_text += "\n\nСчастливого праздника! 🎅"
+                messages.append(OutgoingMessage(
+                    chat_id=receiver_telegram_id,
+                    text=message_text,
+                    photo=draw_obj.giver.gift_photo_file_id,
+                    parse_mode='HTML',
+                    key=key,
+                    draw_id=draw_obj.id
+                ))
+            else:
+                # Если только текст без фото
+                message_text = (
+                    f"🎁 Подарок от Тайного Санты! 🎄\n\n"
+                    f"🎁 Ваш подарок:\n{draw_obj.giver.gift_message}\n\n"
+                    f"Счастливого праздника! 🎅"
+                )
+                messages.append(OutgoingMessage(
+                    chat_id=receiver_telegram_id, text=message_text, parse_mode='HTML', key=key, draw_id=draw_obj.id
+                ))
+        else:
+            # Если подарок не через бота или не отправлен
+            message_text = (
+                "🎁 Подарок от Тайного Санты! 🎄\n\n"
+                "Подарок будет в условленном месте! 🎅"
+            )
+            messages.append(OutgoingMessage(
+                chat_id=receiver_telegram_id, text=message_text, parse_mode='HTML', key=key, draw_id=draw_obj.id
+            ))
+    return messages
+
+
+def default_close_text(group):
+    """Стандартное сообщение о закрытии группы"""
+    return (
+        f"🔒 Группа '{group.name}' закрыта.\n\n"
+        f"Спасибо за участие в Тайном Санте! 🎄\n"
+        f"До встречи в следующем году! 🎅"
+    )
+
+
+def close_messages(group, chat_ids, message_text):
+    """Уведомления участникам о закрытии группы"""
+    return [
+        OutgoingMessage(chat_id=chat_id, text=message_text, key=f"close:{group.id}:{chat_id}")
+        for chat_id in chat_ids
+    ]
+
+
+def auto_draw_failed_messages(group, chat_id, error):
+    """Уведомление владельцу: автоматический розыгрыш по дате не удался"""
+    return [
+        OutgoingMessage(
+            chat_id=chat_id,
+            text=(
+                f"⚠️ Не удалось провести розыгрыш в группе '{group.name}' по дате "
+                f"{group.draw_date.strftime('%d.%m.%Y')}.\n\n"
+                f"{error}\n\n"
+                f"Исправьте причину и проведите розыгрыш командой /draw."
+            ),
+            key=f"auto-draw-failed:{group.id}"
+        )
+    ]
@@ -0,0 +1,326 @@
+"""
+Очередь исходящих сообщений (outbox) с возобновляемой доставкой.
+
+Обработчики кладут сообщения в таблицу OutboxMessage в той же транзакции,
+что и изменение состояния (розыгрыш, расдача, закрытие группы). Воркеры
+внутри процесса runbot забирают сообщения пачками и отправляют их через
+движок рассылки. После перезапуска доставка продолжается с неотправленных
+сообщений: отправленные помечаются статусом 'sent' и повторно не уходят.
+
+Если Telegram отвечает, что чат недоступен (бот заблокирован, аккаунт
+удален, чат не найден), пользователь помечается недоступным
+(TelegramUser.is_reachable). Сообщения недоступным пользователям больше не
+отправляются: claim_batch сразу помечает их недоставленными, без запроса к
+Bot API. После /start пользователь снова доступен, и владелец группы может
+повторить доставку (/retry_delivery).
+
+Пачка отправляется дольше LEASE, если Telegram просит подождать
+(RetryAfter) или отвечает медленно. Чтобы другой воркер не забрал и не
+отправил те же сообщения повторно, пока пачка отправляется, ее резерв
+продлевается каждые LEASE_RENEW_INTERVAL (keep_lease). Если процесс
+упал, продлений больше нет, и сообщения снова доступны через LEASE.
+"""
+import asyncio
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from .broadcast import DEFAULT_CONCURRENCY, OutgoingMessage, broadcast
+from .db import db_async
+from .models import Draw, OutboxMessage, TelegramUser
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 2
+POLL_INTERVAL = 5.0                  # секунд между проверками очереди без пробуждения
+LEASE = timedelta(seconds=60)        # на сколько сообщение резервируется за воркером
+LEASE_RENEW_INTERVAL = LEASE / 3     # как часто продлевается резерв пачки, пока она отправляется
+MAX_ATTEMPTS = 5                     # попыток доставки до статуса 'failed'
+RETRY_DELAY = timedelta(seconds=30)  # базовая задержка повтора, удваивается с каждой попыткой
+# Поле Draw, которое отмечает доставку, по префиксу ключа сообщения (см. notifications.py)
+DRAW_DELIVERY_FIELDS = {'draw': 'notified_at', 'gift': 'delivered_at'}
+UNREACHABLE_ERROR = 'Пользователь недоступен: бот заблокирован или чат не найден'
+
+
+def enqueue(messages):
+    """
+    Добавляет сообщения в outbox.
+
+    Вызывается внутри transaction.atomic() вместе с изменением состояния.
+    OutgoingMessage.key используется как ключ идемпотентности: повторная
+    постановка сообщения с тем же ключом игнорируется.
+    Возвращает количество переданных сообщений.
+    """
+    now = timezone.now()
+    rows = [
+        OutboxMessage(
+            idempotency_key=message.key,
+            next_attempt_at=now,
+            chat_id=message.chat_id,
+            text=message.text,
+            photo_file_id=message.photo,
+            parse_mode=message.parse_mode,
+            draw_id=message.draw_id,
+        )
+        for message in messages
+    ]
+    OutboxMessage.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+    return len(rows)
+
+
+def claim_batch(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Резервирует пачку готовых к отправке сообщений.
+
+    Резерв оформляется сдвигом next_attempt_at на LEASE вперед: другие воркеры
+    (в том числе в других процессах) не возьмут эти сообщения, а если процесс
+    упадет, сообщения снова станут доступны по истечении резерва.
+    Сообщения недоступным пользователям сразу помечаются недоставленными
+    и не возвращаются.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('id')[:batch_size]
+        )
+        if not rows:
+            return rows
+        # Один запрос по частичному индексу недоступных пользователей на пачку
+        unreachable = set(
+            TelegramUser.objects.filter(
+                is_reachable=False,
+                telegram_id__in={row.chat_id for row in rows}
+            ).values_list('telegram_id', flat=True)
+        )
+        skipped = [row for row in rows if row.chat_id in unreachable]
+        rows = [row for row in rows if row.chat_id not in unreachable]
+        if skipped:
+            OutboxMessage.objects.filter(id__in=[row.id for row in skipped]).update(
+                status='failed',
+                last_error=UNREACHABLE_ERROR
+            )
+            Draw.objects.filter(id__in=[row.draw_id for row in skipped if row.draw_id]).update(
+                last_error=UNREACHABLE_ERROR
+            )
+        if rows:
+            OutboxMessage.objects.filter(id__in=[row.id for row in rows]).update(next_attempt_at=now + LEASE)
+    return rows
+
+
+def extend_lease(ids):
+    """Продлевает резерв еще не отправленных сообщений пачки на LEASE"""
+    return OutboxMessage.objects.filter(id__in=ids, status='pending').update(
+        next_attempt_at=timezone.now() + LEASE
+    )
+
+
+async def keep_lease(ids, interval=None):
+    """Продлевает резерв пачки, пока задачу не отменят (см. deliver_batch)"""
+    interval = (interval or LEASE_RENEW_INTERVAL).total_seconds()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db_async(extend_lease)(ids)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка продления резерва outbox: {e}")
+
+
+def _is_permanent(error):
+    """Ошибки, при которых повторная отправка не поможет (Forbidden, BadRequest и т.п.)"""
+    if isinstance(error, BadRequest):
+        return True
+    return not isinstance(error, (NetworkError, RetryAfter))
+
+
+def is_unreachable(error):
+    """Ошибки, после которых пользователю нельзя писать, пока он снова не отправит /start"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+def mark_unreachable(chat_ids, now=None):
+    """Помечает пользователей недоступными; дата первой ошибки сохраняется"""
+    return TelegramUser.objects.filter(telegram_id__in=chat_ids, is_reachable=True).update(
+        is_reachable=False,
+        unreachable_since=now or timezone.now()
+    )
+
+
+def record_results(rows, results):
+    """Сохраняет результаты доставки пачки"""
+    now = timezone.now()
+    rows_by_id = {row.id: row for row in rows}
+    sent_ids = []
+    failed = []
+    unreachable = set()
+    for result in results:
+        row = rows_by_id[result.message.key]
+        if result.ok:
+            sent_ids.append(row.id)
+            continue
+        row.attempts += 1
+        row.last_error = str(result.error)[:1000]
+        if is_unreachable(result.error):
+            unreachable.add(row.chat_id)
+        if _is_permanent(result.error) or row.attempts >= MAX_ATTEMPTS:
+            row.status = 'failed'
+        else:
+            row.next_attempt_at = now + RETRY_DELAY * 2 ** (row.attempts - 1)
+        failed.append(row)
+
+    with transaction.atomic():
+        if sent_ids:
+            OutboxMessage.objects.filter(id__in=sent_ids).update(
+                status='sent',
+                sent_at=now,
+                last_error=None,
+                attempts=F('attempts') + 1
+            )
+        if failed:
+            OutboxMessage.objects.bulk_update(failed, ['status', 'attempts', 'last_error', 'next_attempt_at'])
+        _record_draw_delivery(rows_by_id, sent_ids, failed, now)
+        if unreachable:
+            mark_unreachable(unreachable, now)
+
+
+def _record_draw_delivery(rows_by_id, sent_ids, failed, now):
+    """
+    Переносит результаты доставки сообщений розыгрыша на Draw: несколько
+    UPDATE на пачку (по полю и по тексту ошибки), а не запрос на каждую пару
+    """
+    delivered = {}
+    for row_id in sent_ids:
+        row = rows_by_id[row_id]
+        field = DRAW_DELIVERY_FIELDS.get(row.idempotency_key.split(':', 1)[0])
+        if row.draw_id and field:
+            delivered.setdefault(field, []).append(row.draw_id)
+    for field, draw_ids in delivered.items():
+        Draw.objects.filter(id__in=draw_ids).update(
+            **{field: now}, attempts=F('attempts') + 1, last_error=None
+        )
+    errors = {}
+    for row in failed:
+        if row.draw_id:
+            errors.setdefault(row.last_error, []).append(row.draw_id)
+    for error, draw_ids in errors.items():
+        Draw.objects.filter(id__in=draw_ids).update(attempts=F('attempts') + 1, last_error=error)
+
+
+async def deliver_batch(bot, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Забирает и доставляет одну пачку. Возвращает количество обработанных сообщений."""
+    rows = await db_async(claim_batch)(batch_size)
+    if not rows:
+        return 0
+    # Паузы RetryAfter могут растянуть отправку пачки дольше LEASE
+    renewing = asyncio.create_task(keep_lease([row.id for row in rows]))
+    try:
+        results = await broadcast(bot, [
+            OutgoingMessage(
+                chat_id=row.chat_id,
+                text=row.text,
+                photo=row.photo_file_id,
+                parse_mode=row.parse_mode,
+                key=row.id
+            )
+            for row in rows
+        ], concurrency=concurrency)
+    finally:
+        renewing.cancel()
+        await asyncio.gather(renewing, return_exceptions=True)
+    for result in results:
+        if not result.ok:
+            print(f"Ошибка доставки сообщения {result.message.key} в чат {result.message.chat_id}: {result.error}")
+    await db_async(record_results)(rows, results)
+    return len(rows)
+
+
+async def drain(bot, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Доставляет все готовые к отправке сообщения. Возвращает их количество."""
+    total = 0
+    while True:
+        processed = await deliver_batch(bot, batch_size, concurrency)
+        if not processed:
+            return total
+        total += processed
+
+
+class OutboxWorkerPool:
+    """Пул асинхронных воркеров, разбирающих outbox внутри процесса бота"""
+
+    def __init__(self, bot, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.bot = bot
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def _run(self):
+        while True:
+            # Сбрасываем флаг до выборки, чтобы не потерять пробуждение во время нее
+            self.wakeup.clear()
+            try:
+                processed = await deliver_batch(self.bot, self.batch_size)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ошибка воркера outbox: {e}")
+                processed = 0
+            if processed:
+                continue
+            # Очередь пуста - ждем пробуждения от обработчика или следующего опроса
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+_pool = None
+_shared_wakeup = None  # multiprocessing.Event для пробуждения воркеров outbox в другом процессе
+
+
+def start_workers(bot, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE):
+    """Запускает воркеры outbox в текущем event loop"""
+    global _pool
+    _pool = OutboxWorkerPool(bot, workers=workers, batch_size=batch_size)
+    _pool.start()
+    return _pool
+
+
+async def stop_workers():
+    """Останавливает воркеры outbox"""
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        _pool = None
+
+
+def share_wakeup(event):
+    """Передавать пробуждения в другой процесс через event (см. bot/sharding.py)"""
+    global _shared_wakeup
+    _shared_wakeup = event
+
+
+def wake():
+    """Будит воркеры после постановки новых сообщений в очередь"""
+    if _pool is not None:
+        _pool.wakeup.set()
+    if _shared_wakeup is not None:
+        _shared_wakeup.set()
@@ -0,0 +1,249 @@
+"""
+Персистентность диалогов бота в базе данных Django.
+
+DjangoPersistence хранит состояния ConversationHandler (ConversationState)
+и context.user_data (UserState), поэтому перезапуск бота не прерывает
+пользователей посреди /create_group или /send_gift.
+
+Запись идет пачками: python-telegram-bot раз в update_interval секунд
+передает изменившиеся диалоги и данные пользователей, DjangoPersistence
+копит их в памяти и записывает одной транзакцией. Данные пользователя
+читаются из базы лениво, при первом обновлении от него, а при старте
+загружаются только незавершенные диалоги. Список загруженных
+пользователей ограничен (LRU размером с кэш пользователей
+TELEGRAM_USER_CACHE_SIZE): вытесненный пользователь при следующем
+обновлении снова читается из базы.
+"""
+import asyncio
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import transaction
+from telegram.ext import BasePersistence, PersistenceInput
+
+from .db import db_async
+from .models import ConversationState, UserState
+
+
+DEFAULT_UPDATE_INTERVAL = 10  # секунд между записями изменений в базу
+DEFAULT_LOADED_USERS = 10000  # пользователей, чьи данные уже прочитаны из базы
+
+
+def _encode(value):
+    """Приводит user_data к JSON: даты помечаются, кортежи становятся списками"""
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if set(value) == {'__datetime__'}:
+            return datetime.fromisoformat(value['__datetime__'])
+        if set(value) == {'__date__'}:
+            return date.fromisoformat(value['__date__'])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _conversation_key(key):
+    return json.dumps(list(key))
+
+
+class DjangoPersistence(BasePersistence):
+    """
+    BasePersistence поверх моделей ConversationState и UserState.
+
+    Хранит только диалоги и user_data (chat_data, bot_data и callback_data
+    бот не использует). Методы update_*/drop_* лишь отмечают изменения;
+    запись выполняет _write_pending, одна на все изменения очередного
+    запуска Application.update_persistence.
+
+    shard/workers - процесс-воркер (bot/sharding.py) загружает только
+    диалоги пользователей своего шарда.
+    """
+
+    def __init__(self, update_interval=DEFAULT_UPDATE_INTERVAL, shard=None, workers=1,
+                 loaded_users_size=DEFAULT_LOADED_USERS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._conversations = {}  # (name, key) -> состояние, None - диалог завершен
+        self._user_data = {}      # telegram_id -> данные, None - удалить
+        self._loaded_users = OrderedDict()  # telegram_id -> None, LRU
+        self.loaded_users_size = loaded_users_size
+        self._write_lock = asyncio.Lock()
+        self.shard = shard
+        self.workers = workers
+        self.writes = 0
+
+    # Чтение
+
+    async def get_conversations(self, name):
+        @db_async
+        def load():
+            return {
+                tuple(json.loads(key)): state
+                for key, state in ConversationState.objects.filter(name=name).values_list('key', 'state')
+            }
+        conversations = await load()
+        if self.shard is not None:
+            # Ключ диалога - (chat_id, user_id), шард выбирается по пользователю
+            conversations = {
+                key: state for key, state in conversations.items()
+                if key[-1] % self.workers == self.shard
+            }
+        return conversations
+
+    async def get_user_data(self):
+        # Все пользователи не загружаются: см. refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Загружает user_data пользователя из базы при первом обновлении от него"""
+        if user_id in self._loaded_users:
+            self._loaded_users.move_to_end(user_id)
+            return
+        self._mark_loaded(user_id)
+        # Под локом записи: база не отстает от памяти из-за идущей записи
+        async with self._write_lock:
+            if user_id in self._user_data:
+                # Незаписанные изменения новее, чем данные в базе
+                return
+            stored = await db_async(self._load_user_data)(user_id)
+        if stored:
+            user_data.update(_decode(stored))
+
+    def _mark_loaded(self, user_id):
+        self._loaded_users[user_id] = None
+        self._loaded_users.move_to_end(user_id)
+        while len(self._loaded_users) > self.loaded_users_size:
+            self._loaded_users.popitem(last=False)
+
+    @staticmethod
+    def _load_user_data(user_id):
+        return UserState.objects.filter(telegram_id=user_id).values_list('data', flat=True).first()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # Изменения
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, _conversation_key(key))] = new_state
+        await self._write_soon()
+
+    async def update_user_data(self, user_id, data):
+        self._mark_loaded(user_id)
+        # Пустые данные (диалог завершен, user_data.clear()) не храним
+        self._user_data[user_id] = _encode(data) if data else None
+        await self._write_soon()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.pop(user_id, None)
+        self._user_data[user_id] = None
+        await self._write_soon()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        await self._write_pending()
+
+    # Запись
+
+    async def _write_soon(self):
+        # Application.update_persistence вызывает update_* параллельно (asyncio.gather):
+        # пропускаем одну итерацию цикла, чтобы все они успели отметить изменения,
+        # и первая проснувшаяся корутина записывает всю пачку
+        await asyncio.sleep(0)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if not self._conversations and not self._user_data:
+                return
+            conversations, self._conversations = self._conversations, {}
+            user_data, self._user_data = self._user_data, {}
+            try:
+                await db_async(self._write)(conversations, user_data)
+            except Exception:
+                # Вернем изменения, чтобы записать их в следующий раз (более новые не затираем)
+                self._conversations = {**conversations, **self._conversations}
+                self._user_data = {**user_data, **self._user_data}
+                raise
+            self.writes += 1
+
+    @staticmethod
+    def _write(conversations, user_data):
+        with transaction.atomic():
+            ended = {}
+            for (name, key), state in conversations.items():
+                if state is None:
+                    ended.setdefault(name, []).append(key)
+            for name, keys in ended.items():
+                ConversationState.objects.filter(name=name, key__in=keys).delete()
+            ConversationState.objects.bulk_create(
+                [
+                    ConversationState(name=name, key=key, state=state)
+                    for (name, key), state in conversations.items()
+                    if state is not None
+                ],
+                update_conflicts=True,
+                unique_fields=['name', 'key'],
+                update_fields=['state', 'updated_at'],
+            )
+            dropped = [user_id for user_id, data in user_data.items() if data is None]
+            if dropped:
+                UserState.objects.filter(telegram_id__in=dropped).delete()
+            UserState.objects.bulk_create(
+                [
+                    UserState(telegram_id=user_id, data=data)
+                    for user_id, data in user_data.items()
+                    if data is not None
+                ],
+                update_conflicts=True,
+                unique_fields=['telegram_id'],
+                update_fields=['data', 'updated_at'],
+            )
+
+
+def persistence_from_settings(**kwargs):
+    """DjangoPersistence с интервалом записи из TELEGRAM_PERSISTENCE_INTERVAL"""
+    return DjangoPersistence(
+        update_interval=getattr(settings, 'TELEGRAM_PERSISTENCE_INTERVAL', DEFAULT_UPDATE_INTERVAL),
+        loaded_users_size=getattr(settings, 'TELEGRAM_USER_CACHE_SIZE', DEFAULT_LOADED_USERS),
+        **kwargs
+    )
@@ -0,0 +1,185 @@
+"""
+Профилирование обработчиков бота.
+
+Включается настройкой TELEGRAM_PROFILE_HANDLERS: setup_handlers оборачивает
+все обработчики, в том числе шаги ConversationHandler. Для каждого вызова
+обработчика измеряются:
+- полное время (wall);
+- вызовы ORM через db_async: ожидание свободного потока пула и выполнение
+  в потоке (DBExecutor), число запросов к БД и их время
+  (connection.execute_wrapper);
+- запросы к Bot API через клиенты bot/telegram_requests.py.
+Время middleware в профиль не входит: профиль начинается в обработчике.
+
+Обновления дольше TELEGRAM_SLOW_UPDATE_MS записываются в журнал
+bot.slow_updates одной строкой JSON. Доля TELEGRAM_PROFILE_SAMPLE_RATE
+обновлений выполняется под cProfile; если такое обновление оказалось
+медленным, статистика сохраняется в TELEGRAM_PROFILE_DIR (файлы .prof, см.
+python -m pstats). Для каждого обработчика хранятся только
+TELEGRAM_PROFILE_KEEP самых медленных профилей.
+
+cProfile профилирует весь поток, поэтому в профиль попадают и другие
+обновления, которые event loop выполнял в это время, а одновременно
+профилируется не больше одного обновления. Состояние профилировщика
+меняется только из event loop, поэтому блокировки не нужны.
+"""
+import cProfile
+import functools
+import json
+import logging
+import random
+import time
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+
+from .metrics import instrument_handlers
+
+
+DEFAULT_SLOW_MS = 500
+DEFAULT_SAMPLE_RATE = 0.0
+DEFAULT_KEEP = 5
+
+slow_log = logging.getLogger('bot.slow_updates')
+
+
+class UpdateProfile:
+    """Время обработки обновления по составляющим, секунд"""
+    __slots__ = ('db_calls', 'db_wait', 'db_run', 'db_queries', 'db_query_time', 'api_calls', 'api_time')
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_wait = 0.0
+        self.db_run = 0.0
+        self.db_queries = 0
+        self.db_query_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+
+
+_current = ContextVar('update_profile', default=None)
+
+
+def record_db(wait, run, executed):
+    """Итог вызова DBExecutor: executed - [(sql, секунд)] выполненных запросов"""
+    profile = _current.get()
+    if profile is not None:
+        profile.db_calls += 1
+        profile.db_wait += wait
+        profile.db_run += run
+        profile.db_queries += len(executed)
+        profile.db_query_time += sum(seconds for _, seconds in executed)
+
+
+def record_bot_api(duration):
+    """Запрос к Bot API из обработчика"""
+    profile = _current.get()
+    if profile is not None:
+        profile.api_calls += 1
+        profile.api_time += duration
+
+
+class HandlerProfiler:
+    """Обертка обработчиков: журнал медленных обновлений и выборочный cProfile"""
+
+    def __init__(
+        self,
+        slow_ms=DEFAULT_SLOW_MS,
+        sample_rate=DEFAULT_SAMPLE_RATE,
+        profile_dir=None,
+        keep=DEFAULT_KEEP,
+    ):
+        self.slow = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.keep = keep
+        self.updates = 0
+        self.slow_updates = 0
+        self._profiling = False
+        self._top = {}  # обработчик -> [(секунд, путь к .prof)], самые медленные
+
+    def wrap(self, name, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            profile = UpdateProfile()
+            token = _current.set(profile)
+            profiler = self._start_profiler()
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                wall = time.perf_counter() - started
+                _current.reset(token)
+                if profiler is not None:
+                    profiler.disable()
+                    self._profiling = False
+                self._finish(name, update, wall, profile, profiler)
+        return wrapper
+
+    def _start_profiler(self):
+        if self.profile_dir is None or self._profiling or random.random() >= self.sample_rate:
+            return None
+        self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _finish(self, name, update, wall, profile, profiler):
+        self.updates += 1
+        if wall < self.slow:
+            return
+        self.slow_updates += 1
+        record = summary(name, update, wall, profile)
+        if profiler is not None:
+            record['profile'] = self._dump(name, wall, profiler)
+        slow_log.warning(json.dumps(record, ensure_ascii=False))
+
+    def _dump(self, name, wall, profiler):
+        """Сохраняет профиль, если он среди keep самых медленных; возвращает путь или None"""
+        top = self._top.setdefault(name, [])
+        if len(top) >= self.keep and wall <= top[-1][0]:
+            return None
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profile_dir / f'{name}-{time.time_ns() // 1_000_000}.prof'
+        profiler.dump_stats(path)
+        top.append((wall, path))
+        top.sort(key=lambda item: -item[0])
+        for _, evicted in top[self.keep:]:
+            evicted.unlink(missing_ok=True)
+        del top[self.keep:]
+        return str(path)
+
+
+def summary(name, update, wall, profile):
+    """Запись журнала медленных обновлений: времена в миллисекундах"""
+    user = getattr(update, 'effective_user', None)
+    accounted = profile.db_wait + profile.db_run + profile.api_time
+    return {
+        'handler': name,
+        'update_id': getattr(update, 'update_id', None),
+        'user_id': user.id if user else None,
+        'wall_ms': round(wall * 1000, 1),
+        'db_calls': profile.db_calls,
+        'db_wait_ms': round(profile.db_wait * 1000, 1),
+        'db_run_ms': round(profile.db_run * 1000, 1),
+        'db_queries': profile.db_queries,
+        'db_query_ms': round(profile.db_query_time * 1000, 1),
+        'api_calls': profile.api_calls,
+        'api_ms': round(profile.api_time * 1000, 1),
+        # Код обработчика и event loop; параллельные вызовы могут дать больше wall
+        'other_ms': round(max(0.0, wall - accounted) * 1000, 1),
+    }
+
+
+handler_profiler = HandlerProfiler(
+    slow_ms=getattr(settings, 'TELEGRAM_SLOW_UPDATE_MS', DEFAULT_SLOW_MS),
+    sample_rate=getattr(settings, 'TELEGRAM_PROFILE_SAMPLE_RATE', DEFAULT_SAMPLE_RATE),
+    profile_dir=getattr(settings, 'TELEGRAM_PROFILE_DIR', None),
+    keep=getattr(settings, 'TELEGRAM_PROFILE_KEEP', DEFAULT_KEEP),
+)
+
+
+def profile_handlers(application, profiler=None):
+    """Оборачивает обработчики приложения профилировщиком (по умолчанию handler_profiler)"""
+    instrument_handlers(application, (profiler or handler_profiler).wrap)
@@ -0,0 +1,213 @@
+"""
+Доступ к базе данных для обработчиков бота.
+
+Обработчики не обращаются к ORM напрямую. Запросы оформлены синхронными
+функциями, а обработчики вызывают их асинхронные варианты (префикс a-):
+одна операция, даже из нескольких запросов, - один переход в поток пула
+db_executor (bot/db.py). Асинхронный API Django (aget, afirst, async for)
+не используется: он выполняет все запросы в одном общем потоке.
+"""
+from django.db import transaction
+from django.db.models import Count, Prefetch
+
+from . import group_codes
+from .db import db_async
+from .models import Draw, Group, Participant, TelegramUser
+from .services import delivery_stats, groups_with_undelivered, retry_undelivered
+
+
+def default_participant_name(telegram_user):
+    """Имя участника по умолчанию при вступлении в группу"""
+    return telegram_user.first_name or telegram_user.username or f"Участник {telegram_user.telegram_id}"
+
+
+def mark_reachable(telegram_user):
+    """
+    Снова разрешает писать пользователю после /start.
+
+    Условный UPDATE без чтения: объект из кэша middleware может не знать,
+    что доставка пометила пользователя недоступным. Возвращает True, если
+    пользователь был недоступен.
+    """
+    updated = TelegramUser.objects.filter(pk=telegram_user.pk, is_reachable=False).update(
+        is_reachable=True,
+        unreachable_since=None
+    )
+    telegram_user.is_reachable = True
+    telegram_user.unreachable_since = None
+    return bool(updated)
+
+
+amark_reachable = db_async(mark_reachable)
+
+
+def get_my_groups(telegram_user):
+    """
+    Данные для /my_groups за 3 запроса независимо от количества групп.
+
+    Возвращает (owned_groups, participations):
+    - owned_groups - группы пользователя с аннотацией participants_count;
+    - participations - участия в чужих группах с загруженной group и
+      own_draws - списком розыгрышей, где пользователь даритель (с receiver).
+    """
+    owned_groups = list(
+        Group.objects.filter(owner=telegram_user)
+        .annotate(participants_count=Count('participants'))
+        .order_by('id')
+    )
+    participations = list(
+        Participant.objects.filter(user=telegram_user)
+        .exclude(group__owner=telegram_user)
+        .select_related('group')
+        .prefetch_related(
+            Prefetch(
+                'gifts_given',
+                queryset=Draw.objects.select_related('receiver'),
+                to_attr='own_draws'
+            )
+        )
+        .order_by('id')
+    )
+    return owned_groups, participations
+
+
+aget_my_groups = db_async(get_my_groups)
+
+
+def create_group_with_owner(telegram_user, **fields):
+    """Создает группу с уникальным кодом и добавляет владельца участником"""
+    with transaction.atomic():
+        group = group_codes.create_group(owner=telegram_user, **fields)
+        Participant.objects.create(group=group, user=telegram_user, name=default_participant_name(telegram_user))
+    return group
+
+
+acreate_group_with_owner = db_async(create_group_with_owner)
+
+
+def delete_closed_group(group_id, telegram_user):
+    """
+    Удаляет закрытую группу из списка пользователя.
+
+    Владелец удаляет группу целиком, участник - только свое участие.
+    Возвращает (group, owner_deleted). Вызывает Group.DoesNotExist или
+    Participant.DoesNotExist.
+    """
+    group = Group.objects.get(id=group_id)
+    if group.owner_id == telegram_user.id:
+        group.delete()
+        return group, True
+    Participant.objects.filter(group=group, user=telegram_user).get().delete()
+    return group, False
+
+
+adelete_closed_group = db_async(delete_closed_group)
+
+
+def find_owned_group(telegram_user, statuses):
+    """Первая группа пользователя с одним из статусов или None"""
+    return Group.objects.filter(owner=telegram_user, status__in=statuses).first()
+
+
+afind_owned_group = db_async(find_owned_group)
+
+
+def get_group_by_code(code):
+    """Группа по коду. Вызывает Group.DoesNotExist."""
+    return Group.objects.get(code=code)
+
+
+aget_group_by_code = db_async(get_group_by_code)
+
+
+def get_group(group_id):
+    """Группа по id. Вызывает Group.DoesNotExist."""
+    return Group.objects.get(id=group_id)
+
+
+aget_group = db_async(get_group)
+
+
+def get_participation(participation_id):
+    """Участие по id вместе с группой"""
+    return Participant.objects.select_related('group').get(id=participation_id)
+
+
+aget_participation = db_async(get_participation)
+
+
+def list_participations(telegram_user, **filters):
+    """Участия пользователя вместе с группами, отобранные по filters"""
+    return list(
+        Participant.objects.filter(user=telegram_user, **filters)
+        .select_related('group')
+        .order_by('id')
+    )
+
+
+alist_participations = db_async(list_participations)
+
+
+def list_owned_groups(telegram_user, **filters):
+    """Группы, которыми владеет пользователь, отобранные по filters"""
+    return list(Group.objects.filter(owner=telegram_user, **filters).order_by('-created_at'))
+
+
+alist_owned_groups = db_async(list_owned_groups)
+
+
+def count_participants(group):
+    return group.participants.count()
+
+
+acount_participants = db_async(count_participants)
+
+
+def join_group(group, telegram_user):
+    """
+    Добавляет пользователя в группу.
+
+    Возвращает (participation, created); created=False, если пользователь
+    уже участник.
+    """
+    return Participant.objects.get_or_create(
+        group=group,
+        user=telegram_user,
+        defaults={'name': default_participant_name(telegram_user)}
+    )
+
+
+ajoin_group = db_async(join_group)
+
+
+def list_received_gifts(telegram_user):
+    """Розыгрыши, где пользователь получатель, в группах после расдачи подарков"""
+    return list(
+        Draw.objects.filter(
+            receiver__user=telegram_user,
+            group__status__in=['distribution', 'closed']
+        ).select_related(
+            'group',
+            'giver',
+            'giver__user'
+        ).order_by('-group__gift_distribution_date', '-group__created_at')
+    )
+
+
+alist_received_gifts = db_async(list_received_gifts)
+
+
+def retry_owned_deliveries(telegram_user):
+    """
+    Повторная доставка недоставленных сообщений розыгрыша в группах пользователя.
+
+    Возвращает список (group, поставлено в очередь, delivery_stats группы).
+    """
+    result = []
+    for group in groups_with_undelivered(owner=telegram_user):
+        queued = retry_undelivered(group)
+        result.append((group, queued, delivery_stats(group)))
+    return result
+
+
+aretry_owned_deliveries = db_async(retry_owned_deliveries)
@@ -0,0 +1,185 @@
+"""
+Автоматический розыгрыш и закрытие групп по датам.
+
+Задача JobQueue внутри runbot раз в TELEGRAM_SCHEDULER_INTERVAL секунд
+выбирает группы, у которых наступила draw_date (статус 'active') или
+close_date (группа не закрыта), и обрабатывает их пачками: проводит
+розыгрыш через services.run_draw или закрывает группу через
+services.close_group. Уведомления уходят через outbox.
+
+Группа, у которой уже наступила и дата закрытия, по дате не
+разыгрывается: иначе участники получили бы результат розыгрыша и сразу
+сообщение о закрытии (например, старые группы при первом запуске
+планировщика). Такая группа просто закрывается. Группа после розыгрыша,
+в которой раздача не проведена, перед закрытием проходит раздачу
+(services.start_distribution): подарки, отправленные боту, и сообщения
+получателям не теряются.
+
+Несколько экземпляров бота могут работать одновременно: каждая группа
+обрабатывается в своей транзакции под SELECT ... FOR UPDATE SKIP LOCKED,
+поэтому группу, которую уже обрабатывает другой экземпляр, пропускают,
+а условия на статус не дают обработать ее повторно. На SQLite блокировок
+строк нет, там запись сериализует сама база.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import outbox
+from .db import db_async
+from .models import Group
+from .notifications import auto_draw_failed_messages, default_close_text
+from .services import DrawError, close_group, run_draw, start_distribution
+
+
+DEFAULT_INTERVAL = 60     # секунд между проверками
+DEFAULT_BATCH_SIZE = 100  # групп за один запрос
+JOB_NAME = 'group-scheduler'
+
+
+def not_closing(today):
+    """Дата закрытия не наступила: такие группы еще можно разыгрывать"""
+    return Q(close_date__isnull=True) | Q(close_date__gt=today)
+
+
+def due_draws_queryset(today, batch_size=DEFAULT_BATCH_SIZE, after_id=0):
+    """
+    Активные группы, у которых наступила дата розыгрыша, но не дата
+    закрытия (индекс status, draw_date)
+    """
+    return Group.objects.filter(
+        not_closing(today),
+        status='active',
+        draw_date__lte=today,
+        auto_draw_error__isnull=True,
+        id__gt=after_id
+    ).order_by('id').values_list('id', flat=True)[:batch_size]
+
+
+def due_closes_queryset(today, batch_size=DEFAULT_BATCH_SIZE, after_id=0):
+    """Незакрытые группы, у которых наступила дата закрытия (частичный индекс по close_date)"""
+    return Group.objects.filter(
+        is_closed=False,
+        close_date__lte=today,
+        id__gt=after_id
+    ).order_by('id').values_list('id', flat=True)[:batch_size]
+
+
+def due_draws(today, batch_size=DEFAULT_BATCH_SIZE, after_id=0):
+    """id групп для розыгрыша по дате (due_draws_queryset)"""
+    return list(due_draws_queryset(today, batch_size, after_id))
+
+
+def due_closes(today, batch_size=DEFAULT_BATCH_SIZE, after_id=0):
+    """id групп для закрытия по дате (due_closes_queryset)"""
+    return list(due_closes_queryset(today, batch_size, after_id))
+
+
+def _lock_group(group_id, *conditions, **filters):
+    """Блокирует группу до конца транзакции; None, если ее держит другой экземпляр или она уже обработана"""
+    return (
+        Group.objects.select_for_update(skip_locked=True)
+        .select_related('owner')
+        .filter(*conditions, pk=group_id, **filters)
+        .first()
+    )
+
+
+def auto_draw(group_id, today):
+    """
+    Проводит розыгрыш в группе по дате.
+
+    Возвращает 'drawn', 'failed' (владелец получит уведомление, повторно
+    группа не выбирается до очистки auto_draw_error) или None, если группа
+    уже обработана.
+    """
+    with transaction.atomic():
+        group = _lock_group(
+            group_id, not_closing(today), status='active', draw_date__lte=today, auto_draw_error__isnull=True
+        )
+        if group is None:
+            return None
+        try:
+            run_draw(group)
+        except DrawError as e:
+            if not Group.objects.filter(pk=group.pk, status='active').exists():
+                return None  # розыгрыш уже провел другой экземпляр (SQLite без блокировок строк)
+            Group.objects.filter(pk=group.pk).update(auto_draw_error=str(e))
+            outbox.enqueue(auto_draw_failed_messages(group, group.owner.telegram_id, e))
+            return 'failed'
+    return 'drawn'
+
+
+def auto_close(group_id, today):
+    """
+    Закрывает группу по дате; группу после розыгрыша без раздачи сначала
+    раздает. Возвращает количество уведомлений (подарки и закрытие) или
+    None, если группа уже обработана.
+    """
+    with transaction.atomic():
+        group = _lock_group(group_id, is_closed=False, close_date__lte=today)
+        if group is None:
+            return None
+        gifts = start_distribution(group) if group.status == 'drawn' else 0
+        return gifts + close_group(group, default_close_text(group))
+
+
+async def _process(select, handle, today, batch_size):
+    # Каждая пачка и каждая группа - отдельный вызов в пуле db_executor, чтобы
+    # длинный проход не занимал поток надолго и не задерживал обработчики команд
+    results = []
+    after_id = 0
+    while True:
+        group_ids = await db_async(select)(today, batch_size, after_id)
+        for group_id in group_ids:
+            results.append(await db_async(handle)(group_id, today))
+        if len(group_ids) < batch_size:
+            return results
+        after_id = group_ids[-1]
+
+
+async def run_due(today=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Обрабатывает все группы с наступившими датами.
+
+    Сначала розыгрыши, затем закрытия. Возвращает статистику:
+    drawn, failed, closed, skipped (группы, обработанные другим экземпляром).
+    """
+    today = today or date.today()
+    draws = await _process(due_draws, auto_draw, today, batch_size)
+    closes = await _process(due_closes, auto_close, today, batch_size)
+    return {
+        'drawn': draws.count('drawn'),
+        'failed': draws.count('failed'),
+        'closed': sum(1 for result in closes if result is not None),
+        'skipped': draws.count(None) + closes.count(None),
+    }
+
+
+async def scheduler_job(context):
+    """Задача JobQueue: один проход планировщика"""
+    stats = await run_due(batch_size=context.job.data['batch_size'])
+    if stats['drawn'] or stats['failed'] or stats['closed']:
+        outbox.wake()
+        print(
+            f"Планировщик: розыгрышей {stats['drawn']}, ошибок розыгрыша {stats['failed']}, "
+            f"закрыто групп {stats['closed']}"
+        )
+
+
+def setup_scheduler(application, interval=None, batch_size=None):
+    """Регистрирует задачу планировщика в JobQueue приложения"""
+    if application.job_queue is None:
+        print('⚠️ Планировщик не запущен: установите python-telegram-bot[job-queue]')
+        return None
+    interval = interval or getattr(settings, 'TELEGRAM_SCHEDULER_INTERVAL', DEFAULT_INTERVAL)
+    batch_size = batch_size or getattr(settings, 'TELEGRAM_SCHEDULER_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    return application.job_queue.run_repeating(
+        scheduler_job,
+        interval=interval,
+        first=1,
+        name=JOB_NAME,
+        data={'batch_size': batch_size}
+    )
@@ -0,0 +1,249 @@
+"""
+Изменения состояния групп вместе с постановкой уведомлений в outbox.
+
+Все функции синхронные и выполняют изменение состояния и постановку
+уведомлений в одной транзакции: либо группа переходит в новый статус и
+все уведомления гарантированно будут доставлены, либо не меняется ничего.
+"""
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from . import outbox
+from .draw_engine import DrawInfeasible, DrawParticipant, solve_assignment
+from .models import Draw, Exclusion, Group, OutboxMessage, Participant, TelegramUser
+from .notifications import close_messages, default_close_text, draw_messages, gift_messages
+
+
+class DrawError(Exception):
+    """Розыгрыш невозможно провести"""
+
+
+def unreachable_chat_ids():
+    """Подзапрос telegram_id недоступных пользователей (по частичному индексу)"""
+    return TelegramUser.objects.filter(is_reachable=False).values('telegram_id')
+
+
+def run_draw(group, rng=None):
+    """
+    Проводит розыгрыш в группе.
+
+    Строит распределение с учетом исключений группы, сохраняет все пары одним bulk_create,
+    меняет статус группы и ставит уведомления в очередь в одной транзакции.
+    Возвращает список созданных Draw.
+    """
+    with transaction.atomic():
+        # Условное обновление защищает от повторного розыгрыша параллельной командой,
+        # а после смены статуса в группу уже нельзя вступить
+        drawn_at = timezone.now()
+        updated = Group.objects.filter(pk=group.pk, status='active').update(status='drawn', drawn_at=drawn_at)
+        if not updated:
+            raise DrawError("Розыгрыш в группе уже проведен")
+        
+        # Компактные кортежи вместо моделей: для 5000 участников это в десятки раз быстрее
+        participants = [
+            DrawParticipant(*row)
+            for row in group.participants.order_by('id').values_list('id', 'name', 'user__telegram_id')
+        ]
+        if len(participants) < 2:
+            raise DrawError("Для розыгрыша необходимо минимум 2 участника")
+        
+        # Исключения (пары, прошлогодние назначения) переводим в индексы участников
+        index_by_id = {participant.id: index for index, participant in enumerate(participants)}
+        forbidden = {}
+        for giver_id, receiver_id in Exclusion.objects.filter(group=group).values_list('giver_id', 'receiver_id'):
+            if giver_id in index_by_id and receiver_id in index_by_id:
+                forbidden.setdefault(index_by_id[giver_id], set()).add(index_by_id[receiver_id])
+        try:
+            receivers = solve_assignment(len(participants), forbidden, rng)
+        except DrawInfeasible:
+            raise DrawError("Невозможно провести розыгрыш с учетом исключений. Уменьшите количество исключений.")
+        
+        pairs = [(participants[giver], participants[receiver]) for giver, receiver in enumerate(receivers)]
+        draws = Draw.objects.bulk_create([
+            Draw(group_id=group.id, giver_id=giver.id, receiver_id=receiver.id)
+            for giver, receiver in pairs
+        ])
+        messages = draw_messages(group, pairs)
+        for message, draw in zip(messages, draws):
+            message.draw_id = draw.id
+        outbox.enqueue(messages)
+    group.status = 'drawn'
+    group.drawn_at = drawn_at
+    return draws
+
+
+def start_distribution(group):
+    """
+    Переводит группу в статус "расдача подарков" и ставит подарки в очередь.
+
+    Если дата закрытия уже наступила, группа сразу закрывается.
+    Возвращает количество подарков в очереди.
+    """
+    with transaction.atomic():
+        draws = list(
+            Draw.objects.filter(group=group).select_related('giver__user', 'receiver__user')
+        )
+        if not draws:
+            return 0
+        group.status = 'distribution'
+        # Проверяем, нужно ли автоматически закрыть группу
+        if group.close_date and group.close_date <= date.today():
+            group.status = 'closed'
+        group.save()
+        outbox.enqueue(gift_messages(group, draws))
+    return len(draws)
+
+
+def delivery_stats(group):
+    """
+    Состояние доставки сообщений розыгрыша группы.
+
+    pairs - пар, notified - дарителям доставлен результат розыгрыша,
+    delivered - получателям доставлен подарок, pending - сообщений ждут
+    отправки, failed - сообщений не доставлено (их отправит retry_undelivered),
+    unreachable - из них адресованы пользователям, заблокировавшим бота.
+    """
+    stats = Draw.objects.filter(group=group).aggregate(
+        pairs=Count('id'),
+        notified=Count('notified_at'),
+        delivered=Count('delivered_at')
+    )
+    statuses = dict(
+        OutboxMessage.objects.filter(draw__group=group, status__in=['pending', 'failed'])
+        .order_by()
+        .values_list('status')
+        .annotate(count=Count('id'))
+    )
+    stats['pending'] = statuses.get('pending', 0)
+    stats['failed'] = statuses.get('failed', 0)
+    stats['unreachable'] = OutboxMessage.objects.filter(
+        draw__group=group, status='failed', chat_id__in=unreachable_chat_ids()
+    ).count() if stats['failed'] else 0
+    return stats
+
+
+def retry_undelivered(group):
+    """
+    Повторно ставит в очередь только недоставленные сообщения розыгрыша группы.
+
+    Сообщения со статусом 'failed' снова получают статус 'pending' и полный
+    запас попыток; доставленные и еще ожидающие отправки не затрагиваются,
+    поэтому остальные участники повторных сообщений не получат. Сообщения
+    пользователям, которые все еще недоступны, остаются недоставленными.
+    Возвращает количество сообщений, поставленных в очередь.
+    """
+    return OutboxMessage.objects.filter(draw__group=group, status='failed').exclude(
+        chat_id__in=unreachable_chat_ids()
+    ).update(
+        status='pending',
+        attempts=0,
+        next_attempt_at=timezone.now()
+    )
+
+
+def groups_with_undelivered(**filters):
+    """Группы, в которых есть недоставленные сообщения розыгрыша доступным пользователям"""
+    failed = OutboxMessage.objects.filter(draw__group=OuterRef('pk'), status='failed').exclude(
+        chat_id__in=unreachable_chat_ids()
+    )
+    return Group.objects.filter(Exists(failed), **filters).order_by('id')
+
+
+def close_group(group, message_text):
+    """
+    Закрывает группу и ставит уведомления участникам в очередь.
+
+    Недоступные пользователи уведомлений не получают.
+    Возвращает количество уведомлений в очереди.
+    """
+    with transaction.atomic():
+        chat_ids = list(
+            Participant.objects.filter(group=group, user__is_reachable=True)
+            .values_list('user__telegram_id', flat=True)
+        )
+        group.status = 'closed'
+        group.is_closed = True
+        group.save()
+        outbox.enqueue(close_messages(group, chat_ids, message_text))
+    return len(chat_ids)
+
+
+def close_open_groups(after_id=0, batch_size=500, chunk_size=2000):
+    """
+    Закрывает пачку незакрытых групп с id больше after_id.
+
+    Одна транзакция на пачку: группы блокируются (SKIP LOCKED - их обрабатывает
+    другой процесс), закрываются одним UPDATE, а участники читаются потоком
+    кортежей (group_id, telegram_id) и сразу превращаются в уведомления outbox;
+    недоступные пользователи пропускаются.
+    Возвращает (id последней группы пачки или None, закрыто групп, уведомлений в очереди).
+    """
+    with transaction.atomic():
+        groups = list(
+            Group.objects.select_for_update(skip_locked=True)
+            .filter(is_closed=False, status__in=Group.OPEN_STATUSES, id__gt=after_id)
+            .order_by('id')
+            .values_list('id', 'name')[:batch_size]
+        )
+        if not groups:
+            return None, 0, 0
+        group_ids = [group_id for group_id, _ in groups]
+        closed = Group.objects.filter(id__in=group_ids).update(status='closed', is_closed=True)
+        
+        # Легкие объекты вместо загрузки групп: текстам нужны только id и название
+        groups_by_id = {group_id: Group(id=group_id, name=name) for group_id, name in groups}
+        texts = {group_id: default_close_text(group) for group_id, group in groups_by_id.items()}
+        messages = []
+        participants = (
+            Participant.objects.filter(group_id__in=group_ids, user__is_reachable=True)
+            .order_by()
+            .values_list('group_id', 'user__telegram_id')
+            .iterator(chunk_size=chunk_size)
+        )
+        for group_id, chat_id in participants:
+            messages.extend(close_messages(groups_by_id[group_id], [chat_id], texts[group_id]))
+        outbox.enqueue(messages)
+    return group_ids[-1], closed, len(messages)
+
+
+def add_couple_exclusion(group, first, second):
+    """Запрещает участникам-паре дарить подарки друг другу"""
+    Exclusion.objects.bulk_create([
+        Exclusion(group=group, giver=first, receiver=second, reason='couple'),
+        Exclusion(group=group, giver=second, receiver=first, reason='couple'),
+    ], ignore_conflicts=True)
+
+
+def exclude_previous_pairs(group):
+    """
+    Запрещает повторять назначения из предыдущего розыгрыша владельца группы.
+
+    Пары сопоставляются по пользователям Telegram, т.к. участники в каждой
+    группе свои. Возвращает количество добавленных исключений.
+    """
+    previous = (
+        Group.objects.filter(owner_id=group.owner_id, drawn_at__isnull=False)
+        .exclude(pk=group.pk)
+        .order_by('-drawn_at')
+        .first()
+    )
+    if previous is None:
+        return 0
+    participant_by_user = dict(group.participants.values_list('user_id', 'id'))
+    exclusions = [
+        Exclusion(
+            group=group,
+            giver_id=participant_by_user[giver_user_id],
+            receiver_id=participant_by_user[receiver_user_id],
+            reason='previous'
+        )
+        for giver_user_id, receiver_user_id in Draw.objects.filter(group=previous).values_list(
+            'giver__user_id', 'receiver__user_id'
+        )
+        if giver_user_id in participant_by_user and receiver_user_id in participant_by_user
+    ]
+    Exclusion.objects.bulk_create(exclusions, ignore_conflicts=True)
+    return len(exclusions)
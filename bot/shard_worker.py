@@ -0,0 +1,14 @@
+"""
+Точка входа процесса-воркера (bot/sharding.py).
+
+Процесс запускается через spawn и импортирует модуль с целью процесса до
+настройки Django. Здесь нет импортов моделей: sharding и остальные модули
+бота импортируются только после django.setup().
+"""
+
+
+def main(*args):
+    import django
+    django.setup()
+    from .sharding import worker_main
+    worker_main(*args)
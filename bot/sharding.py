@@ -0,0 +1,368 @@
+"""
+Обработка обновлений в нескольких процессах с шардированием по пользователю.
+
+Главный процесс (диспетчер) получает обновления через long polling и
+раскладывает их по N процессам-воркерам: шард = effective_user.id % N.
+Все обновления одного пользователя попадают в один воркер и обрабатываются
+по порядку, поэтому диалоги (ConversationHandler) работают как в одном
+процессе, а нагрузка распределяется по всем ядрам.
+
+Диспетчер следит за воркерами: процесс, который завершился или перестал
+отправлять heartbeat, перезапускается. Heartbeat отправляет отдельная
+задача воркера (heartbeat), а число обработанных обновлений считает
+ProcessedCounter после обработки. Рассылку из outbox выполняет только
+диспетчер; воркеры будят его через общий multiprocessing.Event.
+
+Перезапущенный воркер получает новую очередь шарда: убитый процесс обычно
+ждал в updates.get и остался владельцем лока чтения старой очереди, из нее
+больше никто не прочитает. Непрочитанные обновления переносятся из старой
+очереди в новую (drain_queue). Обновления, которые воркер уже забрал из
+очереди (обрабатываемое и не более WORKER_BUFFER_SIZE в его update_queue),
+теряются вместе с процессом.
+"""
+import asyncio
+import multiprocessing
+import os
+import pickle
+import queue
+import struct
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor, Updater
+
+from . import metrics, outbox, shard_worker
+from .telegram_requests import make_bot
+
+
+SHARD_QUEUE_SIZE = 1000     # обновлений в очереди одного шарда до ожидания диспетчера
+WORKER_BUFFER_SIZE = 1      # обновлений в update_queue воркера сверх обрабатываемого
+HEARTBEAT_INTERVAL = 1.0    # секунд между heartbeat воркера
+HEARTBEAT_TIMEOUT = 30.0    # секунд без heartbeat до перезапуска воркера
+SUPERVISE_INTERVAL = 2.0    # секунд между проверками воркеров
+STATS_INTERVAL = 60.0       # секунд между выводом статистики
+DISPATCH_RETRY_INTERVAL = 0.05  # секунд между попытками положить обновление в заполненную очередь шарда
+DRAIN_TIMEOUT = 0.5         # секунд ожидания данных из очереди убитого воркера
+STOP = None                 # сигнал воркеру завершиться
+
+
+def shard_for(update, workers):
+    """Номер воркера для обновления: по пользователю, иначе по чату"""
+    if update.effective_user is not None:
+        key = update.effective_user.id
+    elif update.effective_chat is not None:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % workers
+
+
+class ProcessedCounter(BaseUpdateProcessor):
+    """Последовательная обработка обновлений со счетчиком обработанных в общем массиве processed"""
+
+    def __init__(self, shard, processed):
+        super().__init__(1)
+        self.shard = shard
+        self.processed = processed
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            with self.processed.get_lock():
+                self.processed[self.shard] += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def drain_queue(old_queue, timeout=DRAIN_TIMEOUT):
+    """
+    Забирает непрочитанные объекты из multiprocessing.Queue, лок чтения
+    которой может держать убитый процесс: сообщения читаются прямо из канала
+    очереди, без лока (других читателей у нее уже нет). Сообщение, которое
+    убитый процесс успел прочитать частично, и все после него теряются.
+    Очередь закрывается. Возвращает (объекты, потеряно); потеряно - None,
+    если размер очереди неизвестен (macOS).
+    """
+    try:
+        expected = old_queue.qsize()
+    except NotImplementedError:
+        expected = None
+    # Формат канала multiprocessing.Connection: длина (4 байта, big-endian), затем pickle
+    reader = old_queue._reader
+    items = []
+    buffer = b''
+    try:
+        while expected is None or len(items) < expected:
+            if not reader.poll(timeout):
+                break
+            chunk = os.read(reader.fileno(), 65536)
+            if not chunk:
+                break
+            buffer += chunk
+            while len(buffer) >= 4:
+                size, = struct.unpack('!i', buffer[:4])
+                if size < 0 or len(buffer) < 4 + size:
+                    break
+                items.append(pickle.loads(buffer[4:4 + size]))
+                buffer = buffer[4 + size:]
+    except Exception:
+        # Канал сбит частичным чтением: остаток не восстановить
+        pass
+    old_queue.cancel_join_thread()
+    old_queue.close()
+    return items, None if expected is None else expected - len(items)
+
+
+async def heartbeat(shard, heartbeats, interval=HEARTBEAT_INTERVAL):
+    """
+    Отдельная задача heartbeat: воркер, который ждет места в заполненной
+    очереди update_queue, жив и продолжает отправлять heartbeat. Heartbeat
+    пропадает, только если event loop воркера заблокирован.
+    """
+    while True:
+        heartbeats[shard] = time.time()
+        await asyncio.sleep(interval)
+
+
+def worker_main(shard, workers, token, base_url, http_options, metrics, updates, processed, heartbeats, outbox_wakeup):
+    """Работа процесса-воркера; процесс запускается через shard_worker.main, который настраивает Django"""
+    try:
+        asyncio.run(_worker_loop(
+            shard, workers, token, base_url, http_options, metrics, updates, processed, heartbeats, outbox_wakeup
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(shard, workers, token, base_url, http_options, metrics, updates, processed, heartbeats, outbox_wakeup):
+    from .application import build_application, start_application, stop_application
+    from .persistence import persistence_from_settings
+
+    # Рассылкой занимается диспетчер: здесь только будим его воркеры outbox
+    application = build_application(
+        token,
+        outbox_workers=0,
+        webhook=True,
+        # Очередь в памяти воркера маленькая: ее содержимое теряется, если процесс убит
+        update_queue_size=WORKER_BUFFER_SIZE,
+        base_url=base_url,
+        http_options=http_options,
+        # Свой порт метрик у каждого воркера: (порт, адрес) или (0, адрес)
+        metrics_port=metrics[0] and metrics[0] + 1 + shard,
+        metrics_host=metrics[1],
+        persistence=persistence_from_settings(shard=shard, workers=workers),
+        # Группы по датам проверяет один воркер, а не каждый
+        scheduler=shard == 0,
+        # Обработанные обновления считаются после обработки, а не при постановке в очередь
+        concurrent_updates=ProcessedCounter(shard, processed),
+    )
+    outbox.share_wakeup(outbox_wakeup)
+    loop = asyncio.get_running_loop()
+    await start_application(application)
+    beating = asyncio.create_task(heartbeat(shard, heartbeats))
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, updates.get, True, HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                continue
+            if data is STOP:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        beating.cancel()
+        await asyncio.gather(beating, return_exceptions=True)
+        await stop_application(application)
+
+
+class ShardedRunner:
+    """Диспетчер: long polling, раздача обновлений по воркерам и их надзор"""
+
+    def __init__(self, token, workers, outbox_workers=outbox.DEFAULT_WORKERS,
+                 outbox_batch_size=outbox.DEFAULT_BATCH_SIZE, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 stats_interval=STATS_INTERVAL, base_url=None, http_options=None, metrics_port=0,
+                 metrics_host='127.0.0.1', stdout=None):
+        self.token = token
+        self.base_url = base_url
+        self.http_options = http_options
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.workers = workers
+        self.outbox_workers = outbox_workers
+        self.outbox_batch_size = outbox_batch_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stats_interval = stats_interval
+        self.stdout = stdout
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+        self.processed = self.context.Array('q', workers)
+        self.heartbeats = self.context.Array('d', workers, lock=False)
+        self.outbox_wakeup = self.context.Event()
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.lost = [0] * workers
+        self.dispatched = 0
+
+    def _log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+        else:
+            print(message)
+
+    def _start_worker(self, shard):
+        self.heartbeats[shard] = time.time()
+        process = self.context.Process(
+            target=shard_worker.main,
+            args=(
+                shard, self.workers, self.token, self.base_url, self.http_options,
+                (self.metrics_port, self.metrics_host), self.queues[shard], self.processed, self.heartbeats, self.outbox_wakeup
+            ),
+            name=f'santa-worker-{shard}',
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def _check_workers(self):
+        """Перезапускает завершившиеся и зависшие воркеры"""
+        now = time.time()
+        for shard, process in enumerate(self.processes):
+            stale = now - self.heartbeats[shard] > self.heartbeat_timeout
+            if process.is_alive() and not stale:
+                continue
+            reason = 'не отвечает' if process.is_alive() else f'завершился с кодом {process.exitcode}'
+            self._log(f"⚠️ Воркер {shard} (pid {process.pid}) {reason}, перезапуск")
+            if process.is_alive():
+                process.kill()
+            process.join(timeout=5)
+            self.restarts[shard] += 1
+            moved, lost = self._replace_queue(shard)
+            if moved or lost:
+                self._log(f"   очередь шарда {shard}: перенесено обновлений {moved}, потеряно {lost}")
+            self._start_worker(shard)
+
+    def _replace_queue(self, shard):
+        """Новая очередь шарда для перезапускаемого воркера; непрочитанное переносится в нее из старой"""
+        backlog, lost = drain_queue(self.queues[shard])
+        self.queues[shard] = self.context.Queue(SHARD_QUEUE_SIZE)
+        # В старой очереди было не больше SHARD_QUEUE_SIZE обновлений: новая пуста и вмещает все
+        for data in backlog:
+            self.queues[shard].put_nowait(data)
+        self.lost[shard] += lost or 0
+        return len(backlog), lost
+
+    def stats(self):
+        """Статистика по воркерам: обработано обновлений, очередь шарда, перезапуски"""
+        workers = []
+        for shard, process in enumerate(self.processes):
+            try:
+                queued = self.queues[shard].qsize()
+            except NotImplementedError:  # macOS
+                queued = None
+            workers.append({
+                'shard': shard,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'processed': self.processed[shard],
+                'queued': queued,
+                'restarts': self.restarts[shard],
+                'lost': self.lost[shard],
+                'heartbeat_age': time.time() - self.heartbeats[shard],
+            })
+        return {'dispatched': self.dispatched, 'workers': workers}
+
+    async def _supervise(self):
+        last_report = time.monotonic()
+        last_processed = list(self.processed)
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            self._check_workers()
+            elapsed = time.monotonic() - last_report
+            if elapsed < self.stats_interval:
+                continue
+            current = list(self.processed)
+            lines = [
+                f"  воркер {worker['shard']} (pid {worker['pid']}): "
+                f"{(current[worker['shard']] - last_processed[worker['shard']]) / elapsed:.1f} обновл./с, "
+                f"всего {worker['processed']}, в очереди {worker['queued']}, перезапусков {worker['restarts']}, "
+                f"потеряно при перезапусках {worker['lost']}"
+                for worker in self.stats()['workers']
+            ]
+            self._log(f"📊 Получено обновлений: {self.dispatched}\n" + "\n".join(lines))
+            last_report, last_processed = time.monotonic(), current
+
+    async def _forward_outbox_wakeups(self):
+        """Передает пробуждения outbox от воркеров в воркеры outbox диспетчера"""
+        while True:
+            if await asyncio.to_thread(self.outbox_wakeup.wait, 1.0):
+                self.outbox_wakeup.clear()
+                outbox.wake()
+
+    async def _dispatch(self, update_queue):
+        while True:
+            update = await update_queue.get()
+            shard = shard_for(update, self.workers)
+            data = update.to_dict()
+            while True:
+                # Очередь берется заново на каждой попытке: при перезапуске воркера она заменяется.
+                # Ожидание в event loop, а не в потоке: перенос очереди в _check_workers
+                # не пересекается с записью в нее
+                try:
+                    self.queues[shard].put_nowait(data)
+                    break
+                except queue.Full:
+                    # Воркер не успевает: ждем место, не принимая новые обновления
+                    await asyncio.sleep(DISPATCH_RETRY_INTERVAL)
+            self.dispatched += 1
+
+    async def run(self):
+        for shard in range(self.workers):
+            self._start_worker(shard)
+
+        # getUpdates и рассылка outbox диспетчера идут через свои HTTP-клиенты
+        bot = make_bot(self.token, 'broadcast', self.base_url, self.http_options)
+        update_queue = asyncio.Queue(maxsize=SHARD_QUEUE_SIZE)
+        updater = Updater(bot=bot, update_queue=update_queue)
+        await updater.initialize()
+        outbox.start_workers(bot, workers=self.outbox_workers, batch_size=self.outbox_batch_size)
+        await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        # Метрики диспетчера (getUpdates, рассылка); у воркеров - свои порты
+        metrics_server = await metrics.start_server(self.metrics_port, self.metrics_host) if self.metrics_port else None
+        self._log(f"✅ Бот запущен: {self.workers} процессов-воркеров, шардирование по пользователю")
+
+        tasks = [
+            asyncio.create_task(self._dispatch(update_queue)),
+            asyncio.create_task(self._supervise()),
+            asyncio.create_task(self._forward_outbox_wakeups()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if metrics_server is not None:
+                metrics_server.close()
+                await metrics_server.wait_closed()
+            await updater.stop()
+            await updater.shutdown()
+            await outbox.stop_workers()
+            self.shutdown_workers()
+
+    def shutdown_workers(self, timeout=10):
+        """Останавливает воркеры после обработки уже полученных обновлений"""
+        for shard_queue in self.queues:
+            try:
+                shard_queue.put(STOP, True, 1)
+            except queue.Full:
+                pass  # воркер не разбирает очередь: он будет остановлен terminate
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(timeout=max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,333 @@
+"""
+Синтетический набор данных для проверки на больших объемах.
+
+Генерирует пользователей, группы, участников и результаты розыгрыша с
+распределениями, похожими на настоящий сезон:
+- размер группы - логнормальный (медиана ~7 человек, длинный хвост до
+  max_group_size), участник - случайный пользователь, владелец - первый
+  участник; пользователь состоит в среднем в participants/users группах;
+- статусы групп по STATUS_WEIGHTS: большинство групп прошлых сезонов закрыты;
+- у групп после розыгрыша есть пары розыгрыша (цикл по перемешанным
+  участникам), у групп с подарками через бота - подарки: часть - фото,
+  часть - длинные сообщения (до лимита Telegram 4096 символов);
+- доля пользователей, заблокировавших бота.
+
+Данные полностью определяются seed: генератор не зависит от содержимого БД,
+кроме первичных ключей, которые продолжают существующие. Ключи задаются
+явно, поэтому строки разных таблиц пишутся независимо, без чтения
+созданных id обратно. Пользователи создаются с telegram_id от
+TELEGRAM_ID_BASE, коды групп - CODE_PREFIX и номер (настоящие коды -
+8 символов), по ним набор и удаляется.
+
+Способы записи:
+- insert - INSERT пачками через executemany, как в бенчмарке group_codes;
+- bulk_create - ORM; даты создания при этом заменяются текущим временем
+  (auto_now_add), а каждая строка сначала становится объектом модели;
+- copy - COPY FROM STDIN (только PostgreSQL), самый быстрый.
+Пачки таблиц пишутся в одной транзакции в порядке внешних ключей.
+"""
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Draw, Exclusion, Group, OutboxMessage, Participant, TelegramUser
+
+
+TELEGRAM_ID_BASE = 6_000_000_000
+TELEGRAM_ID_RANGE = 1_000_000_000
+CODE_PREFIX = 'SY'
+METHODS = ['insert', 'bulk_create', 'copy']
+
+STATUS_WEIGHTS = {'active': 15, 'drawn': 10, 'distribution': 5, 'closed': 70}
+GROUP_SIZE_MU = 2.0         # логнормальное распределение размера группы: медиана e^2 ~ 7
+GROUP_SIZE_SIGMA = 0.6
+MIN_GROUP_SIZE = 3
+GIFT_VIA_BOT_SHARE = 0.6
+GIFT_SENT_SHARE = {'active': 0.1, 'drawn': 0.6, 'distribution': 0.9, 'closed': 0.95}
+PHOTO_SHARE = 0.3
+UNREACHABLE_SHARE = 0.02
+USERNAME_SHARE = 0.7
+SCHEDULED_SHARE = 0.5       # доля групп с датами розыгрыша и раздачи
+SEASON_DAYS = 365           # группы созданы за последний год
+MAX_MESSAGE_LENGTH = 4096
+
+GIFT_TEXT = (
+    'С Новым годом! Пусть этот подарок принесет тепло, уют и немного волшебства. '
+    'Я долго выбирал(а), что тебе подарить, и надеюсь, что угадал(а) с цветом и размером. '
+    'Если что-то не подойдет - чек в коробке, обменять можно до конца января. '
+)
+GIFT_TEXT = (GIFT_TEXT * (MAX_MESSAGE_LENGTH // len(GIFT_TEXT) + 1))[:MAX_MESSAGE_LENGTH]
+
+USER_COLUMNS = ['id', 'telegram_id', 'username', 'first_name', 'created_at', 'is_reachable', 'unreachable_since']
+GROUP_COLUMNS = [
+    'id', 'name', 'code', 'owner_id', 'description', 'gift_via_bot', 'status', 'draw_date',
+    'gift_distribution_date', 'close_date', 'is_closed', 'created_at', 'drawn_at',
+]
+PARTICIPANT_COLUMNS = [
+    'id', 'group_id', 'user_id', 'name', 'gift_message', 'gift_photo_file_id', 'gift_sent', 'joined_at',
+]
+DRAW_COLUMNS = [
+    'id', 'group_id', 'giver_id', 'receiver_id', 'created_at', 'notified_at', 'delivered_at', 'attempts',
+]
+TABLES = [
+    (TelegramUser, USER_COLUMNS),
+    (Group, GROUP_COLUMNS),
+    (Participant, PARTICIPANT_COLUMNS),
+    (Draw, DRAW_COLUMNS),
+]
+
+
+class SyntheticDataset:
+    """Генератор строк набора: кортежи в порядке *_COLUMNS с явными первичными ключами"""
+
+    def __init__(self, users, groups, seed=1, max_group_size=200, now=None):
+        self.users = users
+        self.groups = groups
+        self.max_group_size = min(max_group_size, users)
+        self.now = now or timezone.now()
+        self._random = random.Random(seed)
+        self._statuses = list(STATUS_WEIGHTS)
+        self._status_weights = list(STATUS_WEIGHTS.values())
+        self.next_id = {}  # модель -> следующий первичный ключ
+
+    def start_ids(self):
+        """Первичные ключи продолжают существующие в БД"""
+        for model, _ in TABLES:
+            self.next_id[model] = (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        self.user_first_id = self.next_id[TelegramUser]
+
+    def _id(self, model):
+        pk = self.next_id[model]
+        self.next_id[model] = pk + 1
+        return pk
+
+    def _moment(self, days_ago_max=SEASON_DAYS):
+        return self.now - timedelta(seconds=self._random.randrange(days_ago_max * 86400))
+
+    def user_rows(self):
+        rng = self._random
+        first = self.user_first_id
+        for i in range(self.users):
+            reachable = rng.random() >= UNREACHABLE_SHARE
+            yield (
+                first + i,
+                TELEGRAM_ID_BASE + i,
+                f'synthetic_{i}' if rng.random() < USERNAME_SHARE else None,
+                f'Пользователь {i}',
+                self._moment(),
+                reachable,
+                None if reachable else self._moment(30),
+            )
+        self.next_id[TelegramUser] = first + self.users
+
+    def group_size(self):
+        size = round(self._random.lognormvariate(GROUP_SIZE_MU, GROUP_SIZE_SIGMA))
+        return max(MIN_GROUP_SIZE, min(size, self.max_group_size))
+
+    def message(self):
+        """Сообщение подарка: в основном короткие, 15% средние, 5% до лимита Telegram"""
+        rng = self._random
+        roll = rng.random()
+        if roll < 0.8:
+            length = rng.randint(10, 200)
+        elif roll < 0.95:
+            length = rng.randint(200, 1000)
+        else:
+            length = rng.randint(1000, MAX_MESSAGE_LENGTH)
+        return GIFT_TEXT[:length]
+
+    def group_rows(self, index):
+        """Группа index: (строка группы, строки участников, строки розыгрыша)"""
+        rng = self._random
+        status = rng.choices(self._statuses, self._status_weights)[0]
+        members = set()
+        size = self.group_size()
+        while len(members) < size:
+            members.add(rng.randrange(self.users))
+        members = sorted(members)
+        rng.shuffle(members)
+
+        group_id = self._id(Group)
+        created_at = self._moment()
+        gift_via_bot = rng.random() < GIFT_VIA_BOT_SHARE
+        drawn = status != 'active'
+        draw_date = distribution_date = close_date = None
+        if rng.random() < SCHEDULED_SHARE:
+            draw_date = (created_at + timedelta(days=rng.randint(3, 30))).date()
+            distribution_date = draw_date + timedelta(days=rng.randint(1, 14))
+            close_date = distribution_date + timedelta(days=1)
+        drawn_at = created_at + timedelta(days=rng.randint(1, 30)) if drawn else None
+        group = (
+            group_id, f'Группа {index}', f'{CODE_PREFIX}{index:08d}', self.user_first_id + members[0],
+            'До 1000 рублей', gift_via_bot, status, draw_date, distribution_date, close_date,
+            status == 'closed', created_at, drawn_at,
+        )
+
+        participants = []
+        for user in members:
+            message = photo = None
+            sent = gift_via_bot and rng.random() < GIFT_SENT_SHARE[status]
+            if sent:
+                if rng.random() < PHOTO_SHARE:
+                    photo = f'AgACAgIAAxkBAAI{rng.getrandbits(160):040x}'
+                    message = self.message() if rng.random() < 0.5 else None
+                else:
+                    message = self.message()
+            participants.append((
+                self._id(Participant), group_id, self.user_first_id + user, f'Пользователь {user}',
+                message, photo, sent, created_at + timedelta(seconds=rng.randrange(86400)),
+            ))
+
+        draws = []
+        if drawn:
+            # Цикл по перемешанному списку: каждый дарит следующему
+            delivered = status in ('distribution', 'closed') and gift_via_bot
+            for k, giver in enumerate(participants):
+                receiver = participants[(k + 1) % len(participants)]
+                draws.append((
+                    self._id(Draw), group_id, giver[0], receiver[0], drawn_at,
+                    drawn_at, drawn_at + timedelta(days=7) if delivered and giver[6] else None, 1,
+                ))
+        return group, participants, draws
+
+
+def _insert(model, columns, rows):
+    table = connection.ops.quote_name(model._meta.db_table)
+    names = ', '.join(connection.ops.quote_name(column) for column in columns)
+    placeholders = ', '.join(['%s'] * len(columns))
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {table} ({names}) VALUES ({placeholders})', rows)
+
+
+def _bulk_create(model, columns, rows):
+    model.objects.bulk_create([model(**dict(zip(columns, row))) for row in rows])
+
+
+def _copy(model, columns, rows):
+    table = connection.ops.quote_name(model._meta.db_table)
+    names = ', '.join(connection.ops.quote_name(column) for column in columns)
+    with connection.cursor() as cursor, cursor.copy(f'COPY {table} ({names}) FROM STDIN') as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+WRITERS = {'insert': _insert, 'bulk_create': _bulk_create, 'copy': _copy}
+
+
+class Writer:
+    """Пишет строки таблиц пачками и считает время записи по таблицам"""
+
+    def __init__(self, method='insert', batch_size=10000):
+        if method == 'copy' and connection.vendor != 'postgresql':
+            raise ValueError('COPY доступен только на PostgreSQL')
+        self.write = WRITERS[method]
+        self.batch_size = batch_size
+        self.buffers = {model: [] for model, _ in TABLES}
+        self.rows = {model: 0 for model, _ in TABLES}
+        self.seconds = {model: 0.0 for model, _ in TABLES}
+
+    def add(self, model, rows):
+        self.buffers[model].extend(rows)
+
+    def full(self):
+        return any(len(rows) >= self.batch_size for rows in self.buffers.values())
+
+    def flush(self):
+        """Одна транзакция на пачку: сначала таблицы, на которые ссылаются остальные"""
+        with transaction.atomic():
+            for model, columns in TABLES:
+                rows = self.buffers[model]
+                if not rows:
+                    continue
+                started = time.perf_counter()
+                self.write(model, columns, rows)
+                self.seconds[model] += time.perf_counter() - started
+                self.rows[model] += len(rows)
+                self.buffers[model] = []
+
+
+def seed(users, groups, seed=1, method='insert', batch_size=10000, max_group_size=200, progress=None):
+    """
+    Создает набор; progress(таблица, создано, всего) вызывается после каждой пачки.
+    Возвращает {таблица: (строк, секунд записи)} и общее время.
+    """
+    if users > TELEGRAM_ID_RANGE:
+        raise ValueError(f'Не больше {TELEGRAM_ID_RANGE} пользователей')
+    dataset = SyntheticDataset(users, groups, seed=seed, max_group_size=max_group_size)
+    writer = Writer(method, batch_size)
+    started = time.perf_counter()
+    dataset.start_ids()
+
+    for row in dataset.user_rows():
+        writer.add(TelegramUser, [row])
+        if writer.full():
+            writer.flush()
+            if progress:
+                progress(TelegramUser, writer.rows[TelegramUser], users)
+    writer.flush()
+
+    for index in range(groups):
+        group, participants, draws = dataset.group_rows(index)
+        writer.add(Group, [group])
+        writer.add(Participant, participants)
+        writer.add(Draw, draws)
+        if writer.full():
+            writer.flush()
+            if progress:
+                progress(Group, writer.rows[Group], groups)
+    writer.flush()
+
+    if connection.vendor == 'postgresql':
+        # Ключи заданы явно: последовательности id нужно сдвинуть за них
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model for model, _ in TABLES]):
+                cursor.execute(sql)
+    return {
+        'tables': {
+            model._meta.db_table: {'rows': writer.rows[model], 'seconds': writer.seconds[model]}
+            for model, _ in TABLES
+        },
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def exists():
+    return TelegramUser.objects.filter(
+        telegram_id__gte=TELEGRAM_ID_BASE, telegram_id__lt=TELEGRAM_ID_BASE + TELEGRAM_ID_RANGE
+    ).exists()
+
+
+def delete():
+    """
+    Удаляет набор сырым SQL, без каскада через ORM: он загрузил бы все строки.
+    Возвращает {таблица: удалено строк}.
+    """
+    quote = connection.ops.quote_name
+    users = (
+        f'SELECT id FROM {quote(TelegramUser._meta.db_table)} '
+        f'WHERE telegram_id >= %s AND telegram_id < %s'
+    )
+    groups = f'SELECT id FROM {quote(Group._meta.db_table)} WHERE owner_id IN ({users})'
+    draws = f'SELECT id FROM {quote(Draw._meta.db_table)} WHERE group_id IN ({groups})'
+    bounds = [TELEGRAM_ID_BASE, TELEGRAM_ID_BASE + TELEGRAM_ID_RANGE]
+    statements = [
+        (OutboxMessage, f'UPDATE {quote(OutboxMessage._meta.db_table)} SET draw_id = NULL WHERE draw_id IN ({draws})'),
+        (Draw, f'DELETE FROM {quote(Draw._meta.db_table)} WHERE group_id IN ({groups})'),
+        (Exclusion, f'DELETE FROM {quote(Exclusion._meta.db_table)} WHERE group_id IN ({groups})'),
+        (Participant, f'DELETE FROM {quote(Participant._meta.db_table)} WHERE group_id IN ({groups})'),
+        (Group, f'DELETE FROM {quote(Group._meta.db_table)} WHERE owner_id IN ({users})'),
+        (TelegramUser, f'DELETE FROM {quote(TelegramUser._meta.db_table)} WHERE telegram_id >= %s AND telegram_id < %s'),
+    ]
+    deleted = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model, sql in statements:
+            cursor.execute(sql, bounds)
+            if model is not OutboxMessage:
+                table = model._meta.db_table
+                deleted[table] = deleted.get(table, 0) + cursor.rowcount
+    return deleted
@@ -0,0 +1,155 @@
+"""
+HTTP-клиенты Bot API с отдельными пулами соединений.
+
+По умолчанию python-telegram-bot отправляет все запросы бота через один
+HTTPXRequest: ответы пользователям и массовая рассылка делят общий пул на
+256 соединений с keep-alive по умолчанию httpx (20 соединений). httpcore
+закрывает простаивающее соединение, как только всего соединений в пуле
+больше max_keepalive_connections, поэтому при рассылке соединения
+постоянно переоткрываются, каждый раз с TLS-рукопожатием. Кроме того,
+учет соединений в пуле httpcore квадратичен по их числу, и большой пул
+тратит заметно больше CPU.
+
+Здесь запросы разделены по профилям, у каждого свой HTTPXRequest:
+- updates - получение обновлений (getUpdates, long polling);
+- bot - ответы пользователям из обработчиков (application.bot);
+- broadcast - рассылки outbox (отдельный экземпляр Bot у воркеров outbox,
+  а также команд close_all_groups и retry_delivery).
+
+Размер пула подобран под конкурентность (рассылка - DEFAULT_WORKERS
+воркеров outbox по DEFAULT_CONCURRENCY отправок), keep-alive равен размеру
+пула. Для каждого профиля настраиваются размер пула, число соединений keep-alive
+и время их жизни, версия HTTP (2 - нужен пакет h2:
+pip install "python-telegram-bot[http2]") и таймауты операций (отправка
+фото - media_write_timeout). Значения по умолчанию - DEFAULT_REQUESTS,
+они переопределяются settings.TELEGRAM_REQUESTS (переменные окружения
+TELEGRAM_<ПРОФИЛЬ>_<ПАРАМЕТР>) и параметрами runbot.
+
+Длительность и ошибки запросов каждого клиента записываются в метрики
+(bot/metrics.py) с меткой профиля и в профиль обработчика (bot/profiling.py).
+"""
+import time
+
+import httpx
+from django.conf import settings
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from . import metrics, profiling
+
+
+PROFILES = ['updates', 'bot', 'broadcast']
+
+DEFAULT_REQUESTS = {
+    # Одно долгое соединение getUpdates; к read_timeout PTB сам добавляет timeout опроса
+    'updates': {
+        'pool_size': 1,
+        'keepalive': 1,
+        'keepalive_expiry': 30.0,
+        'http_version': '1.1',
+        'connect_timeout': 5.0,
+        'read_timeout': 5.0,
+        'write_timeout': 5.0,
+        'media_write_timeout': 20.0,
+        'pool_timeout': 1.0,
+    },
+    # Ответы пользователям: короткие таймауты, чтобы зависший запрос не держал обработчик
+    'bot': {
+        'pool_size': 16,
+        'keepalive': 16,
+        'keepalive_expiry': 30.0,
+        'http_version': '1.1',
+        'connect_timeout': 5.0,
+        'read_timeout': 5.0,
+        'write_timeout': 5.0,
+        'media_write_timeout': 20.0,
+        'pool_timeout': 1.0,
+    },
+    # Рассылки: все соединения остаются открытыми между пачками, а отправка
+    # скорее подождет свободное соединение, чем завершится ошибкой
+    'broadcast': {
+        'pool_size': 48,
+        'keepalive': 48,
+        'keepalive_expiry': 30.0,
+        'http_version': '1.1',
+        'connect_timeout': 5.0,
+        'read_timeout': 10.0,
+        'write_timeout': 10.0,
+        'media_write_timeout': 20.0,
+        'pool_timeout': 30.0,
+    },
+}
+
+
+def request_options(profile, overrides=None):
+    """
+    Параметры профиля: DEFAULT_REQUESTS, затем settings.TELEGRAM_REQUESTS,
+    затем overrides ({профиль: {параметр: значение}}, например из runbot).
+    Пустые значения пропускаются, строки приводятся к типу значения по умолчанию.
+    """
+    options = dict(DEFAULT_REQUESTS[profile])
+    for source in (getattr(settings, 'TELEGRAM_REQUESTS', {}), overrides or {}):
+        for name, value in (source.get(profile) or {}).items():
+            if name not in options:
+                raise ValueError(f"Неизвестный параметр HTTP-клиента {profile}: {name}")
+            if value is not None and value != '':
+                options[name] = type(DEFAULT_REQUESTS[profile][name])(value)
+    return options
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который записывает длительность, ошибки и ответы 429 по методам Bot API"""
+
+    def __init__(self, profile, **kwargs):
+        super().__init__(**kwargs)
+        self.profile = profile
+
+    async def do_request(self, url, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = None
+        try:
+            status, payload = await super().do_request(url, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            metrics.record_bot_api(self.profile, api_method, duration, status)
+            profiling.record_bot_api(duration)
+        return status, payload
+
+
+def build_request(profile, overrides=None):
+    """HTTPXRequest для профиля"""
+    options = request_options(profile, overrides)
+    return InstrumentedRequest(
+        profile,
+        connection_pool_size=options['pool_size'],
+        http_version=options['http_version'],
+        connect_timeout=options['connect_timeout'],
+        read_timeout=options['read_timeout'],
+        write_timeout=options['write_timeout'],
+        media_write_timeout=options['media_write_timeout'],
+        pool_timeout=options['pool_timeout'],
+        # HTTPXRequest задает только max_connections; keep-alive настраиваем сами
+        httpx_kwargs={'limits': httpx.Limits(
+            max_connections=options['pool_size'],
+            max_keepalive_connections=options['keepalive'],
+            keepalive_expiry=options['keepalive_expiry'],
+        )},
+    )
+
+
+def make_bot(token, profile='broadcast', base_url=None, overrides=None, pool_size=None):
+    """
+    Отдельный экземпляр Bot с HTTP-клиентом профиля (getUpdates - через профиль updates).
+    pool_size - размер пула и keep-alive вместо настроенных, например по --concurrency команды.
+    """
+    if pool_size:
+        overrides = {**(overrides or {})}
+        overrides[profile] = {**overrides.get(profile, {}), 'pool_size': pool_size, 'keepalive': pool_size}
+    kwargs = {'base_url': base_url} if base_url else {}
+    return Bot(
+        token,
+        request=build_request(profile, overrides),
+        get_updates_request=build_request('updates', overrides),
+        **kwargs
+    )
@@ -1,3 +1,1411 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.test import TestCase, override_settings, tag
+
+from telegram import Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from bot import broadcast, db, draw_engine, group_codes, metrics, middleware, outbox, profiling, queries, scheduler, services, sharding, telegram_requests, webhook
+from bot.admin import ParticipantAdmin
+from bot.application import build_application, start_application, stop_application
+from bot.benchmarks import loadtest
+from bot.bot_handler import build_my_groups_message
+from bot.management.commands import close_all_groups
+from bot.broadcast import DeliveryResult, OutgoingMessage
+from bot.fake_bot_api import BOT_TOKEN, FakeBotAPI, FakeBotAPIServer, make_text_update
+from bot.middleware import user_cache
+from bot.models import ConversationState, Draw, Exclusion, Group, OutboxMessage, Participant, TelegramUser, UserState
+from bot.persistence import DjangoPersistence
+
+
+def setUpModule():
+    # TestCase хранит данные в незавершенной транзакции соединения основного
+    # потока: запросы бота должны выполняться в нем, а не в потоках пула
+    patcher = mock.patch.object(db, 'db_executor', db.DBExecutor(threads=0))
+    patcher.start()
+    unittest.addModuleCleanup(patcher.stop)
+
+
+class _Lifespan:
+    """Драйвер ASGI lifespan для тестов"""
+
+    def __init__(self, app):
+        self.app = app
+        self.messages = asyncio.Queue()
+        self.sent = asyncio.Queue()
+
+    async def _send(self, message):
+        await self.sent.put(message)
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.app({'type': 'lifespan'}, self.messages.get, self._send))
+        await self.messages.put({'type': 'lifespan.startup'})
+        message = await self.sent.get()
+        assert message['type'] == 'lifespan.startup.complete', message
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.messages.put({'type': 'lifespan.shutdown'})
+        await self.task
+
+
+async def _post(app, path, body, secret=None):
+    """POST-запрос к ASGI-приложению, возвращает статус ответа"""
+    headers = [(b'content-type', b'application/json')]
+    if secret is not None:
+        headers.append((b'x-telegram-bot-api-secret-token', secret.encode()))
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'headers': headers, 'query_string': b''}
+    chunks = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    responses = []
+
+    async def receive():
+        return chunks.pop(0) if chunks else {'type': 'http.disconnect'}
+
+    async def send(message):
+        responses.append(message)
+
+    await app(scope, receive, send)
+    return responses[0]['status']
+
+
+class WebhookTest(TestCase):
+    """Webhook-режим поверх ASGI-приложения с фейковым Bot API"""
+
+    def setUp(self):
+        user_cache.clear()
+        self.api = FakeBotAPI()
+        self.config = webhook.configure(
+            token=BOT_TOKEN,
+            url='https://example.com/telegram/webhook/',
+            secret='test-secret',
+            queue_size=2,
+            outbox_workers=0,
+            request=self.api,
+        )
+
+    def tearDown(self):
+        webhook._config = None
+
+    async def _not_found_app(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _wait_for_reply(self, chat_id, timeout=5):
+        for _ in range(int(timeout / 0.05)):
+            if self.api.sent_messages(chat_id):
+                return self.api.sent_messages(chat_id)
+            await asyncio.sleep(0.05)
+        self.fail(f'Бот не ответил в чат {chat_id}')
+
+    async def test_update_is_processed(self):
+        app = webhook.WebhookASGI(self._not_found_app)
+        async with _Lifespan(app):
+            set_webhook = [params for method, params in self.api.calls if method == 'setWebhook']
+            self.assertEqual(set_webhook[0]['url'], self.config.url)
+            self.assertEqual(set_webhook[0]['secret_token'], 'test-secret')
+
+            body = json.dumps(make_text_update(555, '/start')).encode()
+            status = await _post(app, self.config.path, body, secret='test-secret')
+            self.assertEqual(status, 200)
+
+            replies = await self._wait_for_reply(555)
+            self.assertIn('Добро пожаловать', replies[0]['text'])
+        self.assertTrue(await TelegramUser.objects.filter(telegram_id=555).aexists())
+
+    def test_secret_from_settings_is_same_in_every_process(self):
+        with override_settings(TELEGRAM_WEBHOOK_URL='https://example.com/telegram/webhook/', TELEGRAM_WEBHOOK_SECRET=''), \
+                mock.patch.dict(os.environ, {'TELEGRAM_BOT_TOKEN': BOT_TOKEN}):
+            first = webhook.config_from_settings()
+            second = webhook.config_from_settings()
+        self.assertEqual(first.secret, second.secret)
+        self.assertEqual(first.secret, webhook.default_secret(BOT_TOKEN))
+        self.assertNotEqual(first.secret, webhook.default_secret(BOT_TOKEN + 'x'))
+        # Telegram принимает секрет из символов A-Z, a-z, 0-9, _ и - длиной до 256
+        self.assertRegex(first.secret, r'^[A-Za-z0-9_-]{1,256}$')
+
+        with override_settings(TELEGRAM_WEBHOOK_URL='https://example.com/telegram/webhook/', TELEGRAM_WEBHOOK_SECRET='configured'), \
+                mock.patch.dict(os.environ, {'TELEGRAM_BOT_TOKEN': BOT_TOKEN}):
+            self.assertEqual(webhook.config_from_settings().secret, 'configured')
+
+    async def test_wrong_secret_is_rejected(self):
+        app = webhook.WebhookASGI(self._not_found_app)
+        async with _Lifespan(app):
+            body = json.dumps(make_text_update(556, '/start')).encode()
+            self.assertEqual(await _post(app, self.config.path, body), 403)
+            self.assertEqual(await _post(app, self.config.path, body, secret='wrong'), 403)
+            self.assertEqual(await _post(app, self.config.path, b'not json', secret='test-secret'), 400)
+            # Остальные пути обслуживает Django
+            self.assertEqual(await _post(app, '/admin/', body, secret='test-secret'), 404)
+        self.assertEqual(app.rejected, 2)
+        self.assertEqual(self.api.sent_messages(556), [])
+
+    async def test_full_queue_returns_503(self):
+        app = webhook.WebhookASGI(self._not_found_app)
+        async with _Lifespan(app):
+            # Останавливаем разбор очереди, чтобы она заполнилась
+            await app.application.stop()
+            statuses = [
+                await _post(app, self.config.path, json.dumps(make_text_update(557, '/help')).encode(), secret='test-secret')
+                for _ in range(3)
+            ]
+        self.assertEqual(statuses, [200, 200, 503])
+        self.assertEqual(app.overflow, 1)
+
+
+class PersistenceTest(TestCase):
+    """Диалоги продолжаются после перезапуска бота"""
+
+    def setUp(self):
+        user_cache.clear()
+
+    async def _run(self, user_id, texts):
+        """Запускает бота, обрабатывает сообщения и останавливает его; возвращает ответы"""
+        api = FakeBotAPI()
+        application = build_application(
+            BOT_TOKEN, outbox_workers=0, webhook=True, request=api,
+            persistence=DjangoPersistence(update_interval=60)
+        )
+        await start_application(application)
+        for text in texts:
+            await application.update_queue.put(Update.de_json(make_text_update(user_id, text), application.bot))
+            await application.update_queue.join()
+        await stop_application(application)
+        return [message['text'] for message in api.sent_messages(user_id)]
+
+    async def test_conversation_survives_restart(self):
+        await self._run(600, ['/create_group', 'Офис', 'Книга', 'да', '25.12.2030'])
+        # Изменения записаны при остановке одной пачкой
+        state = await ConversationState.objects.aget(name='create_group')
+        self.assertEqual(state.key, '[600, 600]')
+        user_state = await UserState.objects.aget(telegram_id=600)
+        self.assertEqual(user_state.data['draw_date'], {'__date__': '2030-12-25'})
+
+        replies = await self._run(600, ['27.12.2030', 'пропустить'])
+        self.assertIn('успешно создана', replies[-2])
+        group = await Group.objects.aget(owner__telegram_id=600)
+        self.assertEqual(str(group.draw_date), '2030-12-25')
+        # Завершенный диалог и пустые user_data удаляются из базы
+        self.assertFalse(await ConversationState.objects.aexists())
+        self.assertFalse(await UserState.objects.aexists())
+
+    async def test_loaded_users_are_bounded(self):
+        persistence = DjangoPersistence(update_interval=60, loaded_users_size=2)
+        await UserState.objects.acreate(telegram_id=1, data={'step': 'name'})
+        for user_id in (1, 2, 3):
+            await persistence.refresh_user_data(user_id, {})
+        self.assertEqual(list(persistence._loaded_users), [2, 3])
+
+        # Вытесненный пользователь снова читается из базы
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {'step': 'name'})
+        self.assertEqual(list(persistence._loaded_users), [3, 1])
+
+        # Незаписанные изменения не затираются старыми данными из базы
+        user_data = {'step': 'date'}
+        await persistence.update_user_data(1, user_data)
+        for user_id in (4, 5):
+            await persistence.refresh_user_data(user_id, {})
+        self.assertNotIn(1, persistence._loaded_users)
+        await persistence.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {'step': 'date'})
+
+        await persistence.drop_user_data(1)
+        self.assertNotIn(1, persistence._loaded_users)
+
+
+QUERY_PLAN_ROWS = int(os.getenv('QUERY_PLAN_ROWS', '1000000'))
+SEED_BATCH_SIZE = 10000
+
+
+def _bulk_create(model, objects):
+    """bulk_create пачками из генератора, возвращает id созданных строк"""
+    ids, batch = [], []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == SEED_BATCH_SIZE:
+            ids.extend(created.pk for created in model.objects.bulk_create(batch))
+            batch = []
+    if batch:
+        ids.extend(created.pk for created in model.objects.bulk_create(batch))
+    return ids
+
+
+class MyGroupsQueriesTest(TestCase):
+    """/my_groups: фиксированное число запросов при любом количестве групп"""
+
+    def _user_with_groups(self, telegram_id, count):
+        user = TelegramUser.objects.create(telegram_id=telegram_id, first_name='Пользователь')
+        for i in range(count):
+            # Своя группа с участниками
+            owned = Group.objects.create(name=f'Своя {i}', code=f'OWN{telegram_id}{i}', owner=user, description='Подарок')
+            Participant.objects.create(group=owned, user=user, name='Я')
+            for k in range(2):
+                friend = TelegramUser.objects.create(telegram_id=telegram_id * 100 + i * 10 + k, first_name='Друг')
+                Participant.objects.create(group=owned, user=friend, name=f'Друг {k}')
+
+            # Участие в чужой группе, разыгранной и с подарками через бота
+            other_owner = TelegramUser.objects.create(telegram_id=telegram_id * 100 + i * 10 + 5, first_name='Владелец')
+            other = Group.objects.create(
+                name=f'Чужая {i}', code=f'OTH{telegram_id}{i}', owner=other_owner, description='Подарок',
+                status='drawn', gift_via_bot=True,
+            )
+            me = Participant.objects.create(group=other, user=user, name='Я', gift_sent=i % 2 == 0, gift_message='Книга')
+            receiver = Participant.objects.create(group=other, user=other_owner, name=f'Получатель {i}')
+            Draw.objects.create(group=other, giver=me, receiver=receiver)
+            Draw.objects.create(group=other, giver=receiver, receiver=me)
+        return user
+
+    def _assert_three_queries(self, user, count):
+        with self.assertNumQueries(3):
+            owned_groups, participations = queries.get_my_groups(user)
+            # Текст ответа строится без дополнительных запросов
+            message = build_my_groups_message(owned_groups, participations)
+        self.assertEqual(len(owned_groups), count)
+        self.assertEqual(len(participations), count)
+        self.assertTrue(all(group.participants_count == 3 for group in owned_groups))
+        for i, participation in enumerate(participations):
+            self.assertEqual([draw.receiver.name for draw in participation.own_draws], [f'Получатель {i}'])
+            self.assertIn(f'Вы дарите подарок: Получатель {i}', message)
+
+    def test_query_count_does_not_depend_on_group_count(self):
+        self._assert_three_queries(self._user_with_groups(31, 1), 1)
+        self._assert_three_queries(self._user_with_groups(32, 15), 15)
+
+
+@tag('query_plan')
+class QueryPlanTest(TestCase):
+    """
+    Горячие запросы обработчиков используют индексы, а не полный просмотр таблиц.
+
+    Данные: QUERY_PLAN_ROWS строк (по умолчанию 1 000 000) в пользователях,
+    группах, участниках и розыгрышах; 70% групп закрыты. Долгий тест
+    можно пропустить: python manage.py test bot --exclude-tag query_plan
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        users = QUERY_PLAN_ROWS // 5
+        groups = QUERY_PLAN_ROWS // 10
+        user_ids = _bulk_create(TelegramUser, (
+            TelegramUser(telegram_id=7_000_000_000 + i, first_name=f'Участник {i}') for i in range(users)
+        ))
+        statuses = ['active', 'drawn', 'distribution'] + ['closed'] * 7
+        group_ids = _bulk_create(Group, (
+            Group(
+                name=f'Группа {i}', code=f'QP{i:08d}', owner_id=user_ids[i * 5 % users],
+                description='Подарок', status=statuses[i % 10], is_closed=statuses[i % 10] == 'closed'
+            )
+            for i in range(groups)
+        ))
+        # 5 участников в каждой группе, первый - владелец
+        participant_ids = _bulk_create(Participant, (
+            Participant(group_id=group_id, user_id=user_ids[(i * 5 + k) % users], name=f'Участник {k}')
+            for i, group_id in enumerate(group_ids)
+            for k in range(5)
+        ))
+        # Два назначения розыгрыша в каждой группе
+        _bulk_create(Draw, (
+            Draw(group_id=group_id, giver_id=participant_ids[i * 5 + k], receiver_id=participant_ids[i * 5 + 1 - k])
+            for i, group_id in enumerate(group_ids)
+            for k in range(2)
+        ))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.user = TelegramUser.objects.get(id=user_ids[5])
+
+    def assertUsesIndexes(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            scans = re.findall(r'Seq Scan on (\w+)', plan)
+        else:
+            # SQLite: "SCAN таблица" без "USING INDEX" - полный просмотр
+            scans = re.findall(r'\bSCAN (\w+)$', plan, re.MULTILINE)
+        self.assertEqual(scans, [], f'Полный просмотр таблиц в плане запроса:\n{queryset.query}\n{plan}')
+
+    def test_owned_group_by_status(self):
+        self.assertUsesIndexes(Group.objects.filter(owner=self.user, status__in=Group.OPEN_STATUSES))
+        self.assertUsesIndexes(Group.objects.filter(owner=self.user, status='active').order_by('-created_at'))
+
+    def test_participations_in_open_groups(self):
+        self.assertUsesIndexes(
+            Participant.objects.filter(user=self.user, group__is_closed=False).select_related('group')
+        )
+
+    def test_received_gifts(self):
+        self.assertUsesIndexes(
+            Draw.objects.filter(
+                receiver__user=self.user,
+                group__status__in=['distribution', 'closed']
+            ).select_related('group', 'giver', 'giver__user')
+        )
+
+    def test_open_groups(self):
+        self.assertUsesIndexes(Group.objects.filter(is_closed=False, status__in=Group.OPEN_STATUSES))
+
+    def test_scheduler_due_groups(self):
+        # Проверяются те же запросы, что выполняет планировщик
+        today = date(2030, 12, 25)
+        self.assertUsesIndexes(scheduler.due_draws_queryset(today))
+        self.assertUsesIndexes(scheduler.due_closes_queryset(today))
+
+
+class SchedulerTest(TestCase):
+    """Автоматический розыгрыш и закрытие групп по датам"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            TelegramUser.objects.create(telegram_id=800 + i, first_name=f'Участник {i}') for i in range(3)
+        ]
+        cls.today = date(2030, 12, 25)
+
+    def _group(self, code, participants=3, **fields):
+        group = Group.objects.create(name=code, code=code, owner=self.users[0], description='Подарок', **fields)
+        for user in self.users[:participants]:
+            Participant.objects.create(group=group, user=user, name=user.first_name)
+        return group
+
+    def _run_due(self):
+        return async_to_sync(scheduler.run_due)(today=self.today, batch_size=2)
+
+    def test_due_groups_are_drawn_and_closed(self):
+        yesterday = self.today - timedelta(days=1)
+        due = [self._group(f'DRAW{i}', draw_date=yesterday) for i in range(3)]
+        single = self._group('SINGLE', participants=1, draw_date=yesterday)
+        future = self._group('FUTURE', draw_date=self.today + timedelta(days=1))
+        closing = self._group('CLOSE', status='drawn', close_date=self.today)
+
+        stats = self._run_due()
+        self.assertEqual(stats, {'drawn': 3, 'failed': 1, 'closed': 1, 'skipped': 0})
+
+        for group in due:
+            group.refresh_from_db()
+            self.assertEqual(group.status, 'drawn')
+            self.assertEqual(group.draws.count(), 3)
+        single.refresh_from_db()
+        self.assertEqual(single.status, 'active')
+        self.assertIn('минимум 2 участника', single.auto_draw_error)
+        self.assertTrue(OutboxMessage.objects.filter(idempotency_key=f'auto-draw-failed:{single.id}').exists())
+        future.refresh_from_db()
+        self.assertEqual(future.status, 'active')
+        closing.refresh_from_db()
+        self.assertEqual(closing.status, 'closed')
+        self.assertTrue(closing.is_closed)
+
+        # Повторный проход ничего не меняет
+        self.assertEqual(self._run_due(), {'drawn': 0, 'failed': 0, 'closed': 0, 'skipped': 0})
+
+    def test_group_past_close_date_is_closed_without_draw(self):
+        # Старая группа: и дата розыгрыша, и дата закрытия прошли до запуска планировщика
+        past = self._group(
+            'PAST', draw_date=self.today - timedelta(days=10), close_date=self.today - timedelta(days=1)
+        )
+        self.assertEqual(scheduler.due_draws(self.today), [])
+        self.assertIsNone(scheduler.auto_draw(past.id, self.today))
+
+        stats = self._run_due()
+        self.assertEqual(stats, {'drawn': 0, 'failed': 0, 'closed': 1, 'skipped': 0})
+        past.refresh_from_db()
+        self.assertEqual(past.status, 'closed')
+        self.assertFalse(past.draws.exists())
+        # Участники получают только сообщение о закрытии, без результата розыгрыша
+        self.assertFalse(OutboxMessage.objects.filter(idempotency_key__startswith='draw:').exists())
+        self.assertEqual(OutboxMessage.objects.filter(idempotency_key__startswith='close:').count(), 3)
+
+    def test_undistributed_group_is_distributed_before_closing(self):
+        group = self._group('UNDIST', gift_via_bot=True, draw_date=self.today - timedelta(days=7))
+        services.run_draw(group)
+        Participant.objects.filter(group=group).update(gift_message='Книга', gift_sent=True)
+        Group.objects.filter(pk=group.pk).update(close_date=self.today)
+        OutboxMessage.objects.all().delete()
+
+        stats = self._run_due()
+        self.assertEqual(stats, {'drawn': 0, 'failed': 0, 'closed': 1, 'skipped': 0})
+        group.refresh_from_db()
+        self.assertEqual(group.status, 'closed')
+        # Подарки получателям уходят раньше сообщений о закрытии
+        keys = [key.split(':')[0] for key in OutboxMessage.objects.order_by('id').values_list('idempotency_key', flat=True)]
+        self.assertEqual(keys, ['gift'] * 3 + ['close'] * 3)
+        self.assertTrue(all('Книга' in text for text in OutboxMessage.objects.filter(
+            idempotency_key__startswith='gift:').values_list('text', flat=True)))
+
+    def test_locked_group_is_skipped(self):
+        group = self._group('LOCKED', draw_date=self.today)
+        # Группу уже обработал другой экземпляр между выборкой и блокировкой
+        Group.objects.filter(pk=group.pk).update(status='drawn')
+        self.assertIsNone(scheduler.auto_draw(group.id, self.today))
+
+
+class _ScriptedBot:
+    """Бот для Broadcaster: на каждую отправку в чат бросает очередную заданную ошибку, затем отправляет"""
+
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(items) for chat_id, items in (errors or {}).items()}
+        self.calls = []
+        self.sent = []
+        self.failed = asyncio.Event()
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        now = time.monotonic()
+        self.calls.append((chat_id, now))
+        errors = self.errors.get(chat_id)
+        if errors:
+            self.failed.set()
+            raise errors.pop(0)
+        self.sent.append((chat_id, now))
+
+
+class BroadcasterTest(TestCase):
+    """Лимиты, паузы и повторы движка рассылки"""
+
+    def _messages(self, chat_ids):
+        return [OutgoingMessage(chat_id=chat_id, text='Привет') for chat_id in chat_ids]
+
+    async def test_retry_after_pauses_all_senders(self):
+        broadcaster = broadcast.Broadcaster(global_rate=1000, per_chat_rate=1000)
+        bot = _ScriptedBot({1: [RetryAfter(timedelta(seconds=0.3))]})
+
+        first = asyncio.create_task(broadcaster.send(bot, OutgoingMessage(chat_id=1, text='Привет')))
+        await bot.failed.wait()
+        paused_at = bot.calls[0][1]
+        results = await broadcaster.broadcast(bot, self._messages(range(2, 6)))
+
+        self.assertTrue(all(result.ok for result in results))
+        # Ни один отправитель не обращается к API, пока действует пауза flood control
+        self.assertTrue(all(sent_at >= paused_at + 0.29 for _, sent_at in bot.calls[1:]))
+        result = await first
+        self.assertEqual((result.ok, result.attempts), (True, 2))
+
+    async def test_bad_request_is_not_retried(self):
+        bot = _ScriptedBot({1: [BadRequest('Chat not found')] * 5})
+        result = await broadcast.Broadcaster().send(bot, OutgoingMessage(chat_id=1, text='Привет'))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 1)
+        self.assertIsInstance(result.error, BadRequest)
+        self.assertEqual(len(bot.calls), 1)
+
+    async def test_network_error_backoff_stops_at_max_attempts(self):
+        bot = _ScriptedBot({1: [NetworkError('Connection reset')] * 5})
+        with mock.patch.object(broadcast, 'BACKOFF_BASE', 0.02):
+            result = await broadcast.Broadcaster(per_chat_rate=1000, max_attempts=3).send(bot, OutgoingMessage(chat_id=1, text='Привет'))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 3)
+        self.assertIsInstance(result.error, NetworkError)
+        self.assertEqual(len(bot.calls), 3)
+        # Задержка между попытками удваивается: 0.02, затем 0.04 секунды
+        times = [called_at for _, called_at in bot.calls]
+        self.assertGreaterEqual(times[1] - times[0], 0.019)
+        self.assertGreaterEqual(times[2] - times[1], 0.039)
+        self.assertLess(times[2] - times[0], 0.5)
+
+    async def test_global_rate_is_respected(self):
+        broadcaster = broadcast.Broadcaster(global_rate=50)
+        self.assertEqual(broadcast.Broadcaster().global_bucket.rate, broadcast.GLOBAL_RATE)
+        bot = _ScriptedBot()
+        started = time.monotonic()
+        await broadcaster.broadcast(bot, self._messages(range(100)), concurrency=20)
+
+        self.assertEqual(len(bot.sent), 100)
+        # Запас bucket - 50 сообщений сразу, остальные 50 - не быстрее 50 в секунду
+        self.assertGreaterEqual(time.monotonic() - started, 0.98)
+        times = sorted(sent_at for _, sent_at in bot.sent)
+        for i in range(50, 100):
+            self.assertGreaterEqual(times[i] - started, (i + 1 - 50) / 50 - 0.01)
+
+    async def test_per_chat_rate_is_respected(self):
+        broadcaster = broadcast.Broadcaster(global_rate=1000, per_chat_rate=10)
+        self.assertEqual(broadcast.Broadcaster().per_chat_interval, 1 / broadcast.PER_CHAT_RATE)
+        bot = _ScriptedBot()
+        await broadcaster.broadcast(bot, self._messages([1, 1, 1, 1, 2, 3]), concurrency=6)
+
+        chat_times = [sent_at for chat_id, sent_at in bot.sent if chat_id == 1]
+        self.assertEqual(len(chat_times), 4)
+        for earlier, later in zip(chat_times, chat_times[1:]):
+            self.assertGreaterEqual(later - earlier, 0.099)
+        # Другие чаты не ждут очереди первого
+        other = [sent_at for chat_id, sent_at in bot.sent if chat_id != 1]
+        self.assertLess(max(other) - chat_times[0], 0.05)
+
+
+class TelegramUserCacheTest(TestCase):
+    """Кэш пользователей middleware: время жизни, вытеснение и счетчики"""
+
+    def setUp(self):
+        self.now = 0.0
+
+    def _cache(self, **kwargs):
+        return middleware.TelegramUserCache(clock=lambda: self.now, **kwargs)
+
+    def test_entry_expires_after_ttl(self):
+        cache = self._cache(ttl=10)
+        user = TelegramUser(telegram_id=1, first_name='Анна')
+        cache.set(user)
+        self.now = 9.9
+        self.assertIs(cache.get(1), user)
+        self.now = 10
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self._cache(maxsize=2)
+        for telegram_id in (1, 2):
+            cache.set(TelegramUser(telegram_id=telegram_id, first_name='Тест'))
+        cache.get(1)  # 2 становится самым давним
+        cache.set(TelegramUser(telegram_id=3, first_name='Тест'))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+    async def test_resolve_upserts_each_user_once(self):
+        cache = self._cache()
+        upsert = mock.Mock(wraps=middleware.upsert_telegram_user)
+        updates = [
+            Update.de_json(make_text_update(user_id, '/help', first_name=name), None)
+            for user_id, name in ((701, 'Анна'), (702, 'Борис'), (701, 'Анна'), (701, 'Анна'), (702, 'Борис'))
+        ]
+        with mock.patch.object(middleware, 'user_cache', cache), \
+                mock.patch.object(middleware, 'upsert_telegram_user', upsert):
+            for update in updates:
+                context = mock.Mock(spec=[])
+                await middleware.resolve_telegram_user(update, context)
+                self.assertEqual(context.telegram_user.telegram_id, update.effective_user.id)
+                self.assertEqual(context.telegram_user.first_name, update.effective_user.first_name)
+
+            self.assertEqual([call.args[0] for call in upsert.call_args_list], [701, 702])
+            self.assertEqual(cache.stats()['hits'], 3)
+            self.assertEqual(cache.stats()['misses'], 2)
+            self.assertEqual(cache.stats()['hit_rate'], 0.6)
+
+            # Изменившееся имя - промах: данные в БД обновляются
+            context = mock.Mock(spec=[])
+            await middleware.resolve_telegram_user(
+                Update.de_json(make_text_update(701, '/help', first_name='Аня'), None), context
+            )
+            self.assertEqual(upsert.call_count, 3)
+            self.assertEqual(cache.misses, 3)
+        self.assertEqual((await TelegramUser.objects.aget(telegram_id=701)).first_name, 'Аня')
+        self.assertEqual(await TelegramUser.objects.filter(telegram_id__in=[701, 702]).acount(), 2)
+
+
+class DeliveryTrackingTest(TestCase):
+    """Состояние доставки на Draw и повтор только недоставленных сообщений"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            TelegramUser.objects.create(telegram_id=900 + i, first_name=f'Участник {i}') for i in range(4)
+        ]
+        cls.group = Group.objects.create(name='Доставка', code='DELIVERY', owner=cls.users[0], description='Подарок')
+        for user in cls.users:
+            Participant.objects.create(group=cls.group, user=user, name=user.first_name)
+
+    def _deliver(self, failing_chat_ids):
+        rows = outbox.claim_batch()
+        results = [
+            DeliveryResult(
+                message=OutgoingMessage(chat_id=row.chat_id, text=row.text, key=row.id),
+                ok=row.chat_id not in failing_chat_ids,
+                attempts=1,
+                error=Forbidden('bot was blocked by the user') if row.chat_id in failing_chat_ids else None
+            )
+            for row in rows
+        ]
+        outbox.record_results(rows, results)
+        return rows
+
+    def test_only_failed_deliveries_are_retried(self):
+        services.run_draw(self.group)
+        rows = self._deliver({903})
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(row.draw_id for row in rows))
+
+        failed_draw = Draw.objects.get(giver__user__telegram_id=903)
+        self.assertIsNone(failed_draw.notified_at)
+        self.assertEqual(failed_draw.attempts, 1)
+        self.assertIn('blocked', failed_draw.last_error)
+        self.assertEqual(Draw.objects.filter(notified_at__isnull=False).count(), 3)
+        self.assertEqual(
+            services.delivery_stats(self.group),
+            {'pairs': 4, 'notified': 3, 'delivered': 0, 'pending': 0, 'failed': 1, 'unreachable': 1}
+        )
+        # Заблокировавшему бота пользователю повтор не отправляется, пока он снова не отправит /start
+        self.assertEqual(queries.retry_owned_deliveries(self.users[0]), [])
+        self.assertTrue(queries.mark_reachable(TelegramUser.objects.get(telegram_id=903)))
+
+        results = queries.retry_owned_deliveries(self.users[0])
+        self.assertEqual([(group.code, queued) for group, queued, _ in results], [('DELIVERY', 1)])
+        # В очередь вернулось только недоставленное сообщение
+        retried = outbox.claim_batch()
+        self.assertEqual([row.chat_id for row in retried], [903])
+        self.assertEqual(retried[0].attempts, 0)
+
+        outbox.record_results(retried, [DeliveryResult(
+            message=OutgoingMessage(chat_id=903, text='', key=retried[0].id), ok=True, attempts=1
+        )])
+        failed_draw.refresh_from_db()
+        self.assertIsNotNone(failed_draw.notified_at)
+        self.assertIsNone(failed_draw.last_error)
+        self.assertEqual(failed_draw.attempts, 2)
+        self.assertEqual(queries.retry_owned_deliveries(self.users[0]), [])
+
+    def test_gift_delivery_is_tracked(self):
+        services.run_draw(self.group)
+        self._deliver(set())
+        services.start_distribution(self.group)
+        self._deliver({901})
+        stats = services.delivery_stats(self.group)
+        self.assertEqual((stats['notified'], stats['delivered'], stats['failed']), (4, 3, 1))
+        self.assertIsNone(Draw.objects.get(receiver__user__telegram_id=901).delivered_at)
+
+
+class ReachabilityTest(TestCase):
+    """Пользователи, заблокировавшие бота, исключаются из рассылок до /start"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            TelegramUser.objects.create(telegram_id=900 + i, first_name=f'Участник {i}') for i in range(3)
+        ]
+        cls.group = Group.objects.create(name='Доступность', code='REACH', owner=cls.users[0], description='Подарок')
+        for user in cls.users:
+            Participant.objects.create(group=cls.group, user=user, name=user.first_name)
+
+    def test_delivery_errors_mark_users_unreachable(self):
+        services.run_draw(self.group)
+        rows = outbox.claim_batch()
+        errors = {
+            901: Forbidden('Forbidden: bot was blocked by the user'),
+            902: BadRequest('Chat not found'),
+        }
+        outbox.record_results(rows, [
+            DeliveryResult(
+                message=OutgoingMessage(chat_id=row.chat_id, text=row.text, key=row.id),
+                ok=row.chat_id not in errors,
+                attempts=1,
+                error=errors.get(row.chat_id)
+            )
+            for row in rows
+        ])
+        self.assertEqual(
+            dict(TelegramUser.objects.values_list('telegram_id', 'is_reachable')),
+            {900: True, 901: False, 902: False}
+        )
+        self.assertIsNotNone(TelegramUser.objects.get(telegram_id=901).unreachable_since)
+        # Другие ошибки BadRequest не означают, что чат недоступен
+        self.assertFalse(outbox.is_unreachable(BadRequest('Message is too long')))
+
+    def test_unreachable_users_are_skipped(self):
+        outbox.mark_unreachable([901])
+        services.run_draw(self.group)
+        # Сообщение недоступному пользователю помечается недоставленным без запроса к Bot API
+        rows = outbox.claim_batch()
+        self.assertEqual(sorted(row.chat_id for row in rows), [900, 902])
+        skipped = OutboxMessage.objects.get(chat_id=901)
+        self.assertEqual((skipped.status, skipped.last_error), ('failed', outbox.UNREACHABLE_ERROR))
+        self.assertEqual(services.delivery_stats(self.group)['unreachable'], 1)
+
+        OutboxMessage.objects.all().delete()
+        self.assertEqual(services.close_group(self.group, 'Группа закрыта'), 2)
+        self.assertEqual(sorted(OutboxMessage.objects.values_list('chat_id', flat=True)), [900, 902])
+
+    async def test_start_resets_reachability(self):
+        await db.db_async(outbox.mark_unreachable)([900])
+        user_cache.clear()
+        api = FakeBotAPI()
+        application = build_application(BOT_TOKEN, outbox_workers=0, webhook=True, request=api)
+        await start_application(application)
+        await application.update_queue.put(Update.de_json(make_text_update(900, '/start'), application.bot))
+        await application.update_queue.join()
+        await stop_application(application)
+        user = await TelegramUser.objects.aget(telegram_id=900)
+        self.assertTrue(user.is_reachable)
+        self.assertIsNone(user.unreachable_since)
+
+
+class CloseAllGroupsTest(TestCase):
+    """Пакетное закрытие всех групп"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [TelegramUser.objects.create(telegram_id=900 + i, first_name=f'Участник {i}') for i in range(4)]
+        for i, status in enumerate(['active', 'drawn', 'distribution', 'closed', 'active']):
+            group = Group.objects.create(
+                name=f'Группа {i}', code=f'CLOSE{i}', owner=users[0], description='Подарок', status=status
+            )
+            for user in users[:i % 3 + 2]:
+                Participant.objects.create(group=group, user=user, name=user.first_name)
+
+    def test_dry_run_changes_nothing(self):
+        call_command('close_all_groups', '--dry-run', stdout=io.StringIO())
+        self.assertEqual(Group.objects.filter(is_closed=False).count(), 4)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_groups_are_closed_in_batches(self):
+        batches = []
+        last_id = 0
+        while True:
+            last_id, closed, queued = services.close_open_groups(last_id, batch_size=3)
+            if last_id is None:
+                break
+            batches.append((closed, queued))
+        self.assertEqual(batches, [(3, 2 + 3 + 4), (1, 3)])
+        self.assertFalse(Group.objects.filter(is_closed=False).exists())
+        self.assertFalse(Group.objects.exclude(status='closed').exists())
+        self.assertEqual(OutboxMessage.objects.filter(idempotency_key__startswith='close:').count(), 12)
+
+    def test_dry_run_skips_unreachable_users(self):
+        TelegramUser.objects.filter(telegram_id=903).update(is_reachable=False)
+        stdout = io.StringIO()
+        call_command('close_all_groups', '--dry-run', stdout=stdout)
+        self.assertIn('Будет отправлено уведомлений: 11 ', stdout.getvalue())
+        # Столько же уведомлений ставит в очередь настоящее закрытие
+        _, _, queued = services.close_open_groups(0, batch_size=10)
+        self.assertEqual(queued, 11)
+
+    async def test_delivery_is_stopped_before_error_is_raised(self):
+        finished = []
+
+        async def deliver(bot, concurrency, closing, stats):
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await asyncio.sleep(0)
+                finished.append(True)
+
+        command = close_all_groups.Command(stdout=io.StringIO())
+        with mock.patch.object(command, 'deliver', deliver), \
+                mock.patch.object(close_all_groups, 'make_bot') as make_bot, \
+                mock.patch.object(close_all_groups, 'close_open_groups', side_effect=OperationalError('database is gone')):
+            with self.assertRaises(OperationalError):
+                await command.close_groups_async(4, 500, 2)
+        self.assertEqual(finished, [True])
+        # HTTP-клиенты бота закрываются и при ошибке
+        make_bot.return_value.__aexit__.assert_awaited_once()
+
+
+class GroupCodeTest(TestCase):
+    """Выдача уникальных кодов групп"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = TelegramUser.objects.create(telegram_id=1000, first_name='Владелец')
+        Group.objects.create(name='Занята', code='TAKEN001', owner=cls.owner, description='Подарок')
+
+    def _candidates(self, *codes):
+        return mock.patch.object(Group, 'generate_code', side_effect=list(codes))
+
+    def test_collision_is_retried(self):
+        with self._candidates('TAKEN001', 'TAKEN001', 'FREE0001'):
+            group = group_codes.create_group(name='Новая', owner=self.owner, description='Подарок')
+        self.assertEqual(group.code, 'FREE0001')
+
+    def test_other_integrity_errors_are_not_retried(self):
+        with self._candidates('FREE0002', 'FREE0003'), self.assertRaises(IntegrityError):
+            group_codes.create_group(name=None, owner=self.owner, description='Подарок')
+
+    def test_bulk_allocation_replaces_taken_codes(self):
+        with self._candidates('BULK0001', 'TAKEN001', 'BULK0001', 'BULK0002'):
+            groups = group_codes.bulk_create_groups(
+                [Group(name=f'Импорт {i}', owner=self.owner, description='Подарок') for i in range(2)]
+            )
+        self.assertEqual(sorted(group.code for group in groups), ['BULK0001', 'BULK0002'])
+        self.assertEqual(Group.objects.filter(code__startswith='BULK').count(), 2)
+
+
+class TelegramRequestsTest(TestCase):
+    """Отдельные HTTP-клиенты Bot API"""
+
+    @override_settings(TELEGRAM_REQUESTS={'broadcast': {'pool_size': '10', 'http_version': None}})
+    def test_options_precedence(self):
+        options = telegram_requests.request_options('broadcast', {'broadcast': {'keepalive': 5, 'read_timeout': None}})
+        self.assertEqual(options['pool_size'], 10)
+        self.assertEqual(options['keepalive'], 5)
+        defaults = telegram_requests.DEFAULT_REQUESTS['broadcast']
+        self.assertEqual(options['http_version'], defaults['http_version'])
+        self.assertEqual(options['read_timeout'], defaults['read_timeout'])
+        with self.assertRaises(ValueError):
+            telegram_requests.request_options('bot', {'bot': {'pool': 1}})
+
+    def test_bot_over_http(self):
+        async def send(base_url):
+            bot = telegram_requests.make_bot(BOT_TOKEN, base_url=base_url, pool_size=2)
+            async with bot:
+                return await asyncio.gather(*(bot.send_message(chat_id=700, text=f'Сообщение {i}') for i in range(4)))
+
+        with FakeBotAPIServer() as server:
+            messages = async_to_sync(send)(server.base_url)
+        self.assertEqual([message.text for message in messages], [f'Сообщение {i}' for i in range(4)])
+        # getMe и 4 сообщения через пул из двух соединений с keep-alive
+        self.assertEqual(server.requests, 5)
+        self.assertLessEqual(server.connections, 3)
+
+
+class DatabaseSettingsTest(TestCase):
+    """Прагмы SQLite для новых соединений"""
+
+    def _new_connection(self):
+        new_connection = connections.create_connection(connection.alias)
+        self.addCleanup(new_connection.close)
+        new_connection.ensure_connection()
+        return new_connection
+
+    def test_sqlite_pragmas_applied_on_connect(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('прагмы применяются только к SQLite')
+        with override_settings(SQLITE_PRAGMAS={'busy_timeout': 1234, 'cache_size': -1000, 'synchronous': 'NORMAL'}):
+            values = db.sqlite_pragma_values(self._new_connection(), ['busy_timeout', 'cache_size', 'synchronous'])
+        self.assertEqual(values, {'busy_timeout': 1234, 'cache_size': -1000, 'synchronous': 1})
+
+
+class DBExecutorTest(TestCase):
+    """Пул потоков для запросов бота"""
+
+    def test_slow_call_does_not_block_other_calls(self):
+        executor = db.DBExecutor(threads=2)
+        self.addCleanup(executor._pool.shutdown)
+        release = threading.Event()
+
+        async def scenario():
+            slow = asyncio.ensure_future(executor.run(release.wait, 5))
+            # Пока первый поток занят, быстрый вызов выполняется во втором
+            self.assertEqual(await asyncio.wait_for(executor.run(threading.get_ident), 5), await executor.run(threading.get_ident))
+            release.set()
+            self.assertTrue(await slow)
+
+        async_to_sync(scenario)()
+        stats = executor.stats()
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['max_in_flight'], 2)
+        self.assertEqual(stats['functions']['Event.wait']['calls'], 1)
+        self.assertGreaterEqual(stats['run_p99_ms'], stats['functions']['Event.wait']['run_max_ms'])
+
+    def _executor(self):
+        executor = db.DBExecutor(threads=1, retry_delay=0)
+        self.addCleanup(executor._pool.shutdown)
+        return executor
+
+    def test_call_is_retried_after_connection_error(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                # Как обрыв соединения при первом запросе после простоя
+                raise OperationalError('server closed the connection unexpectedly')
+            return TelegramUser.objects.filter(telegram_id=-1).exists()
+
+        executor = self._executor()
+        self.assertFalse(async_to_sync(executor.run)(flaky))
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(executor.stats()['connections']['reconnects'], 1)
+
+    def test_call_is_not_retried_after_executed_statement(self):
+        attempts = []
+
+        def fails_after_query():
+            attempts.append(1)
+            TelegramUser.objects.filter(telegram_id=-1).exists()
+            raise OperationalError('server closed the connection unexpectedly')
+
+        executor = self._executor()
+        with self.assertRaises(OperationalError):
+            async_to_sync(executor.run)(fails_after_query)
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(executor.stats()['connections']['reconnects'], 0)
+
+    def test_retries_are_limited(self):
+        def always_fails():
+            raise OperationalError('connection refused')
+
+        executor = self._executor()
+        with self.assertRaises(OperationalError):
+            async_to_sync(executor.run)(always_fails)
+        connections_stats = executor.stats()['connections']
+        self.assertEqual(connections_stats['reconnects'], db.DEFAULT_RETRIES)
+        self.assertEqual(connections_stats['reconnect_failures'], 1)
+
+
+class MetricsTest(TestCase):
+    """Метрики Prometheus"""
+
+    def setUp(self):
+        user_cache.clear()
+
+    def _sample(self, name, labels=''):
+        """Значение метрики процесса или None (без collectors: они читают БД)"""
+        for metric in metrics.registry.metrics:
+            for sample_name, sample_labels, value in metric.samples():
+                if (sample_name, sample_labels) == (name, labels):
+                    return value
+        return None
+
+    def test_render_format(self):
+        registry = metrics.Registry()
+        counter = registry.counter('test_total', 'Счетчик', ['kind'])
+        histogram = registry.histogram('test_seconds', 'Длительность', buckets=(0.1, 1.0))
+        counter.inc('a "b"', amount=2)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_total Счетчик',
+            '# TYPE test_total counter',
+            'test_total{kind="a \\"b\\""} 2',
+            '# HELP test_seconds Длительность',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+    async def test_handlers_are_instrumented(self):
+        before = self._sample('santa_handler_updates_total', '{handler="start"}') or 0
+        queries_before = self._sample('santa_update_db_queries_count', '{handler="start"}') or 0
+        api = FakeBotAPI()
+        application = build_application(BOT_TOKEN, outbox_workers=0, webhook=True, request=api)
+        await start_application(application)
+        await application.update_queue.put(Update.de_json(make_text_update(800, '/start'), application.bot))
+        await application.update_queue.join()
+        await stop_application(application)
+
+        self.assertIn('Добро пожаловать', api.sent_messages(800)[0]['text'])
+        self.assertEqual(self._sample('santa_handler_updates_total', '{handler="start"}'), before + 1)
+        self.assertEqual(self._sample('santa_update_db_queries_count', '{handler="start"}'), queries_before + 1)
+        # Новый пользователь: запросы middleware и обработчика посчитаны
+        self.assertGreater(self._sample('santa_update_db_queries_sum', '{handler="start"}'), 0)
+
+    def test_bot_api_requests_are_recorded(self):
+        labels = '{client="broadcast",method="sendMessage"}'
+        before = self._sample('santa_bot_api_request_duration_seconds_count', labels) or 0
+
+        async def send(base_url):
+            async with telegram_requests.make_bot(BOT_TOKEN, base_url=base_url) as bot:
+                await bot.send_message(chat_id=801, text='Сообщение')
+
+        with FakeBotAPIServer() as server:
+            async_to_sync(send)(server.base_url)
+        self.assertEqual(self._sample('santa_bot_api_request_duration_seconds_count', labels), before + 1)
+
+    def test_view_access(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('santa_outbox_messages{status="pending"} 0', response.content.decode())
+        # Через прокси без токена метрики недоступны
+        self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='203.0.113.1').status_code, 403)
+        with override_settings(TELEGRAM_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+class ProfilingTest(TestCase):
+    """Профилирование обработчиков и журнал медленных обновлений"""
+
+    def setUp(self):
+        user_cache.clear()
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+
+    @override_settings(TELEGRAM_PROFILE_HANDLERS=True)
+    async def test_slow_updates_are_logged_and_profiled(self):
+        # Порог 0 мс: медленное каждое обновление; cProfile для всех, хранится один профиль
+        profiler = profiling.HandlerProfiler(slow_ms=0, sample_rate=1, profile_dir=self.profile_dir.name, keep=1)
+        with FakeBotAPIServer() as server, mock.patch.object(profiling, 'handler_profiler', profiler):
+            application = build_application(BOT_TOKEN, outbox_workers=0, webhook=True, base_url=server.base_url)
+            await start_application(application)
+            with self.assertLogs('bot.slow_updates', 'WARNING') as logs:
+                for text in ['/start', '/start', '/help']:
+                    await application.update_queue.put(Update.de_json(make_text_update(900, text), application.bot))
+                    await application.update_queue.join()
+            await stop_application(application)
+
+        records = [json.loads(message.split(':', 2)[2]) for message in logs.output]
+        self.assertEqual([record['handler'] for record in records], ['start', 'start', 'help_command'])
+        start = records[0]
+        self.assertEqual(start['user_id'], 900)
+        self.assertGreater(start['db_queries'], 0)
+        self.assertEqual(start['api_calls'], 1)
+        self.assertGreater(start['api_ms'], 0)
+        self.assertEqual(profiler.slow_updates, 3)
+        # Для каждого обработчика остался только самый медленный профиль
+        profiles = sorted(path.name.split('-')[0] for path in Path(self.profile_dir.name).iterdir())
+        self.assertEqual(profiles, ['help_command', 'start'])
+
+    def test_fast_updates_are_not_logged(self):
+        profiler = profiling.HandlerProfiler(slow_ms=1000)
+
+        async def handler(update, context):
+            return 'ok'
+
+        wrapped = profiler.wrap('handler', handler)
+        with mock.patch.object(profiling.slow_log, 'warning') as warning:
+            self.assertEqual(async_to_sync(wrapped)(None, None), 'ok')
+        warning.assert_not_called()
+        self.assertEqual((profiler.updates, profiler.slow_updates), (1, 0))
+
+
+class LoadTestTest(TestCase):
+    """Нагрузочный прогон против фейкового Bot API"""
+
+    def setUp(self):
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+
+    def test_get_updates_and_flood_control(self):
+        api = FakeBotAPI(flood_rate=1, retry_after=3)
+        api.push_updates([make_text_update(1000, '/start'), make_text_update(1000, '/help')])
+        first, second = json.loads(api.respond('getUpdates', {})[1])['result']
+        # offset подтверждает полученные обновления
+        result = json.loads(api.respond('getUpdates', {'offset': second['update_id']})[1])['result']
+        self.assertEqual([update['update_id'] for update in result], [second['update_id']])
+        status, body = api.respond('sendMessage', {'chat_id': 1000, 'text': 'Ответ'})
+        self.assertEqual(status, 429)
+        self.assertEqual(json.loads(body)['parameters'], {'retry_after': 3})
+        self.assertEqual((api.flooded, api.sent_messages()), (1, []))
+
+    async def test_season_scenario(self):
+        result = await loadtest.run_loadtest(6, group_size=3, outbox_workers=1, timeout=10)
+
+        self.assertEqual(result['groups'], 2)
+        self.assertEqual(result['timeouts'], 0)
+        self.assertEqual(result['handler_errors'], 0)
+        # start 6, создание 2 x 7, вступление 4 x 2, розыгрыш 2, подарки 6 x 2, раздача 2
+        self.assertEqual(
+            {phase: data['updates'] for phase, data in result['phases'].items()},
+            {'start': 6, 'create': 14, 'join': 8, 'draw': 2, 'send_gift': 12, 'distribute': 2}
+        )
+        self.assertGreater(result['db']['queries'], result['updates'])
+        # Результаты розыгрыша и подарки всем участникам
+        self.assertEqual(result['bot_api']['broadcast_sent'], 12)
+        self.assertEqual(await OutboxMessage.objects.filter(status='sent').acount(), 12)
+
+
+class SyntheticDatasetTest(TestCase):
+    """Синтетический набор данных (seed_synthetic)"""
+
+    def _snapshot(self):
+        return (
+            list(Group.objects.order_by('code').values_list('code', 'status', 'owner__telegram_id')),
+            list(Participant.objects.order_by('group__code', 'user__telegram_id').values_list(
+                'group__code', 'user__telegram_id', 'gift_message', 'gift_photo_file_id'
+            )),
+        )
+
+    def test_seed_is_reproducible_and_deletable(self):
+        call_command('seed_synthetic', '--users', '300', '--groups', '40', '--seed', '7', '--batch-size', '50',
+                     stdout=io.StringIO())
+        self.assertEqual(TelegramUser.objects.count(), 300)
+        self.assertEqual(Group.objects.count(), 40)
+        snapshot = self._snapshot()
+        # Пары розыгрыша: каждый участник группы после розыгрыша дарит и получает ровно один подарок
+        for group in Group.objects.exclude(status='active'):
+            participants = set(group.participants.values_list('id', flat=True))
+            pairs = list(group.draws.values_list('giver_id', 'receiver_id'))
+            self.assertEqual({giver for giver, _ in pairs}, participants)
+            self.assertEqual({receiver for _, receiver in pairs}, participants)
+            self.assertTrue(all(giver != receiver for giver, receiver in pairs))
+        self.assertFalse(Draw.objects.filter(group__status='active').exists())
+
+        with self.assertRaises(CommandError):
+            call_command('seed_synthetic', '--users', '300', stdout=io.StringIO())
+        call_command('seed_synthetic', '--delete', stdout=io.StringIO())
+        self.assertFalse(TelegramUser.objects.exists())
+        self.assertFalse(Participant.objects.exists())
+
+        call_command('seed_synthetic', '--users', '300', '--groups', '40', '--seed', '7',
+                     '--method', 'bulk_create', stdout=io.StringIO())
+        self.assertEqual(self._snapshot(), snapshot)
+
+
+class MicroBenchmarkTest(TestCase):
+    """Микробенчмарки и сравнение с базовой линией"""
+
+    def _run(self, *args):
+        stdout = io.StringIO()
+        call_command(
+            'benchmark', 'micro', '--repeats', '2', '--warmup', '0', '--min-time', '0',
+            'messages.*', 'orm.my_groups', *args, stdout=stdout
+        )
+        return stdout.getvalue()
+
+    def test_baseline_comparison_flags_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'baseline.json'
+            self._run('--save-baseline', str(path))
+            baseline = json.loads(path.read_text())
+            self.assertEqual(list(baseline['cases']), ['messages.invite', 'messages.my_groups', 'orm.my_groups'])
+            self.assertEqual(baseline['cases']['orm.my_groups']['queries'], 3)
+            # Данные бенчмарка откатываются
+            self.assertFalse(TelegramUser.objects.exists())
+
+            # Базовая линия в миллион раз быстрее и с меньшим числом запросов;
+            # порог большой, чтобы шум одиночных замеров не давал регрессий
+            baseline['cases']['messages.invite']['median'] /= 1_000_000
+            baseline['cases']['orm.my_groups']['queries'] = 2
+            path.write_text(json.dumps(baseline))
+            output = self._run('--baseline', str(path), '--threshold', '100')
+            self.assertIn('Регрессий: 2 (messages.invite, orm.my_groups)', output)
+            with self.assertRaises(CommandError):
+                self._run('--baseline', str(path), '--threshold', '100', '--fail-on-regression')
+
+
+class ShardingTest(TestCase):
+    """Шардирование обновлений по воркерам и надзор за воркерами"""
+
+    def test_shard_for_user_chat_and_update(self):
+        by_user = Update.de_json(make_text_update(1003, '/start'), None)
+        self.assertEqual(sharding.shard_for(by_user, 4), 1003 % 4)
+        # Без пользователя - по чату, без чата - по номеру обновления
+        channel_post = Update.de_json({
+            'update_id': 10,
+            'channel_post': {'message_id': 1, 'date': 0, 'chat': {'id': -1006, 'type': 'channel'}, 'text': 'Пост'},
+        }, None)
+        self.assertEqual(sharding.shard_for(channel_post, 4), -1006 % 4)
+        self.assertEqual(sharding.shard_for(Update.de_json({'update_id': 13}, None), 4), 13 % 4)
+        # Все обновления пользователя - в один шард
+        shards = {sharding.shard_for(Update.de_json(make_text_update(1003, text), None), 4) for text in ('/start', 'Имя')}
+        self.assertEqual(len(shards), 1)
+
+    def _worker_settings(self, directory):
+        """Модуль настроек для процессов-воркеров: та же тестовая база"""
+        if connection.vendor == 'sqlite':
+            # Тестовая база SQLite в памяти не видна другим процессам: воркеры получают ее копию
+            name = os.path.join(directory, 'worker.sqlite3')
+            connection.ensure_connection()
+            target = sqlite3.connect(name)
+            target.executescript('\n'.join(connection.connection.iterdump()))
+            target.close()
+        else:
+            name = connection.settings_dict['NAME']
+        Path(directory, 'shard_worker_settings.py').write_text(
+            f'from {settings.SETTINGS_MODULE} import *  # noqa\n'
+            f'DATABASES = {{"default": {{**DATABASES["default"], "NAME": {name!r}}}}}\n'
+        )
+
+    def _wait_for(self, condition, timeout=60):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Воркер не обработал обновления')
+            time.sleep(0.05)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGSTOP'), 'нужен SIGSTOP')
+    def test_hung_worker_is_replaced_and_shard_keeps_processing(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self._worker_settings(directory.name)
+        server = FakeBotAPIServer().start()
+        self.addCleanup(server.stop)
+        runner = sharding.ShardedRunner(
+            BOT_TOKEN, workers=1, heartbeat_timeout=1.5, base_url=server.base_url, stdout=io.StringIO()
+        )
+
+        # Процессы-воркеры запускаются через spawn и берут настройки и sys.path отсюда
+        with mock.patch.dict(os.environ, {'DJANGO_SETTINGS_MODULE': 'shard_worker_settings'}), \
+                mock.patch.object(sys, 'path', [directory.name, *sys.path]):
+            runner._start_worker(0)
+            self.addCleanup(runner.shutdown_workers, 5)
+            old_queue = runner.queues[0]
+            old_queue.put(make_text_update(1401, '/help'))
+            self._wait_for(lambda: runner.processed[0] == 1)
+
+            # Воркер зависает, ожидая в updates.get: лок чтения очереди остается за ним
+            hung = runner.processes[0]
+            time.sleep(0.2)
+            os.kill(hung.pid, signal.SIGSTOP)
+            for user_id in (1402, 1403, 1404):
+                old_queue.put(make_text_update(user_id, '/help'))
+            time.sleep(1.6)
+            runner._check_workers()
+
+        hung.join(5)
+        self.assertFalse(hung.is_alive())
+        self.assertEqual(runner.restarts, [1])
+        self.assertIsNot(runner.queues[0], old_queue)
+        self.assertEqual(runner.lost, [0])
+        # Обновления из очереди зависшего воркера и новые обрабатывает новый воркер
+        runner.queues[0].put(make_text_update(1405, '/help'))
+        self._wait_for(lambda: runner.processed[0] == 5)
+        for user_id in range(1401, 1406):
+            self.assertTrue(server.api.sent_messages(user_id), user_id)
+
+    def test_drain_queue_reads_past_held_lock(self):
+        old_queue = multiprocessing.get_context('spawn').Queue(10)
+        for i in range(3):
+            old_queue.put({'update_id': i})
+        time.sleep(0.1)
+        # Лок чтения остался у убитого процесса
+        self.assertTrue(old_queue._rlock.acquire(False))
+        self.assertEqual(sharding.drain_queue(old_queue, timeout=0.1), ([{'update_id': i} for i in range(3)], 0))
+
+    async def test_heartbeat_continues_while_update_queue_is_full(self):
+        heartbeats = [0.0]
+        beating = asyncio.create_task(sharding.heartbeat(0, heartbeats, interval=0.01))
+        full = asyncio.Queue(maxsize=1)
+        full.put_nowait('занято')
+        try:
+            await asyncio.sleep(0.02)
+            before = heartbeats[0]
+            # Воркер ждет места в очереди, а heartbeat идет дальше
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(full.put('обновление'), 0.05)
+            self.assertGreater(heartbeats[0], before)
+        finally:
+            beating.cancel()
+
+    async def test_processed_is_counted_after_handling(self):
+        processed = multiprocessing.get_context('spawn').Array('q', 2)
+        counter = sharding.ProcessedCounter(1, processed)
+        handled = asyncio.Event()
+
+        async def handle():
+            self.assertEqual(processed[1], 0)
+            handled.set()
+
+        await counter.do_process_update(None, handle())
+        self.assertTrue(handled.is_set())
+        self.assertEqual(list(processed), [0, 1])
+
+
+class _SlowBot:
+    """Бот, который отвечает на отправку через delay секунд и запоминает получателей"""
+
+    def __init__(self, token, delay):
+        self.token = token
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(self.delay)
+        self.sent.append(chat_id)
+
+
+class OutboxLeaseTest(TestCase):
+    """Резерв пачки outbox продлевается, пока пачка отправляется"""
+
+    async def test_slow_batch_is_not_claimed_twice(self):
+        await TelegramUser.objects.acreate(telegram_id=950, first_name='Получатель')
+        await db.db_async(outbox.enqueue)([OutgoingMessage(chat_id=950, text='Привет', key='lease:950')])
+        bot = _SlowBot('lease-test-token', delay=0.6)
+
+        with mock.patch.object(outbox, 'LEASE', timedelta(seconds=0.3)), \
+                mock.patch.object(outbox, 'LEASE_RENEW_INTERVAL', timedelta(seconds=0.1)):
+            first = asyncio.create_task(outbox.deliver_batch(bot))
+            # Отправка идет дольше резерва: без продления второй воркер забрал бы сообщение
+            await asyncio.sleep(0.45)
+            self.assertEqual(await db.db_async(outbox.claim_batch)(), [])
+            self.assertEqual(await first, 1)
+            # После отправки сообщение больше не выдается
+            await asyncio.sleep(0.35)
+            self.assertEqual(await db.db_async(outbox.claim_batch)(), [])
+
+        self.assertEqual(bot.sent, [950])
+        message = await OutboxMessage.objects.aget(idempotency_key='lease:950')
+        self.assertEqual((message.status, message.attempts), ('sent', 1))
+
+
+class DrawEngineTest(TestCase):
+    """Распределение участников розыгрыша с исключениями"""
+
+    def assertValidAssignment(self, receivers, n, forbidden):
+        self.assertEqual(sorted(receivers), list(range(n)))
+        for giver, receiver in enumerate(receivers):
+            self.assertNotEqual(giver, receiver)
+            self.assertNotIn(receiver, forbidden.get(giver, ()))
+
+    def test_derangement_has_no_fixed_points(self):
+        rng = random.Random(7)
+        for n in range(2, 200):
+            items = [f'Участник {i}' for i in range(n)]
+            receivers = draw_engine.derangement(items, rng)
+            self.assertEqual(sorted(receivers), sorted(items))
+            self.assertTrue(all(giver != receiver for giver, receiver in zip(items, receivers)))
+        # Исходный список не меняется
+        self.assertEqual(items, [f'Участник {i}' for i in range(len(items))])
+
+    def test_derangement_needs_two_items(self):
+        for items in ([], ['Один']):
+            with self.subTest(items=items), self.assertRaises(ValueError):
+                draw_engine.derangement(items, random.Random(1))
+
+    def test_assignment_respects_exclusions(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            n = rng.randint(3, 60)
+            forbidden = {giver: set(rng.sample(range(n), n // 3)) for giver in range(n)}
+            self.assertValidAssignment(draw_engine.solve_assignment(n, forbidden, rng), n, forbidden)
+
+    def test_assignment_without_exclusions_has_no_fixed_points(self):
+        for n in range(2, 30):
+            self.assertValidAssignment(draw_engine.solve_assignment(n, rng=random.Random(n)), n, {})
+
+    def test_infeasible_exclusions(self):
+        cases = [
+            (1, {}),
+            (2, {0: {1}}),                                      # двоим некого назначить
+            (5, {2: {0, 1, 3, 4}}),                             # участник исключен из всех
+            (5, {giver: {0} for giver in range(1, 5)}),         # участнику никто не дарит
+            (5, {giver: {2, 3, 4} for giver in (2, 3, 4)}),     # трое дарят только двоим - проверка Холла
+        ]
+        for n, forbidden in cases:
+            with self.subTest(n=n, forbidden=forbidden), self.assertRaises(draw_engine.DrawInfeasible):
+                draw_engine.solve_assignment(n, forbidden, random.Random(1))
+
+    def test_augmenting_paths_resolve_all_conflicts(self):
+        # Без случайных обменов все конфликты решает поиск увеличивающих путей.
+        # Исключения запрещают каждому дарителю получателя из первого цикла Саттоло
+        with mock.patch.object(draw_engine, 'REPAIR_SWAP_ATTEMPTS', 0):
+            for seed in range(10):
+                n = 3 + seed * 5
+                initial = draw_engine.derangement(range(n), random.Random(seed))
+                forbidden = {giver: {initial[giver]} for giver in range(n)}
+                receivers = draw_engine.solve_assignment(n, forbidden, random.Random(seed))
+                self.assertValidAssignment(receivers, n, forbidden)
+
+    def test_couple_exclusion_admin_action(self):
+        owner = TelegramUser.objects.create(telegram_id=990, first_name='Владелец')
+        group = Group.objects.create(name='Пары', code='COUPLE', owner=owner, description='Подарок')
+        other = Group.objects.create(name='Другая', code='COUPLE2', owner=owner, description='Подарок')
+        first, second = (
+            Participant.objects.create(group=group, user=TelegramUser.objects.create(telegram_id=991 + i), name=name)
+            for i, name in enumerate(['Аня', 'Боря'])
+        )
+        stranger = Participant.objects.create(group=other, user=owner, name='Владелец')
+        participant_admin = ParticipantAdmin(Participant, admin.site)
+
+        with mock.patch.object(participant_admin, 'message_user') as message_user:
+            participant_admin.exclude_couple(None, Participant.objects.filter(id__in=[first.id, stranger.id]))
+            self.assertFalse(Exclusion.objects.exists())
+            self.assertEqual(message_user.call_args.args[2], messages.ERROR)
+
+            participant_admin.exclude_couple(None, Participant.objects.filter(id__in=[first.id, second.id]))
+        self.assertEqual(
+            set(Exclusion.objects.values_list('giver_id', 'receiver_id', 'reason')),
+            {(first.id, second.id, 'couple'), (second.id, first.id, 'couple')}
+        )
@@ -1,5 +1,8 @@
 from django.shortcuts import render
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from bot import metrics as bot_metrics
 
 
 def index(request):
@@ -13,3 +16,10 @@ def index(request):
         'admin_url': '/admin/',
     }
     return render(request, 'bot/index.html', context)
+
+
+def metrics(request):
+    """Метрики бота в формате Prometheus (см. bot/metrics.py)"""
+    if not bot_metrics.is_authorized(request.headers, request.META.get('REMOTE_ADDR', '')):
+        return HttpResponseForbidden()
+    return HttpResponse(bot_metrics.registry.render(), content_type=bot_metrics.CONTENT_TYPE)
@@ -0,0 +1,201 @@
+"""
+Прием обновлений Telegram через webhook внутри ASGI-приложения проекта.
+
+WebhookASGI оборачивает ASGI-приложение Django: запросы на путь webhook
+обрабатываются здесь же, без middleware Django, остальные (админка, главная
+страница) передаются Django. При старте сервера (ASGI lifespan) запускается
+приложение бота и регистрируется webhook с секретным токеном.
+
+Обновление проверяется по заголовку X-Telegram-Bot-Api-Secret-Token.
+Если секрет не задан, он выводится из токена бота (HMAC), поэтому у всех
+процессов ASGI-сервера он одинаковый: webhook, зарегистрированный одним
+процессом, принимают и остальные. Обновление
+кладется в ограниченную очередь application.update_queue, и Telegram сразу
+получает ответ 200. Если очередь заполнена, отвечаем 503: Telegram повторит
+доставку позже, а память процесса не растет под нагрузкой.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from django.conf import settings
+from telegram import Update
+
+from . import outbox
+from .application import build_application, start_application, stop_application
+
+
+DEFAULT_QUEUE_SIZE = 1000
+MAX_BODY_SIZE = 1024 * 1024  # байт, с большим запасом для одного обновления
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+@dataclass
+class WebhookConfig:
+    token: str
+    url: str
+    secret: str
+    queue_size: int = DEFAULT_QUEUE_SIZE
+    outbox_workers: int = outbox.DEFAULT_WORKERS
+    outbox_batch_size: int = outbox.DEFAULT_BATCH_SIZE
+    request: object = None  # свой BaseRequest, например фейковый Bot API в тестах
+    base_url: str = None
+    http_options: dict = None  # параметры HTTP-клиентов Bot API (bot/telegram_requests.py)
+    metrics_port: int = 0      # отдельный сервер метрик; /metrics есть и в самом ASGI-приложении
+    metrics_host: str = '127.0.0.1'
+
+    @property
+    def path(self):
+        return urlparse(self.url).path or '/'
+
+
+_config = None
+
+
+def default_secret(token):
+    """Секрет webhook, одинаковый во всех процессах с одним токеном бота"""
+    return hmac.new(token.encode(), b'telegram-webhook-secret', hashlib.sha256).hexdigest()
+
+
+def configure(**kwargs):
+    """Задает настройки webhook до запуска ASGI-сервера (используется runbot --webhook)"""
+    global _config
+    _config = WebhookConfig(**kwargs)
+    return _config
+
+
+def config_from_settings():
+    """Настройки из settings/окружения или None, если webhook не настроен"""
+    token = os.getenv('TELEGRAM_BOT_TOKEN') or getattr(settings, 'TELEGRAM_BOT_TOKEN', None)
+    url = getattr(settings, 'TELEGRAM_WEBHOOK_URL', '')
+    if not token or not url:
+        return None
+    return WebhookConfig(
+        token=token,
+        url=url,
+        secret=getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '') or default_secret(token),
+        queue_size=getattr(settings, 'TELEGRAM_WEBHOOK_QUEUE_SIZE', DEFAULT_QUEUE_SIZE),
+    )
+
+
+async def _respond(send, status, body=b''):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class WebhookASGI:
+    """ASGI-приложение: webhook бота поверх ASGI-приложения Django"""
+
+    def __init__(self, django_application):
+        self.django_application = django_application
+        self.config = None
+        self.application = None
+        self.accepted = 0
+        self.rejected = 0
+        self.overflow = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http' and self.application is not None and scope['path'] == self.config.path:
+            await self._handle_update(scope, receive, send)
+        else:
+            await self.django_application(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        """Запускает бота и регистрирует webhook (если webhook настроен)"""
+        self.config = _config or config_from_settings()
+        if self.config is None:
+            return
+        self.application = build_application(
+            self.config.token,
+            outbox_workers=self.config.outbox_workers,
+            outbox_batch_size=self.config.outbox_batch_size,
+            webhook=True,
+            update_queue_size=self.config.queue_size,
+            request=self.config.request,
+            base_url=self.config.base_url,
+            http_options=self.config.http_options,
+            metrics_port=self.config.metrics_port,
+            metrics_host=self.config.metrics_host,
+        )
+        await start_application(self.application)
+        await self.application.bot.set_webhook(
+            url=self.config.url,
+            secret_token=self.config.secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+    async def shutdown(self):
+        # Webhook не удаляем: пока бот остановлен, Telegram копит обновления у себя
+        if self.application is not None:
+            await stop_application(self.application)
+            self.application = None
+
+    async def _handle_update(self, scope, receive, send):
+        if scope['method'] != 'POST':
+            await _respond(send, 405)
+            return
+
+        secret = dict(scope['headers']).get(SECRET_HEADER, b'')
+        if not hmac.compare_digest(secret, self.config.secret.encode()):
+            self.rejected += 1
+            await _respond(send, 403)
+            return
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > MAX_BODY_SIZE:
+                await _respond(send, 413)
+                return
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception:
+            await _respond(send, 400)
+            return
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.overflow += 1
+            await _respond(send, 503)
+            return
+        self.accepted += 1
+        await _respond(send, 200)
+
+    def stats(self):
+        """Счетчики webhook для мониторинга"""
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'overflow': self.overflow,
+            'queued': self.application.update_queue.qsize() if self.application else 0,
+        }
@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "santagame.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Webhook бота обслуживается тем же ASGI-приложением, что и админка.
+# Импорт после get_asgi_application(): модулям бота нужны загруженные приложения Django.
+from bot.webhook import WebhookASGI  # noqa: E402
+
+application = WebhookASGI(django_application)
@@ -115,15 +115,50 @@ if DB_ENGINE == "postgresql" and DB_NAME:
             "PORT": DB_PORT,
         }
     }
+    # Пул соединений psycopg: бот, воркеры outbox и админка берут готовые
+    # соединения из пула вместо открытия нового на каждый запрос
+    if os.getenv("DB_POOL", "true").lower() in ("1", "true", "yes"):
+        from psycopg_pool import ConnectionPool
+
+        DATABASES["default"]["OPTIONS"] = {
+            "pool": {
+                "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+                "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+                "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),  # секунд ожидания свободного соединения
+                "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "600")),  # секунд до закрытия лишнего соединения
+                # Проверка соединения перед выдачей из пула (после рестарта PostgreSQL и т.п.)
+                "check": ConnectionPool.check_connection,
+            }
+        }
+    else:
+        # Без пула: постоянные соединения с проверкой перед каждым запросом
+        DATABASES["default"]["CONN_MAX_AGE"] = int(os.getenv("DB_CONN_MAX_AGE", "60"))  # секунд
+        DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
 else:
     # По умолчанию используем SQLite
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
             "NAME": BASE_DIR / "db.sqlite3",
+            # Потоки пула запросов бота (bot/db.py) держат свои соединения, а не открывают новое на каждый вызов
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),  # секунд
+            "OPTIONS": {
+                # Транзакция сразу берет блокировку записи: при параллельной записи
+                # ожидание busy_timeout вместо ошибки "database is locked"
+                "transaction_mode": os.getenv("SQLITE_TRANSACTION_MODE", "IMMEDIATE") or None,
+            },
         }
     }
 
+# Прагмы SQLite для каждого соединения (bot/db.py), для PostgreSQL не используются
+SQLITE_PRAGMAS = {
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),  # миллисекунд
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),  # байт
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-64000")),  # отрицательное значение - в КиБ
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -166,3 +201,61 @@ STATIC_ROOT = str(BASE_DIR / "staticfiles")  # Директория для colle
 TELEGRAM_BOT_TOKEN = os.getenv(
     "TELEGRAM_BOT_TOKEN", ""
 )  # Установите токен бота в переменной окружения
+
+# Кэш пользователей Telegram в процессе бота (bot/middleware.py)
+TELEGRAM_USER_CACHE_SIZE = int(os.getenv("TELEGRAM_USER_CACHE_SIZE", "10000"))
+TELEGRAM_USER_CACHE_TTL = int(os.getenv("TELEGRAM_USER_CACHE_TTL", "300"))  # секунд
+
+# Пул потоков для запросов бота к БД (bot/db.py): 0 - один общий поток, как sync_to_async по умолчанию.
+# Для PostgreSQL с пулом соединений DB_POOL_MAX_SIZE должен быть не меньше этого значения
+TELEGRAM_DB_THREADS = int(os.getenv("TELEGRAM_DB_THREADS", "4"))
+# Повторов запроса бота после обрыва соединения с БД (рестарт PostgreSQL, разрыв по простою)
+TELEGRAM_DB_RETRIES = int(os.getenv("TELEGRAM_DB_RETRIES", "2"))
+
+# HTTP-клиенты Bot API (bot/telegram_requests.py): getUpdates (updates), ответы пользователям (bot)
+# и рассылки outbox (broadcast) с отдельными пулами соединений. Переменные окружения
+# TELEGRAM_<ПРОФИЛЬ>_<ПАРАМЕТР>, например TELEGRAM_BROADCAST_POOL_SIZE=48;
+# не заданные параметры берутся из DEFAULT_REQUESTS
+TELEGRAM_REQUESTS = {
+    profile: {
+        name: os.getenv(f"TELEGRAM_{profile.upper()}_{name.upper()}")
+        for name in (
+            "pool_size",
+            "keepalive",
+            "keepalive_expiry",
+            "http_version",
+            "connect_timeout",
+            "read_timeout",
+            "write_timeout",
+            "media_write_timeout",
+            "pool_timeout",
+        )
+    }
+    for profile in ("updates", "bot", "broadcast")
+}
+
+# Профилирование обработчиков бота (bot/profiling.py): журнал медленных обновлений bot.slow_updates
+# и выборочный cProfile. Доля обновлений под cProfile - от 0 до 1, профили пишутся в TELEGRAM_PROFILE_DIR
+TELEGRAM_PROFILE_HANDLERS = os.getenv("TELEGRAM_PROFILE_HANDLERS", "false").lower() in ("1", "true", "yes")
+TELEGRAM_SLOW_UPDATE_MS = int(os.getenv("TELEGRAM_SLOW_UPDATE_MS", "500"))
+TELEGRAM_PROFILE_SAMPLE_RATE = float(os.getenv("TELEGRAM_PROFILE_SAMPLE_RATE", "0"))
+TELEGRAM_PROFILE_DIR = os.getenv("TELEGRAM_PROFILE_DIR", str(BASE_DIR / "profiles"))
+TELEGRAM_PROFILE_KEEP = int(os.getenv("TELEGRAM_PROFILE_KEEP", "5"))  # самых медленных профилей на обработчик
+
+# Метрики в формате Prometheus (bot/metrics.py): представление /metrics и отдельный HTTP-сервер
+# в процессе runbot (порт 0 - не запускать). Без токена /metrics доступны только из локальной сети
+TELEGRAM_METRICS_PORT = int(os.getenv("TELEGRAM_METRICS_PORT", "0"))
+TELEGRAM_METRICS_HOST = os.getenv("TELEGRAM_METRICS_HOST", "127.0.0.1")
+TELEGRAM_METRICS_TOKEN = os.getenv("TELEGRAM_METRICS_TOKEN", "")  # Authorization: Bearer <токен>
+
+# Персистентность диалогов бота в БД (bot/persistence.py): интервал записи изменений
+TELEGRAM_PERSISTENCE_INTERVAL = float(os.getenv("TELEGRAM_PERSISTENCE_INTERVAL", "10"))  # секунд
+
+# Планировщик розыгрышей и закрытия групп по датам (bot/scheduler.py)
+TELEGRAM_SCHEDULER_INTERVAL = float(os.getenv("TELEGRAM_SCHEDULER_INTERVAL", "60"))  # секунд
+TELEGRAM_SCHEDULER_BATCH_SIZE = int(os.getenv("TELEGRAM_SCHEDULER_BATCH_SIZE", "100"))
+
+# Webhook бота (python manage.py runbot --webhook или ASGI-сервер с santagame.asgi:application)
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # публичный HTTPS URL, например https://example.com/telegram/webhook/
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")  # если пусто, выводится из токена бота (одинаковый во всех процессах)
+TELEGRAM_WEBHOOK_QUEUE_SIZE = int(os.getenv("TELEGRAM_WEBHOOK_QUEUE_SIZE", "1000"))
@@ -17,9 +17,10 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path
-from bot.views import index
+from bot.views import index, metrics
 
 urlpatterns = [
     path("", index, name="index"),
+    path("metrics", metrics, name="metrics"),
     path("admin/", admin.site.urls),
 ]